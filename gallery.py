@@ -13,7 +13,9 @@ Usage:
     python gallery.py --imagedir <image folder>
 """
 
-import ast
+import atexit
+import functools
+import heapq
 from logging.handlers import RotatingFileHandler
 import os
 import sys
@@ -22,26 +24,46 @@ from flask import Flask, url_for, render_template, send_from_directory,redirect,
 import logging
 from jinja2 import Environment, FileSystemLoader
 import random
+import signal
 from PIL import Image
 import pandas as pd
 import argparse
 from pathlib import Path
 from io import BytesIO
-import hashlib
 import base64
 from datetime import datetime
 from colorlog import ColoredFormatter
 import multiprocessing
 import time
 import json
-import re
 import configparser
 import piexif
 import piexif.helper
+import threading
+import sqlite3
+import gallery_thumbnails
+import gallery_store
+import gallery_index
+import gallery_scan
+import gallery_watch
+import gallery_embeddings
+import gallery_similar
+import gallery_tasks
+import gallery_exif
+import gallery_library
+import gallery_filter
+import numpy as np
 
 # Increase the maximum pixel count limit
 Image.MAX_IMAGE_PIXELS = None
 
+# Number of images whose EXIF data is read and saved at a time, an interrupted run resumes from the last saved chunk
+EXIF_CHECKPOINT_SIZE = 5000
+# Fewer images than this are read in this process, starting worker processes would take longer
+MIN_POOL_EXIF_READ = 64
+# Upper bound of the number of images a worker process reads per chunk
+EXIF_CHUNK_SIZE = 64
+
 app = Flask(__name__)
 
 def dir_path(string):
@@ -63,27 +85,244 @@ def dir_path(string):
     else:
         raise NotADirectoryError(string)
 
-def convert_string_to_list(x):
-    return eval(x) if isinstance(x, str) else []
+def scan_image_folder():
+    """Rescan the image folder, listing only the directories that changed since the last scan.
 
-# Define the column dtypes
-dtypes = {"Tags": "object", "Categorization": "object"}
+    Thumbnails of images that were removed or changed are deleted, so they are rebuilt.
 
-def filter_images_in_image_folder_path():
+    Returns:
+        gallery_scan.ScanResult: All images in the folder and the added, removed and changed ones.
+    """
     logger.debug(image_folder)
-    filtered_images = []
-    for f in image_folder.glob('**/*'):
-        if f.is_file() and is_valid_image_extension(f.name):
-            file_path = str(f)
-            filtered_images.append(file_path)
-    return filtered_images
+    scan = gallery_scan.scan_folder(image_folder, metadata_subdir / gallery_scan.MANIFEST_NAME, is_valid_image_extension)
+    logger.debug(scan)
+    for image in scan.removed | scan.changed:
+        gallery_thumbnails.thumbnail_path_for_image(image, metadata_subdir / 'thumbnails').unlink(missing_ok=True)
+    return scan
+
+def filter_images_in_image_folder_path():
+    """Rescan the image folder for the listing shown when a filter is reset.
+
+    The scan saves the new state of the folder to its manifest, so the indexing of the
+    images that were added or changed since the last scan is queued here, as the next
+    scan will not report them again.
+
+    Returns:
+        list: Paths of all images in the image folder.
+    """
+    scan = scan_image_folder()
+    if scan.added or scan.removed or scan.changed:
+        logger.info(f"The image folder changed, {scan}")
+        drop_similarity_index()
+        queue_indexing(scan.images, changed=scan.changed)
+    return scan.images
+
+def image_sha256(image):
+    """Get the sha256 key of an image path, as used to index the metadata tables."""
+    return navigation.sha256(image)
+
+def set_filtered_images(images, filters=()):
+    """Set the images being viewed and rebuild the navigation index over them.
+
+    Args:
+        images (list): Paths of the images in viewing order.
+        filters (list, optional): The filters the images were selected with, in the order
+            they were applied, see apply_filter. Empty when all images are viewed.
+    """
+    global filtered_images, active_filters
+    filtered_images = images
+    active_filters = list(filters)
+    navigation.rebuild(images)
+
+def search_prompts(search_query, search_field):
+    """Search the prompts of the images for a text.
+
+    Args:
+        search_query (str): Text to search the prompts for.
+        search_field (str): Where to search: "both", "positive" or "negative".
+
+    Returns:
+        list: The sha256 keys of the matching images.
+    """
+    if metadata_store is None:
+        # The image folder is being loaded
+        return []
+    found_hashes = metadata_store.search_prompts(search_query, search_field)
+    if found_hashes is None:
+        # No full-text index available, scan the prompts instead
+        found = pd.Series(False, index=bulk_exif_data.index)
+        if search_field in ("both", "positive"):
+            found |= bulk_exif_data['Positive prompt'].str.contains(search_query, na=False, regex=False)
+        if search_field in ("both", "negative"):
+            found |= bulk_exif_data['Negative prompt'].str.contains(search_query, na=False, regex=False)
+        found_hashes = found.index[found].tolist()
+    return found_hashes
+
+def matching_new_images(images):
+    """Get the new images that match the filters the images being viewed were selected with.
+
+    Args:
+        images (list): Paths of images that are not being viewed, with their metadata and
+            EXIF data in the filter engine.
+
+    Returns:
+        list: The paths of the matching images.
+    """
+    keys = [image_sha256(image) for image in images]
+    for active in active_filters:
+        if active["ranked"]:
+            # A semantic search only ranks the images it was run on
+            return []
+        if active["search_query"]:
+            found = set(search_prompts(active["search_query"], active["search_field"]))
+            keys = [key for key in keys if key in found]
+        if not keys:
+            return []
+        positions = filter_engine.query(among=filter_engine.positions_of(keys), **active["criteria"])
+        keys = filter_engine.keys_at(positions)
+    matching = set(keys)
+    return [image for image in images if image_sha256(image) in matching]
+
+def reads_library(fn):
+    """Decorator running a route while holding the library lock for reading."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with library_lock.read():
+            return fn(*args, **kwargs)
+    return wrapper
+
+def writes_library(fn):
+    """Decorator running a route while holding the library lock for writing."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with library_lock.write():
+            return fn(*args, **kwargs)
+    return wrapper
+
+def rebuild_vocabularies():
+    """Rebuild the tag and category vocabularies from the metadata of all images."""
+    global tag_vocabulary, category_vocabulary
+    tag_vocabulary = gallery_index.Vocabulary(imgview_data["Tags"])
+    category_vocabulary = gallery_index.Vocabulary(imgview_data["Categorization"])
+
+def rebuild_filter_engine():
+    """Rebuild the filter engine from the metadata and EXIF data of all images."""
+    global filter_engine
+    filter_engine = gallery_filter.FilterEngine(imgview_data, bulk_exif_data)
+
+def listing_positions():
+    """Get the positions in the filter engine of the images being viewed.
+
+    Cached until the listing is replaced or images are added to the filter engine.
+    """
+    global listing_positions_cache
+    listing, engine, version, positions = listing_positions_cache
+    if listing is not filtered_images or engine is not filter_engine or version != filter_engine.version:
+        positions = filter_engine.positions_of(image_sha256(image) for image in filtered_images)
+        listing_positions_cache = (filtered_images, filter_engine, filter_engine.version, positions)
+    return positions
+
+def get_clip_engine():
+    """Get the CLIP engine, loading it on first use.
+
+    Returns:
+        gallery_engine.aesthetic_engine: The engine, or None if torch or clip is not installed.
+    """
+    global aesthetic_engine
+    if aesthetic_engine is None:
+        try:
+            import gallery_engine as ge
+        except ImportError as e:
+            logger.warning(f"CLIP is not available, install torch and clip to use it: {e}")
+            return None
+        aesthetic_engine = ge.aesthetic_engine(embedding_cache=gallery_embeddings.EmbeddingCache(metadata_folder / "embeddings"))
+    return aesthetic_engine
+
+def get_similarity_index():
+    """Get the similarity index over the CLIP embeddings of all images in the folder.
+
+    The index is built by a background task, which is queued on first use, and dropped
+    whenever images are added or removed.
+
+    Returns:
+        gallery_similar.SimilarityIndex: The index, or None until it has been built.
+    """
+    with similarity_lock:
+        if similarity_index is None:
+            task = task_manager.latest("similarity")
+            if task is None or task.status not in ("pending", "running"):
+                task_manager.submit("similarity", build_similarity_index, "Indexing images for similarity search")
+        return similarity_index
+
+def similarity_index_pending():
+    """Get the response to a similarity search made while the similarity index is being built.
+
+    Returns:
+        Response: Flask JSON response with an error and the progress of the build, with status 503.
+    """
+    task = task_manager.latest("similarity")
+    return jsonify(error="The images are being indexed for similarity search, try again shortly",
+                   done=task.done if task else 0, total=task.total if task else 0), 503
+
+def drop_similarity_index():
+    """Drop the similarity index after images were added or removed, including one that is being built."""
+    global similarity_index, similarity_epoch
+    similarity_index = None
+    similarity_epoch += 1
+
+def build_similarity_index(task):
+    """Background task building the similarity index over the CLIP embeddings of all images in the folder.
+
+    The images that are not in the embedding cache yet are embedded. The index is only
+    installed if the library is still open and no images were added or removed meanwhile.
+    """
+    global similarity_index
+    engine = get_clip_engine()
+    if engine is None:
+        raise RuntimeError("Similarity search needs torch and clip to be installed")
+    with library_lock.read():
+        folder = image_folder
+        epoch = similarity_epoch
+        paths = list(imgview_data['Path']) if 'Path' in imgview_data else []
+    task.update(done=0, total=len(paths))
+    start_time = time.time()
+    embeddings = {}
+    for done, (image, embedding) in enumerate(engine.embed_many(paths, batch_size=args.aesthetic_batch_size), 1):
+        if embedding is not None:
+            embeddings[image] = embedding
+        task.update(done=done)
+    images = sorted(embeddings, key=sort_by_filename_and_parent_folder)
+    matrix = np.stack([embeddings[image] for image in images]) if images else np.empty((0, engine.embedding_cache.dim), dtype=np.float32)
+    index = gallery_similar.SimilarityIndex(images, matrix)
+    with library_lock.write():
+        if image_folder != folder or similarity_epoch != epoch:
+            logger.info("The library changed while it was indexed for similarity search, dropping the index")
+            return
+        similarity_index = index
+    logger.info("Indexed {} images for similarity search in {:.2f} seconds".format(len(images), time.time() - start_time))
+
+def semantic_search(query, k):
+    """Rank the images of the folder by the similarity of their CLIP embedding to a text.
+
+    Args:
+        query (str): A description of the images to find.
+        k (int): The maximum number of images to return.
+
+    Returns:
+        list: Paths of the best matching images, best first, or None while the similarity
+        index is being built.
+    """
+    index = get_similarity_index()
+    if index is None:
+        return None
+    return [image for image, _ in index.search(get_clip_engine().embed_text(query.strip()), k)]
 
 def check_images_in_dataframe(image_list, df):
     """
     Checks whether all the images in image_list are in the DataFrame df.
     Assumes that the DataFrame is indexed by sha256 keys.
     """
-    sha256_keys = [hashlib.sha256(image.encode()).hexdigest() for image in image_list]
+    sha256_keys = [image_sha256(image) for image in image_list]
     result = df.index.isin(sha256_keys)
     if sum(result) == len(image_list):
         logger.debug("check_images_in_dataframe: True")
@@ -93,7 +332,7 @@ def check_images_in_dataframe(image_list, df):
         return False
 
 def remove_missing_sha256(dataframe, image_list):
-    sha256_set = set(hashlib.sha256(image.encode()).hexdigest() for image in image_list)
+    sha256_set = set(image_sha256(image) for image in image_list)
     missing_sha256 = dataframe.index.difference(sha256_set)
     logger.debug(f"Length before drop: {len(dataframe)}")
     dataframe = dataframe.drop(missing_sha256)
@@ -115,6 +354,8 @@ def get_args(argv=None) -> argparse.Namespace:
     """
     parser = argparse.ArgumentParser(
         description="Image viewer built with Flask.")
+    parser.add_argument('command', nargs='?', default='serve', choices=['serve', 'index'],
+                        help="serve: run the viewer (default). index: index the image directory without starting the viewer, resuming an interrupted run.")
     parser.add_argument('--config', type=argparse.FileType('r'),
                         help='Path to configuration file')
     parser.add_argument('--imagedir', type=dir_path,
@@ -125,6 +366,11 @@ def get_args(argv=None) -> argparse.Namespace:
                         help='Set the logging level', default='ERROR')
     parser.add_argument('--cleanup', default=False, type=bool, help="Clean up metadata for deleted files.")
     parser.add_argument('--aesthetic', default=False, type=bool, help="Calculate Aesthetic score for images using method derived from https://github.com/AUTOMATIC1111/stable-diffusion-webui/discussions/1831")
+    parser.add_argument('--aesthetic_batch_size', default=32, type=int, help="Number of images scored per model run when calculating aesthetic scores")
+    parser.add_argument('--watch', default=False, type=bool, help="Watch the image folder and add new images while the viewer is running.")
+    parser.add_argument('--serve', default='debug', choices=['debug', 'production'], help="Server to run: the Flask debug server, or a multi-threaded production server (waitress if installed) for serving several users.")
+    parser.add_argument('--threads', default=8, type=int, help="Number of request threads of the production server")
+    parser.add_argument('--library_cache_mb', default=1024, type=int, help="Memory in MB for keeping folders opened with /browse loaded, so switching back to them is instant. 0 turns it off.")
     args, unknown = parser.parse_known_args(argv)
 
     if args.config:
@@ -155,9 +401,27 @@ metadata_folder = ""
 metadata_subdir = ""
 thumbnail_folder = ""
 thumbnails_sent = []
+task_manager = gallery_tasks.TaskManager()
 filtered_images = []
+active_filters = []
+navigation = gallery_index.NavigationIndex()
+folder_watcher = None
+tag_vocabulary = gallery_index.Vocabulary()
+category_vocabulary = gallery_index.Vocabulary()
+filter_engine = gallery_filter.FilterEngine()
+# The keys of the metadata rows edited while index_metadata builds a new table, None otherwise
+metadata_edits = None
+listing_positions_cache = (None, None, None, None)
 aesthetic_engine = None
+similarity_index = None
+# Bumped whenever the similarity index is dropped, so an index built meanwhile is not installed
+similarity_epoch = 0
+similarity_lock = threading.Lock()
+# Held for reading by routes that look at the open library and for writing by the ones that change it
+library_lock = gallery_library.RWLock()
+metadata_store = None
 args = get_args(sys.argv[1:])
+library_cache = gallery_library.LibraryCache(args.library_cache_mb * 2**20)
 
 logger = logging.getLogger(__name__)
 formatter = ColoredFormatter(
@@ -206,6 +470,45 @@ app.jinja_env.globals['type'] = type
 app.jinja_env.filters['my_type'] = my_type
 app.jinja_env.filters['b64encode'] = b64encode
 
+def get_thumbnail_path(image):
+    """Get the path of the thumbnail of an image, creating the thumbnail if it is missing.
+
+    Args:
+        image (str): The path of the image to get the thumbnail for.
+
+    Returns:
+        Path: The path of the thumbnail.
+
+    """
+    thumbnail_folder = metadata_subdir / 'thumbnails'
+    thumbnail_folder.mkdir(parents=True, exist_ok=True)
+
+    thumbnail_path = gallery_thumbnails.thumbnail_path_for_image(image, thumbnail_folder)
+    logger.debug(f"Thumbnail folder: {thumbnail_folder} Thumbnail path:{thumbnail_path}")
+
+    if not thumbnail_path.exists():
+        # Not built by the background stage yet, so generate it on demand
+        gallery_thumbnails.make_thumbnail(image, thumbnail_path)
+    return thumbnail_path
+
+def thumbnail_version(image):
+    """Get the version of the thumbnail of an image, for the URL of the thumbnail.
+
+    Thumbnails are rebuilt when their image changes, so the size and mtime of the image
+    file identify the thumbnail content and the browser may cache each URL forever.
+
+    Args:
+        image (str): The path of the image.
+
+    Returns:
+        str: The version, or None if the image file is gone.
+    """
+    try:
+        st = os.stat(image)
+    except OSError:
+        return None
+    return f"{st.st_mtime_ns:x}-{st.st_size:x}"
+
 def get_thumbnail_from_image(image):
     """Get the thumbnail of an image.
 
@@ -216,25 +519,501 @@ def get_thumbnail_from_image(image):
         io.BytesIO: The thumbnail image.
 
     """
+    with open(get_thumbnail_path(image), 'rb') as f:
+        return BytesIO(f.read())
+
+def current_library():
+    """Get the loaded state of the open image folder, to put it into the library cache."""
+    return gallery_library.LibraryState(image_folder, metadata_subdir, thumbnail_folder, metadata_store, bulk_exif_data,
+                                        imgview_data, filtered_images, active_filters, navigation, tag_vocabulary,
+                                        category_vocabulary, filter_engine, similarity_index)
+
+def restore_library(state):
+    """Make a library state taken from the library cache the open one."""
+    global image_folder, metadata_subdir, thumbnail_folder, metadata_store, bulk_exif_data, imgview_data, filtered_images
+    global active_filters, navigation, tag_vocabulary, category_vocabulary, filter_engine, similarity_index
+    image_folder = state.image_folder
+    metadata_subdir = state.metadata_subdir
+    thumbnail_folder = state.thumbnail_folder
+    metadata_store = state.metadata_store
+    bulk_exif_data = state.bulk_exif_data
+    imgview_data = state.imgview_data
+    filtered_images = state.filtered_images
+    active_filters = state.active_filters
+    navigation = state.navigation
+    tag_vocabulary = state.tag_vocabulary
+    category_vocabulary = state.category_vocabulary
+    filter_engine = state.filter_engine
+    similarity_index = state.similarity_index
+
+def open_library(folder, subdir):
+    """Open an image folder for viewing.
+
+    The folder is opened on an empty listing right away and loaded by a background task:
+    the folder is listed, what was indexed before is loaded from the metadata store and
+    the vocabularies and filter engine are built, then all of it is swapped in under the
+    write lock. That task queues the indexing tasks, reading the EXIF data, initializing
+    the metadata, building the thumbnails and scoring the images, so /progress reports
+    busy until the library is loaded and indexed.
+
+    The folder that was open before is put into the library cache. If the new folder is
+    in there, its state is taken back out and only the folder is rescanned.
+
+    Args:
+        folder (Path): The image folder.
+        subdir (Path): The metadata folder of the image folder, if it is not cached.
+    """
+    # Tasks of the previous library must not write into this one, let the running one stop
+    task_manager.cancel_all()
+    task_manager.wait()
+    with library_lock.write():
+        restored = _open_library(folder, subdir)
+    task_manager.submit("library", lambda task: load_library(task, restored), "Opening the library")
+
+def _open_library(folder, subdir):
+    global image_folder, metadata_subdir, thumbnail_folder, metadata_store, bulk_exif_data, imgview_data
+    global navigation, tag_vocabulary, category_vocabulary, filter_engine
+    if metadata_store is not None:
+        library_cache.put(current_library())
+        metadata_store = None
+
+    state = library_cache.pop(folder)
+    if state is not None:
+        restore_library(state)
+        return True
+
+    image_folder = folder
+    metadata_subdir = subdir
     thumbnail_folder = metadata_subdir / 'thumbnails'
+    bulk_exif_data = pd.DataFrame()
+    imgview_data = pd.DataFrame(columns=gallery_store.METADATA_COLUMNS)
+    navigation = gallery_index.NavigationIndex()
+    set_filtered_images([])
+    tag_vocabulary = gallery_index.Vocabulary()
+    category_vocabulary = gallery_index.Vocabulary()
+    filter_engine = gallery_filter.FilterEngine()
+    drop_similarity_index()
+    return False
+
+def load_library(task, restored=False):
+    """Background task loading the image folder opened by open_library.
+
+    Args:
+        task (gallery_tasks.Task): The task to report progress on.
+        restored (bool, optional): Whether the state of the folder was taken from the
+            library cache, so only the folder is rescanned.
+    """
+    global metadata_store, bulk_exif_data, imgview_data, tag_vocabulary, category_vocabulary, filter_engine
     thumbnail_folder.mkdir(parents=True, exist_ok=True)
+    scan = scan_image_folder()
+    images = sorted(scan.images, key=sort_by_filename_and_parent_folder)
+    task.update(done=len(images), total=len(images))
+    if restored:
+        if scan.added or scan.removed or scan.changed:
+            with library_lock.write():
+                set_filtered_images(images)
+                drop_similarity_index()
+        logger.info(f"Restored {image_folder} from the library cache, {scan}")
+    else:
+        store = gallery_store.open_store(metadata_subdir)
+        try:
+            exif = store.load_exif()
+            metadata = store.load_metadata()
+            logger.debug(f"Loaded {len(exif)} EXIF and {len(metadata)} metadata rows")
+            tags = gallery_index.Vocabulary(metadata["Tags"])
+            categories = gallery_index.Vocabulary(metadata["Categorization"])
+            engine = gallery_filter.FilterEngine(metadata, exif)
+            task.update()
+        except BaseException:
+            store.close()
+            raise
+        with library_lock.write():
+            metadata_store, bulk_exif_data, imgview_data = store, exif, metadata
+            tag_vocabulary, category_vocabulary, filter_engine = tags, categories, engine
+            set_filtered_images(images)
+            drop_similarity_index()
+    queue_indexing(images, changed=scan.changed)
+    if args.watch:
+        start_folder_watcher()
+
+def library_loading():
+    """Whether the open image folder is still being loaded by load_library."""
+    task = task_manager.latest("library")
+    return task is not None and task.finished is None
+
+def library_loading_error():
+    """Respond to a request that needs the image folder while it is being loaded."""
+    return jsonify(error="The image folder is being loaded, try again in a moment"), 503
+
+def queue_indexing(images, changed=()):
+    """Queue the background tasks that index the images of the library.
 
-    thumbnail_name = Path(image).name[:-4] + '_thumbnail.jpg'
-    thumbnail_path = thumbnail_folder / thumbnail_name
-    logger.debug(f"Thumbnail folder: {thumbnail_folder} Thumbnail path:{thumbnail_path}")
+    Args:
+        images (list): Paths of all images in the image folder.
+        changed (set, optional): Paths of images whose file changed since the last scan.
+    """
+    task_manager.submit("exif", lambda task: index_exif(task, images, changed), "Reading EXIF data")
+    task_manager.submit("metadata", lambda task: index_metadata(task, images), "Initializing metadata")
+    task_manager.submit("thumbnails", lambda task: index_thumbnails(task, images), "Building thumbnails")
+    if args.aesthetic:
+        queue_scoring()
+
+def queue_scoring():
+    """Queue a task scoring the images without aesthetic score, unless one is waiting to run already."""
+    task = task_manager.latest("aesthetic")
+    if task is None or task.status != "pending":
+        task_manager.submit("aesthetic", score_pending_images, "Calculating aesthetic scores")
+
+def index_exif(task, images, changed=()):
+    """Background task reading the EXIF data of the images missing from the EXIF table.
+
+    Only images without a row are read, together with the changed ones, whose rows are
+    deleted first. The new rows are read in chunks of EXIF_CHECKPOINT_SIZE, each saved to
+    the metadata store and counted by the filter engine when it is done, so an
+    interrupted run resumes with the images that are still missing. The chunks are
+    appended to the table outside the library lock, once they add up to a quarter of it,
+    so every row is copied a constant number of times however large the folder is, and
+    the lock is only taken to swap the new table in. With --cleanup the rows of images
+    that are no longer in the folder are dropped.
 
-    if not thumbnail_path.exists():
-        image_file = image
-        img = Image.open(image_file)
-        if img.format == "PNG":
-            img = img.convert("P")
-            img = img.convert("RGB")
-        ratio = img.width / img.height
-        img.thumbnail((int(256 * ratio), 256), Image.LANCZOS)
-        img.save(thumbnail_path, format='JPEG', quality=85)
-
-    with open(thumbnail_path, 'rb') as f:
-        return BytesIO(f.read())
+    Args:
+        task (gallery_tasks.Task): The task to report progress on.
+        images (list): Paths of all images in the image folder.
+        changed (set, optional): Paths of images whose file changed since the last scan.
+    """
+    global bulk_exif_data
+    keys = [image_sha256(image) for image in images]
+    stale = [image_sha256(image) for image in changed]
+    with library_lock.write():
+        if args.cleanup:
+            stale.extend(bulk_exif_data.index.difference(keys))
+        stale = bulk_exif_data.index.intersection(stale)
+        if len(stale):
+            logger.info(f"Dropping {len(stale)} outdated EXIF rows")
+            metadata_store.delete_exif(stale)
+            bulk_exif_data = bulk_exif_data.drop(stale)
+        known = set(bulk_exif_data.index)
+    pending = [image for image, key in zip(images, keys) if key not in known]
+    done = len(images) - len(pending)
+    task.update(done=done, total=len(images))
+    if not pending:
+        return
+    logger.info(f"Reading the EXIF data of {len(pending)} of {len(images)} images")
+    chunks = []
+    try:
+        for start in range(0, len(pending), EXIF_CHECKPOINT_SIZE):
+            chunk = pending[start:start + EXIF_CHECKPOINT_SIZE]
+            exif = mp_bulk_exif_read(chunk, progress=lambda chunk_done, _: task.update(done=done + chunk_done))
+            done += len(chunk)
+            with library_lock.write():
+                filter_engine.set_exif(exif)
+            chunks.append(exif)
+            if 4 * sum(len(rows) for rows in chunks) >= len(bulk_exif_data):
+                append_exif_rows(chunks)
+                chunks = []
+            task.update(done=done)
+    finally:
+        # Also when the task is cancelled, the rows read so far are in the store already
+        if chunks:
+            append_exif_rows(chunks)
+
+def append_exif_rows(chunks):
+    """Append chunks of EXIF rows to the EXIF table, building the new table outside the lock.
+
+    Rows that got into the table in the meantime, like the one of an image opened in the
+    viewer, are left out. The new table is only swapped in if the table was not replaced
+    while it was built, otherwise the rows are appended again under the lock.
+
+    Args:
+        chunks (list): EXIF DataFrames, see gallery_exif.exif_frame.
+    """
+    global bulk_exif_data
+    with library_lock.read():
+        base = bulk_exif_data
+    table = gallery_exif.concat_frames(base, *(rows[~rows.index.isin(base.index)] for rows in chunks))
+    with library_lock.write():
+        if bulk_exif_data is not base:
+            current = bulk_exif_data
+            table = gallery_exif.concat_frames(current, *(rows[~rows.index.isin(current.index)] for rows in chunks))
+        bulk_exif_data = table
+
+def index_metadata(task, images):
+    """Background task initializing the metadata of images that have none yet.
+
+    The new metadata table, vocabularies and filter engine are built without holding
+    the library lock, from the store or from a copy of the table. The rows edited in the
+    meantime are noted by record_edit, and copied over from the table being viewed when
+    the write lock is taken to swap the new ones in, so no edit is lost. If the folder
+    watcher replaced the tables meanwhile, the new rows are merged into them and the
+    vocabularies and filter engine are built again under the lock instead.
+    """
+    global imgview_data, tag_vocabulary, category_vocabulary, filter_engine, metadata_edits
+    task.update(total=len(images))
+    with library_lock.read():
+        base, exif = imgview_data, bulk_exif_data
+        metadata_edits = set()
+        if base.empty:
+            build = metadata_initialization
+        elif not check_images_in_dataframe(images, base):
+            build = update_metadata
+        else:
+            # The lists are changed in place by the edit routes
+            build = None
+            metadata = base.copy()
+            for column in ("Tags", "Categorization"):
+                metadata[column] = [list(values) for values in metadata[column]]
+    try:
+        if build is not None:
+            metadata = build(images)
+        stale_metadata = pd.Index([])
+        if args.cleanup:
+            # The EXIF rows of vanished images are dropped by index_exif
+            stale_metadata = metadata.index
+            metadata = remove_missing_sha256(metadata, images)
+            stale_metadata = stale_metadata.difference(metadata.index)
+        tags = gallery_index.Vocabulary(metadata["Tags"])
+        categories = gallery_index.Vocabulary(metadata["Categorization"])
+        engine = gallery_filter.FilterEngine(metadata, exif)
+
+        with library_lock.write():
+            edited = metadata_edits
+            metadata_edits = None
+            if imgview_data is not base or bulk_exif_data is not exif:
+                new_rows = metadata.index.difference(imgview_data.index)
+                imgview_data = pd.concat([imgview_data, metadata.loc[new_rows]]).drop(stale_metadata, errors='ignore')
+                rebuild_vocabularies()
+                rebuild_filter_engine()
+            else:
+                for key in edited.difference(stale_metadata):
+                    if key not in imgview_data.index:
+                        continue
+                    row = imgview_data.loc[key]
+                    if key in metadata.index:
+                        for vocabulary, column in ((tags, "Tags"), (categories, "Categorization")):
+                            for value in metadata.at[key, column]:
+                                vocabulary.remove(value)
+                    for vocabulary, column in ((tags, "Tags"), (categories, "Categorization")):
+                        vocabulary.add_many(row[column])
+                    metadata.loc[key] = row
+                    engine.set(key, **row.to_dict())
+                imgview_data = metadata
+                tag_vocabulary, category_vocabulary, filter_engine = tags, categories, engine
+        if len(stale_metadata):
+            metadata_store.delete_metadata(stale_metadata)
+    finally:
+        metadata_edits = None
+    task.update(done=len(images))
+
+def record_edit(sha256, **fields):
+    """Record an edit of a metadata row in the store, see gallery_store.MetadataStore.record_edit.
+
+    The key is also noted while index_metadata builds a new metadata table, which then
+    takes the row from the table being edited.
+    """
+    if metadata_edits is not None:
+        metadata_edits.add(sha256)
+    metadata_store.record_edit(sha256, **fields)
+
+def index_thumbnails(task, images):
+    """Background task building the missing thumbnails, spread over all cores."""
+    built = gallery_thumbnails.build_thumbnails(images, metadata_subdir / 'thumbnails', progress=task.progress)
+    task.update(message=f"Built {built} thumbnails")
+
+def score_pending_images(task):
+    """Background task calculating the aesthetic scores that are missing.
+
+    Scores are saved in batches as they come in, so the viewer shows them while the
+    task is running and an interrupted task does not lose them.
+    """
+    global imgview_data
+    engine = get_clip_engine()
+    if engine is None:
+        raise RuntimeError("Aesthetic scores need torch and clip to be installed")
+    with library_lock.read():
+        if 'Aesthetic_score' in imgview_data.columns:
+            pending = imgview_data.loc[imgview_data['Aesthetic_score'].isna(), 'Path']
+        else:
+            pending = imgview_data['Path']
+    keys = {image: key for key, image in pending.items()}
+    task.update(done=0, total=len(keys))
+    scores = {}
+
+    def save_scores():
+        global imgview_data
+        with library_lock.write():
+            metadata_store.update_column('Aesthetic_score', scores)
+            imgview_data.loc[list(scores), 'Aesthetic_score'] = list(scores.values())
+            for key, score in scores.items():
+                filter_engine.set(key, Aesthetic_score=score)
+        scores.clear()
+
+    for done, (image, score) in enumerate(engine.score_many(list(keys), batch_size=args.aesthetic_batch_size), 1):
+        if score is not None:
+            scores[keys[image]] = score
+        if len(scores) >= args.aesthetic_batch_size * 8:
+            save_scores()
+        task.update(done=done)
+    if scores:
+        save_scores()
+
+def ingest_changes(added, removed, folder):
+    """Add new images to and drop deleted images from the loaded library.
+
+    Called by the folder watcher with a batch of changes. Only the images in the batch
+    are processed: their EXIF data is read, their metadata is initialized, their
+    thumbnails are built and, with --aesthetic, a task scoring them is queued.
+
+    Args:
+        added (set): Paths of new or changed images.
+        removed (set): Paths of deleted images.
+        folder (Path): The image folder the watcher was started for. The batch is dropped
+            if another folder is open.
+    """
+    global bulk_exif_data, imgview_data
+    if image_folder != folder:
+        return
+    start_time = time.time()
+    added = sorted(p for p in added if os.path.isfile(p))
+    removed = set(removed)
+    new_metadata = {}
+
+    # Read EXIF data for the new images only, in parallel for large batches
+    new_exif = mp_bulk_exif_read(added) if added else None
+    with library_lock.write():
+        if image_folder != folder:
+            logger.info(f"Dropping a batch of changes to {folder}, which is no longer open")
+            return
+        thumbnails = metadata_subdir / 'thumbnails'
+        drop_similarity_index()
+        if added:
+            bulk_exif_data = gallery_exif.concat_frames(bulk_exif_data.drop(new_exif.index, errors='ignore'), new_exif)
+            filter_engine.set_exif(new_exif)
+
+            for image in added:
+                key = image_sha256(image)
+                if key in imgview_data.index:
+                    continue
+                new_metadata[key] = {'Favorites': False,
+                                     'Rating': 0,
+                                     'Tags': [],
+                                     'Categorization': [],
+                                     'Reviewed': False,
+                                     'Todelete': False,
+                                     'Path': image}
+            if new_metadata:
+                new_df = pd.DataFrame.from_dict(new_metadata, orient='index')
+                new_df.index.name = "sha256"
+                metadata_store.save_metadata(new_df)
+                imgview_data = pd.concat([imgview_data, new_df])
+                for key, metadata in new_metadata.items():
+                    filter_engine.set(key, **metadata)
+
+        if removed and args.cleanup:
+            removed_keys = [image_sha256(image) for image in removed]
+            imgview_data = imgview_data.drop(removed_keys, errors='ignore')
+            bulk_exif_data = bulk_exif_data.drop(removed_keys, errors='ignore')
+            metadata_store.delete_metadata(removed_keys)
+            metadata_store.delete_exif(removed_keys)
+            rebuild_filter_engine()
+
+        # The images being viewed keep their order, new ones are added if they match the filter
+        images = [image for image in filtered_images if image not in removed]
+        new_images = matching_new_images([image for image in added if image not in navigation])
+        if new_images:
+            images = list(heapq.merge(images, sorted(new_images, key=sort_by_filename_and_parent_folder),
+                                      key=sort_by_filename_and_parent_folder))
+        set_filtered_images(images, active_filters)
+    # Changed images are in the batch as well, their old thumbnails would be kept otherwise
+    for image in added:
+        gallery_thumbnails.thumbnail_path_for_image(image, thumbnails).unlink(missing_ok=True)
+    gallery_thumbnails.build_thumbnails(added, thumbnails)
+    if args.aesthetic and new_metadata:
+        queue_scoring()
+    logger.info("Ingested {} new and {} deleted images in {:.2f} seconds".format(len(added), len(removed), time.time() - start_time))
+
+def start_folder_watcher():
+    """Start watching the image folder for new and deleted images, replacing the previous watcher."""
+    global folder_watcher
+    stop_folder_watcher()
+    folder_watcher = gallery_watch.FolderWatcher(image_folder, functools.partial(ingest_changes, folder=image_folder),
+                                                 is_valid_image_extension)
+    folder_watcher.start()
+
+def stop_folder_watcher():
+    """Stop the folder watcher, waiting for the batch it is ingesting."""
+    global folder_watcher
+    if folder_watcher is not None:
+        folder_watcher.stop()
+        folder_watcher = None
+
+def serve_production():
+    """Serve the app with a multi-threaded server and without the debugger.
+
+    Uses waitress when it is installed, and the threaded Werkzeug server otherwise.
+    """
+    try:
+        import waitress
+    except ImportError:
+        logger.warning("waitress is not installed (pip install waitress), serving with the threaded Werkzeug server")
+        from werkzeug.serving import run_simple
+        print(f"Serving on http://0.0.0.0:{args.port}")
+        run_simple("0.0.0.0", args.port, app, threaded=True)
+        return
+    print(f"Serving on http://0.0.0.0:{args.port} with {args.threads} threads")
+    waitress.serve(app, host="0.0.0.0", port=args.port, threads=args.threads)
+
+def close_libraries():
+    """Write the pending edits of the open and the cached libraries to their stores and close them, at shutdown."""
+    # Background tasks stop at their next progress report, before the store is closed under them
+    task_manager.cancel_all()
+    task_manager.wait()
+    with library_lock.write():
+        library_cache.clear()
+        if metadata_store is not None:
+            metadata_store.checkpoint()
+            metadata_store.close()
+
+def run_index():
+    """Index the image directory to completion without starting the viewer.
+
+    Runs the same background tasks as the viewer and writes the same metadata folder,
+    printing their progress. Every task saves its work as it goes, so running the
+    command again after an interruption continues where it stopped.
+
+    Returns:
+        int: The exit code, 1 if a task failed.
+    """
+    global image_folder, metadata_folder
+    if not args.imagedir:
+        print("The index command needs --imagedir")
+        return 2
+    image_folder = Path(args.imagedir)
+    metadata_folder = Path("metadata")
+    metadata_folder.mkdir(parents=True, exist_ok=True)
+    start_time = time.time()
+    open_library(image_folder, metadata_folder / (image_folder.parent.name + '_' + image_folder.name))
+    print(f"Indexing {image_folder}")
+
+    last_line = None
+    last_print = 0
+    while task_manager.busy():
+        running = [task for task in task_manager.snapshot()["tasks"] if task["status"] == "running"]
+        if running:
+            line = "{description}: {done} / {total}".format(**running[0])
+            if line != last_line and time.time() - last_print >= 2:
+                print(line, flush=True)
+                last_line = line
+                last_print = time.time()
+        time.sleep(0.2)
+    task_manager.wait()
+
+    failed = [task for task in task_manager.snapshot()["tasks"] if task["status"] == "failed"]
+    for task in failed:
+        print(f"{task['description']} failed: {task['error']}")
+    if metadata_store is not None:
+        metadata_store.checkpoint()
+    print("Indexing took: {:.2f} seconds".format(time.time() - start_time))
+    return 1 if failed else 0
 
 # Define a sorting function to sort based on filename and parent folder
 def sort_by_filename_and_parent_folder(image_path):
@@ -254,7 +1033,7 @@ def fetch_thumbnails(limit, offset, imgsrc):
         offset (int): The offset of the first thumbnail to fetch.
 
     Returns:
-        List[Dict[str, Any]]: A list of thumbnail responses and image source URLs.
+        List[Dict[str, Any]]: A list of thumbnail URLs and image source URLs.
 
     """
     logger.debug("limit: %d. offset: %d. imgsrc: %s" % (limit, offset, imgsrc))
@@ -266,11 +1045,8 @@ def fetch_thumbnails(limit, offset, imgsrc):
     thumbnails = []
     sorted_image_paths = sorted(images[offset:offset+limit], key=sort_by_filename_and_parent_folder)
     for image in sorted_image_paths:
-        thumbnail = (get_thumbnail_from_image(image))
-        response = make_response(thumbnail)
-        response.headers.set('Content-Type', 'image/jpeg')
-        response.headers.set('Content-Disposition', 'inline', filename=image)
-        thumbnails.append({"response": response, "image_src": url_for('image_viewer', image_name=image)})
+        sha256 = image_sha256(image)
+        thumbnails.append({"thumb_src": url_for('thumbnail', sha256=sha256, v=thumbnail_version(image)), "image_src": url_for('image_viewer', image_name=image)})
     logger.debug(len(thumbnails))
     return thumbnails
 
@@ -285,6 +1061,8 @@ def filter_images():
         # Retrieve user input from AJAX request
         try:
             search_query = request.form.get("search_query")
+            search_field = request.form.get("search_field", "both")
+            search_limit = request.form.get("search_limit", 200, type=int)
             favorites = request.form.get("favorites") if request.form.get("favorites") is not None else None
             rating_str = request.form.get("rating")
             rating = int(rating_str) if rating_str and rating_str.strip() else None
@@ -296,76 +1074,100 @@ def filter_images():
         except Exception as e:
             logger.error(str(e))
             return handle_value_error(e)
+        if library_loading():
+            return library_loading_error()
+
+        ranked_images = None
+        if search_query and search_field == "semantic":
+            logger.debug("semantic search_query")
+            if get_clip_engine() is None:
+                return jsonify(error="Semantic search needs torch and clip to be installed"), 503
+            # Outside of the library lock, embedding the query runs CLIP
+            ranked_images = semantic_search(search_query, search_limit)
+            if ranked_images is None:
+                return similarity_index_pending()
+        with library_lock.write():
+            return apply_filter(search_query, search_field, favorites, rating, ascore, tags, categories, ranked_images)
+    except Exception as e:
+        logger.error(traceback.format_exc())
+        return bad_request_error(e)
 
-        # Filter the metadata dataframe based on user input
-        filtered_df = imgview_data.copy()
-        filtered_exif_df = bulk_exif_data.copy()
-        logger.debug(filtered_exif_df.index)
-        if search_query:
-            logger.debug("search_query")
-            found_images = filtered_exif_df[filtered_exif_df['Positive prompt'].str.contains(search_query, na=False) | filtered_exif_df['Negative prompt'].str.contains(search_query, na=False)]
-            logger.debug(found_images)
-            if not found_images.empty:
-                found_hashes = found_images.index.tolist()
-                filtered_df = filtered_df.loc[found_hashes]
-            else:
-                filtered_df = None
-                
-        if not filtered_df.empty:        
-            if favorites in ['True', 'False']:
-                favorites = ast.literal_eval(favorites)
-                filtered_df = filtered_df[filtered_df["Favorites"] == favorites]
-            if rating:
-                logger.debug(f"rating is not None: {rating}")
-                filtered_df["Rating"] = filtered_df["Rating"].astype(int)
-                filtered_df = filtered_df[filtered_df["Rating"] >= rating]
-            if tags:
-                logger.debug(f"tags is not None: {tags}")
-                tags_list = tags.split(",")
-                filtered_df = filtered_df[filtered_df["Tags"].apply(lambda x: [x] if not isinstance(x, list) else x).apply(lambda x: any(tag in x for tag in tags_list))]
-            if categories:
-                logger.debug(f"categories is not None: {categories}")
-                categories_list = categories.split(",")
-                filtered_df = filtered_df[filtered_df["Categorization"].apply(lambda x: [x] if not isinstance(x, list) else x).apply(lambda x: any(category in categories_list for category in categories_list))]
-            if ascore:
-                logger.debug(f"ascore is not None: {ascore}")
-                filtered_df["Aesthetic_score"] = filtered_df["Aesthetic_score"].astype(int)
-                filtered_df = filtered_df[filtered_df["Aesthetic_score"] >= ascore]
-
-            # Retrieve list of filtered image filenames
-            logger.debug(filtered_df)
-            filtered_image_list = filtered_df.index.tolist()
-            logger.debug(filtered_image_list)
-            if len(filtered_image_list) > 0:
-                global filtered_images
-                filtered_images = [x for x in filtered_images if hashlib.sha256(x.encode()).hexdigest()  in filtered_image_list]
-                if len(filtered_images) == 0:
-                    filtered_images = sorted(filter_images_in_image_folder_path(), key=sort_by_filename_and_parent_folder)
-                    logger.debug(f"Resetting filtered_images to the ones in your vieweing directory. You have {len(filtered_images)} in your viewing direcotry images.")
-                    response = url_for('zen', message="No images found for your filter")
-                else:
-                    logger.debug(filtered_images)
-                    response = url_for('image_viewer', image_name=get_random_image())
-                    logger.debug(response)
+def apply_filter(search_query, search_field, favorites, rating, ascore, tags, categories, ranked_images):
+    """Set the images being viewed to the ones matching a filter.
+
+    Args:
+        search_query (str): Text to search the prompts for, or None.
+        search_field (str): Where to search: "both", "positive", "negative" or "semantic".
+        favorites (str): "True" or "False" to only keep favorites or non-favorites, or None.
+        rating (int): The minimum rating, or None.
+        ascore (int): The minimum aesthetic score, or None.
+        tags (str): Comma separated tags of which an image needs one, or None. Tags
+            prefixed with "+" are required and ones prefixed with "-" excluded.
+        categories (str): Comma separated categories, as for tags, or None.
+        ranked_images (list): The result of a semantic search, best match first, or None.
+
+    Returns:
+        Response: Flask JSON response with the URL to go to.
+    """
+    # Filter the metadata with the filter engine, restricted to the search results if any
+    among = None
+    if ranked_images is not None:
+        among = filter_engine.positions_of([image_sha256(image) for image in ranked_images])
+    elif search_query:
+        logger.debug("search_query")
+        found_hashes = search_prompts(search_query, search_field)
+        logger.debug(found_hashes)
+        among = filter_engine.positions_of(found_hashes)
+
+    if len(filter_engine) > 0 and (among is None or len(among) > 0):
+        logger.debug(f"favorites: {favorites} rating: {rating} ascore: {ascore} tags: {tags} categories: {categories}")
+        # Kept with the listing, so images added by the folder watcher are filtered the same way
+        active = {"search_query": search_query if ranked_images is None else None,
+                  "search_field": search_field,
+                  "ranked": ranked_images is not None,
+                  "criteria": {"favorites": {'True': True, 'False': False}.get(favorites),
+                               "min_rating": rating or None,
+                               "min_ascore": ascore or None,
+                               "tags": tags.split(",") if tags else None,
+                               "categories": categories.split(",") if categories else None}}
+        positions = filter_engine.query(among=among, **active["criteria"])
+
+        # Retrieve list of filtered image filenames
+        filtered_image_list = set(filter_engine.keys_at(positions))
+        logger.debug(filtered_image_list)
+        if len(filtered_image_list) > 0:
+            if ranked_images is not None:
+                # Keep the semantic ranking as viewing order, best match first
+                set_filtered_images([x for x in ranked_images if x in navigation and image_sha256(x) in filtered_image_list],
+                                    active_filters + [active])
             else:
-                #filtered_images = filter_images_in_image_folder_path()
-                filtered_images = sorted(filter_images_in_image_folder_path(), key=sort_by_filename_and_parent_folder)
+                set_filtered_images([x for x in filtered_images if image_sha256(x) in filtered_image_list],
+                                    active_filters + [active])
+            if len(filtered_images) == 0:
+                set_filtered_images(sorted(filter_images_in_image_folder_path(), key=sort_by_filename_and_parent_folder))
                 logger.debug(f"Resetting filtered_images to the ones in your vieweing directory. You have {len(filtered_images)} in your viewing direcotry images.")
                 response = url_for('zen', message="No images found for your filter")
+            else:
+                logger.debug(filtered_images)
+                response = url_for('image_viewer', image_name=filtered_images[0] if ranked_images is not None else get_random_image())
                 logger.debug(response)
         else:
             #filtered_images = filter_images_in_image_folder_path()
-            filtered_images = sorted(filter_images_in_image_folder_path(), key=sort_by_filename_and_parent_folder)
+            set_filtered_images(sorted(filter_images_in_image_folder_path(), key=sort_by_filename_and_parent_folder))
             logger.debug(f"Resetting filtered_images to the ones in your vieweing directory. You have {len(filtered_images)} in your viewing direcotry images.")
             response = url_for('zen', message="No images found for your filter")
             logger.debug(response)
-        #return redirect(url_for('image_viewer', image_name=get_random_image()))
-        return jsonify(response)
-    except Exception as e:
-        logger.error(traceback.format_exc())
-        return bad_request_error(e)
+    else:
+        #filtered_images = filter_images_in_image_folder_path()
+        set_filtered_images(sorted(filter_images_in_image_folder_path(), key=sort_by_filename_and_parent_folder))
+        logger.debug(f"Resetting filtered_images to the ones in your vieweing directory. You have {len(filtered_images)} in your viewing direcotry images.")
+        response = url_for('zen', message="No images found for your filter")
+        logger.debug(response)
+    #return redirect(url_for('image_viewer', image_name=get_random_image()))
+    return jsonify(response)
 
 @app.route('/')
+@reads_library
 def index(): 
     """Redirect to the image_viewer route with a randomly selected image.
 
@@ -375,6 +1177,7 @@ def index():
     return redirect(url_for('image_viewer', image_name=get_random_image()))
 
 @app.route('/numimages')
+@reads_library
 def get_num_images():
     """Get the number of images in the image directory.
 
@@ -404,6 +1207,7 @@ def image_data_thumbnails(image_name):
     return response
 
 @app.route('/thumbnails')
+@reads_library
 def thumbnails():
     """Get a list of thumbnail images.
 
@@ -428,6 +1232,68 @@ def thumbnails():
     # Render the thumbnail partial using Jinja2 template
     return render_template('thumbnail_partial.html', thumbnails=thumbnails)
 
+@app.route('/thumb/<sha256>')
+def thumbnail(sha256):
+    """Get the thumbnail of an image by the sha256 key of its path.
+
+    Thumbnail URLs are handed out by /thumbnails, so the browser can fetch them in parallel
+    and keep them in its cache. The URL holds the version of the thumbnail, see
+    thumbnail_version, and a thumbnail requested with its current version is cached as
+    immutable. Other requests are revalidated against the strong ETag, and a request with
+    a matching If-None-Match header gets an empty 304 response.
+
+    Args:
+        sha256 (str): The sha256 key of the image path.
+        v (str): The version of the thumbnail.
+
+    Returns:
+        Response: Flask response containing the thumbnail, or a 304 or 404 response.
+    """
+    with library_lock.read():
+        image = navigation.path_for_sha256(sha256)
+        if image is None and sha256 in imgview_data.index:
+            # An image outside the current listing, e.g. a result of /similar
+            image = imgview_data.at[sha256, 'Path']
+    # Thumbnails missing on disk are made outside of the lock
+    if image is None:
+        return jsonify("Unknown thumbnail"), 404
+    version = thumbnail_version(image)
+    thumbnail_path = get_thumbnail_path(image)
+    stat = thumbnail_path.stat()
+    if version is not None and stat.st_mtime_ns < os.stat(image).st_mtime_ns:
+        # The image changed and its old thumbnail has not been deleted yet
+        gallery_thumbnails.make_thumbnail(image, thumbnail_path)
+        stat = thumbnail_path.stat()
+    etag = f"{sha256}-{stat.st_mtime_ns:x}-{stat.st_size:x}"
+    current = version is not None and request.args.get("v") == version
+    # Without a max_age the response is sent with no-cache
+    response = send_file(thumbnail_path.resolve(), mimetype='image/jpeg', etag=etag, conditional=True,
+                         max_age=31536000 if current else None)
+    response.cache_control.public = True
+    response.cache_control.immutable = current
+    return response
+
+@app.route('/thumbnails/progress')
+def thumbnails_progress():
+    """Get the progress of the background thumbnail build.
+
+    Returns:
+        Response: Flask JSON response with whether the build is running and how many thumbnails are done.
+    """
+    task = task_manager.latest("thumbnails")
+    if task is None:
+        return jsonify(running=False, done=0, total=0)
+    return jsonify(running=task.status in ("pending", "running"), done=task.done, total=task.total)
+
+@app.route('/progress')
+def progress():
+    """Get the progress of the background indexing tasks.
+
+    Returns:
+        Response: Flask JSON response with whether indexing is still busy and the state of the recent tasks.
+    """
+    return jsonify(task_manager.snapshot())
+
 @app.route("/image")
 def image_data():
     """
@@ -457,6 +1323,7 @@ def image_data():
     return response
 
 @app.route("/imagedirection")
+@reads_library
 def image_direction():
     """
     Returns the image data for the specified image name.
@@ -502,52 +1369,14 @@ def browse():
         return bad_request_error('folder_path is empty or not present in form data')
     incoming_image_folder_path = Path(request.form.get('folder_path'))
     logger.debug(f"Incodming image folder path: {incoming_image_folder_path}")
-    global image_folder
     if image_folder == incoming_image_folder_path:
         logger.warning(f"We are already in this folder.")
         return zen("We are already in this folder.")
-    image_folder = incoming_image_folder_path
-    logger.debug(image_folder)
-    global metadata_subdir
-    metadata_subdir = metadata_folder / image_folder.name
-    metadata_subdir.mkdir(parents=True, exist_ok=True)
-    logger.debug(metadata_subdir)
-    global thumbnail_folder
-    thumbnail_folder = metadata_subdir / 'thumbnails'
-    thumbnail_folder.mkdir(parents=True, exist_ok=True)
-    logger.debug(thumbnail_folder)
-    global filtered_images
-    #filtered_images = [f.name for f in image_folder.iterdir() if f.is_file() and is_valid_image_extension(f.name)]
-    #filtered_images = filter_images_in_image_folder_path()
-    filtered_images = sorted(filter_images_in_image_folder_path(), key=sort_by_filename_and_parent_folder)
-    logger.debug(f"filtered_images: {filtered_images}")
     start_time = time.time()
-    
-    global bulk_exif_data
-    # Check if EXIF data already exists
-    exif_df_path = metadata_subdir.joinpath("exif_df.csv")
-    if exif_df_path.exists():
-        bulk_exif_data = pd.read_csv(exif_df_path)
-        bulk_exif_data.set_index('sha256', inplace=True)
-        #bulk_exif_data['Sampler settings'] = pd.array(bulk_exif_data['Sampler settings'].tolist())
-        logger.warning(len(bulk_exif_data))
-    else:
-        logger.debug("Creating bulk exif data")
-        # Read EXIF data for images
-        bulk_exif_data = mp_bulk_exif_read(filtered_images)
-    
-    global imgview_data
-    # Check if metadata already exists
-    metadata_path = metadata_subdir.joinpath("imgview_metadata.csv")
-    if metadata_path.exists():
-        imgview_data = pd.read_csv(metadata_path, converters={'Tags': convert_string_to_list, 'Categorization': convert_string_to_list}, dtype=dtypes)
-        imgview_data.set_index('sha256', inplace=True)
-        logger.warning(len(imgview_data))
-    else:
-        logger.debug("Initializing imgview data")
-        # Initialize metadata for images
-        imgview_data = metadata_initialization()
-    
+    # A batch of the watcher must not be ingested into the folder that is opened
+    stop_folder_watcher()
+    open_library(incoming_image_folder_path, metadata_folder / incoming_image_folder_path.name)
+
     end_time = time.time()
     execution_time = end_time - start_time
     logger.debug("Changing directory took: {:.2f} seconds".format(execution_time))
@@ -560,24 +1389,31 @@ def zen(message):
 @app.route('/save', methods=['PUT'])
 def save():
     """
-    Saves the metadata to the csv
+    Saves the metadata to disk.
+
+    Edits are already recorded in the edit journal of the metadata store, so this only
+    compacts the journal into the store and folds the store's write-ahead log back into
+    the database file.
     """
     try:
-        imgview_data.to_csv(metadata_subdir.joinpath("imgview_metadata.csv"), index=True, header=True)
+        if metadata_store is not None:
+            metadata_store.checkpoint()
         logger.debug("Saving metadata to disk")
         return jsonify("Saved"), 200
-    except ValueError as e:
+    except (ValueError, sqlite3.Error) as e:
         logger.error(f"Error saving metadata: {str(e)}")
         return jsonify("Error saving metadata"), 500
 
 @app.route('/resetfilter', methods=['POST'])
+@writes_library
 def reset_filter():
     """
     Resets filter
     """
+    if library_loading():
+        return redirect(url_for('zen', message="The image folder is being loaded"))
     try:
-        global filtered_images
-        filtered_images = sorted(filter_images_in_image_folder_path(), key=sort_by_filename_and_parent_folder)
+        set_filtered_images(sorted(filter_images_in_image_folder_path(), key=sort_by_filename_and_parent_folder))
         logger.debug("Resetting filter")
         return redirect(url_for('image_viewer', image_name=get_random_image()))
     except ValueError as e:
@@ -611,6 +1447,10 @@ def image_viewer():
     Creates a list of dictionaries for each thumbnail image, including its URL, alt text, and whether or not it is the current image.
     Retrieves the EXIF data for the current image, tries to convert the "Sampler settings" key in exif_data to a dictionary,
     and renders the image_template.html template with the appropriate variables.
+
+    The page is looked up while holding the library lock for reading, so viewers are served
+    in parallel. EXIF data that is not indexed yet is read from the file without the lock,
+    and the lock is only held for writing to store it and to mark the image as reviewed.
     
     Args:
         image_name (str): The name of the selected image.
@@ -620,110 +1460,78 @@ def image_viewer():
     """
     image_name = request.args.get("image_name")
     logger.debug(image_name)
-    # Get a list of all images available in the image directory.
-    image_list = get_image_names_in_image_dir()
-
-    # Get the filter criteria from the request parameters
-    filter_criteria = request.args.get('filter_criteria')
-
-    # Filter the images based on the filter criteria
-    if filter_criteria:
-        images = filter_images(images, filter_criteria)
-
-    # Check if the image_name parameter is a digit or not.
-    # If it is a digit, set image_index to that integer value.
-    # Otherwise, get the index of the selected image by name.
-    if image_name.isdigit():
-        image_index = int(image_name)
-    else:
-        image_index = get_image_index_by_name(image_name)
+    with library_lock.read():
+        folder = image_folder
+        # Get a list of all images available in the image directory.
+        image_list = get_image_names_in_image_dir()
+        if not image_list:
+            message = "The image folder is being loaded" if library_loading() else "No images found in the image folder"
+            return redirect(url_for('zen', message=message))
+
+        # Get the filter criteria from the request parameters
+        filter_criteria = request.args.get('filter_criteria')
+
+        # Filter the images based on the filter criteria
+        if filter_criteria:
+            images = filter_images(images, filter_criteria)
+
+        # Check if the image_name parameter is a digit or not.
+        # If it is a digit, set image_index to that integer value.
+        # Otherwise, get the index of the selected image by name.
+        if image_name.isdigit():
+            image_index = int(image_name)
+        else:
+            image_index = get_image_index_by_name(image_name)
+
+        # Ensure that image_index is within the valid range of image_list indices.
+        if image_index == None:
+            randomimg = get_random_image()
+            image_index = get_image_index_by_name(randomimg)
+            
+        if image_index < 0:
+            image_index = len(image_list) - 1
+        if image_index >= len(image_list):
+            image_index = 0
+
+        # Set the image_src and image_alt variables.
+        image_src = image_list[image_index]
+        image_alt = image_src
+        maxindex = len(image_list)
+        hash_value = image_sha256(image_src)
 
-    # Ensure that image_index is within the valid range of image_list indices.
-    if image_index == None:
-        randomimg = get_random_image()
-        image_index = get_image_index_by_name(randomimg)
-        
-    if image_index < 0:
-        image_index = len(image_list) - 1
-    if image_index >= len(image_list):
-        image_index = 0
-
-    # Set the image_src and image_alt variables.
-    image_src = image_list[image_index]
-    image_alt = image_src
-
-    # Initialize exif_data with a default value.
-    exif_data = [{
-            'exif_key': "Initialized exif structure",
-            'exif_info': "",
-            }]
-    metadata_found = False
-    try:
-        # Try to get the EXIF data for the current image.
         # Look up the image in a pre-computed dataframe of EXIF data.
-        # Convert the dataframe to a dictionary.
-        exif_data = bulk_exif_data.loc[hashlib.sha256(image_src.encode()).hexdigest()].to_dict()
-        metadata_found = True
+        try:
+            exif_data = bulk_exif_data.loc[hash_value].to_dict()
+        except KeyError:
+            exif_data = None
 
-    except KeyError as e:
-        # If the image is not found in the EXIF data, log a warning message.
+        # Only the metadata row of the current image is looked at, the tag and category
+        # vocabularies are maintained by the edit routes.
         try:
-            bulk_exif_data.loc[hashlib.sha256(image_src.encode()).hexdigest()] = read_exif_data(image_src).loc['exifdataindex']
-            exif_data = bulk_exif_data.loc[hashlib.sha256(image_src.encode()).hexdigest()].to_dict()
-            metadata_found = True
+            metadata = imgview_data.loc[hash_value].to_dict()
+        except KeyError:
+            metadata = None
+
+    exif_row = None
+    if exif_data is None:
+        # If the image is not found in the EXIF data, read it from the file
+        try:
+            exif_row = pd.DataFrame.from_records([read_exif_data(image_src)], index=pd.Index([hash_value], name="sha256"))
+            gallery_exif.apply_column_types(exif_row)
+            exif_data = exif_row.iloc[0].to_dict()
         except KeyError as e:
             logger.error(e)
-            logger.warning(e)
             logger.warning(image_src)
-            logger.warning(bulk_exif_data.index)
-            exif_data =  {
-            'Positive prompt': 'No data found',
-            'Negative prompt': 'No data found',
-            'Steps': 'No data found', 
-            'Sampler': 'No data found', 
-            'CFG scale': 'No data found', 
-            'Seed': 'No data found', 
-            'Size': 'No data found', 
-            'Model hash': 'No data found', 
-            'Model': 'No data found', 
-            'Eta': 'No data found',
-            'Hashes': 'No data found',
-            'Postprocessing': 'No data found',
-            'Extras': 'No data found'}
-            metadata_found = False
-    
+            exif_data = {}
+    # Missing fields are not shown
+    exif_data = {key: value for key, value in exif_data.items() if not pd.isna(value)}
+
     # Log the exif_data and image_src values.
     logger.debug("exif_data: %s" % exif_data)
     logger.debug("image_viewer: %s " % image_src)
-    if metadata_found:
-        logger.debug(f"metadata: {imgview_data.loc[hashlib.sha256(image_src.encode()).hexdigest()]}")
-    
-    global filtered_images
-    metadata_for_filtered_images = {}
-
-    for image_path in filtered_images:
-        hash_value = hashlib.sha256(image_path.encode()).hexdigest()
-        try:
-            metadata_for_filtered_images[hash_value] = imgview_data.loc[hash_value].to_dict()
-        except KeyError:
-            metadata_for_filtered_images[hash_value] = {
-                'Favorites': False,
-                'Rating': 0,
-                'Tags': [],
-                'Categorization': [],
-                'Reviewed': False,
-                'Todelete': False,
-                'Path': image_src
-            }
-            if args.aesthetic:
-                metadata_for_filtered_images[hash_value]['Aesthetic_score'] = aesthetic_engine.score(image_path)
-            imgview_data.loc[hash_value] = metadata_for_filtered_images[hash_value]
-
-    logger.debug(metadata_for_filtered_images)
 
-    hash_value = hashlib.sha256(image_src.encode()).hexdigest()
-    metadata = metadata_for_filtered_images.get(hash_value)
-    if metadata is None:
+    new_row = metadata is None
+    if new_row:
         metadata = {
             'Favorites': False,
             'Rating': 0,
@@ -734,25 +1542,14 @@ def image_viewer():
             'Path': image_src
         }
         if args.aesthetic:
-            metadata['Aesthetic_score'] = aesthetic_engine.score(image_src)
-        imgview_data.loc[hash_value] = metadata
-        metadata_for_filtered_images[hash_value] = metadata
-    else:
+            # Scored by the background task, the page shows the score as pending until then
+            metadata['Aesthetic_score'] = None
+    if exif_row is not None or not metadata['Reviewed']:
+        record_view(folder, hash_value, metadata, exif_row)
+    if not new_row:
         metadata['Reviewed'] = True
-        imgview_data.loc[hash_value, 'Reviewed'] = True
 
     logger.debug(metadata)
-    logger.debug(metadata_for_filtered_images)
-
-    tags = set()
-    categories = set()
-
-    for meta in metadata_for_filtered_images.values():
-        tags.update(meta['Tags'])
-        categories.update(meta['Categorization'])
-
-    tags = list(tags)
-    categories = list(categories)
 
     # Render the image_template.html template with the appropriate variables.
     return render_template("image_template.html",
@@ -762,19 +1559,51 @@ def image_viewer():
                            image_index=image_index,
                            exif_list=exif_data,
                            metadata = metadata,
-                           maxindex=len(image_list),
-                           all_meta_tags=tags,
-                           all_meta_categories=categories)
+                           maxindex=maxindex)
+
+def record_view(folder, hash_value, metadata, exif_row):
+    """Mark an image as reviewed, adding its metadata row and EXIF row if it has none yet.
+
+    Args:
+        folder (Path): The image folder the image was looked up in. Nothing is written if
+            another folder was opened in the meantime.
+        hash_value (str): The sha256 key of the image path.
+        metadata (dict): The metadata of the image, used as its row if it has none.
+        exif_row (pandas.DataFrame): The EXIF row read from the image file, or None.
+    """
+    global bulk_exif_data
+    with library_lock.write():
+        if image_folder != folder:
+            return
+        if exif_row is not None and hash_value not in bulk_exif_data.index:
+            metadata_store.save_exif(exif_row)
+            if len(bulk_exif_data.columns) > 0:
+                # Before the EXIF data has been read, the background task picks it up from the store
+                bulk_exif_data = gallery_exif.concat_frames(bulk_exif_data, exif_row)
+                filter_engine.set_exif(exif_row)
+        if hash_value not in imgview_data.index:
+            if args.aesthetic:
+                queue_scoring()
+            imgview_data.loc[hash_value] = metadata
+            record_edit(hash_value, **metadata)
+            filter_engine.set(hash_value, **metadata)
+        elif not imgview_data.at[hash_value, 'Reviewed']:
+            imgview_data.loc[hash_value, 'Reviewed'] = True
+            record_edit(hash_value, Reviewed=True)
+            filter_engine.set(hash_value, Reviewed=True)
 
 def get_random_image():
     """
     Return a random image from the image directory.
 
     Returns:
-        A string representing the file name of a random image from the image directory.
+        A string representing the file name of a random image from the image directory,
+        None when there is none, as while the image folder is being loaded.
     """
     images = get_image_names_in_image_dir()
     logger.debug(images)
+    if not images:
+        return None
     image = random.sample(images, 1)[0]
     logging.debug(image)
     return image
@@ -788,113 +1617,193 @@ def set_theme_cookie():
     logger.debug(response)
     return response
 
+def edit_payload():
+    """Get the JSON object sent with an edit, or None if the request body is not one."""
+    data = request.get_json(silent=True)
+    return data if isinstance(data, dict) else None
+
+def metadata_key(image_name):
+    """Get the sha256 key of the image an edit is for.
+
+    Args:
+        image_name (str): The image path sent with the edit.
+
+    Returns:
+        str: The sha256 key, or None if the image has no metadata row.
+    """
+    if not isinstance(image_name, str):
+        return None
+    sha256 = image_sha256(image_name)
+    return sha256 if sha256 in imgview_data.index else None
+
+def edit_values(value):
+    """Get the tags or categories sent with an edit as a list.
+
+    Args:
+        value: A value or a list of values.
+
+    Returns:
+        list: The values, or None unless they are all non-empty strings.
+    """
+    values = value if isinstance(value, list) else [value]
+    if not values or not all(isinstance(v, str) and v for v in values):
+        return None
+    return values
+
 # Define a route to handle the toggle request
 @app.route("/toggle", methods=["PUT"])
+@writes_library
 def toggle():
-    data = request.json
+    data = edit_payload()
+    if data is None:
+        return bad_request_error("The edit is not a JSON object")
     image_name = data.get("image_name")
+    sha256 = metadata_key(image_name)
     logger.debug("Toggling favorite")
     logger.debug(image_name)
-    # Find the row that matches the image name
-    row = imgview_data.loc[hashlib.sha256(image_name.encode()).hexdigest()]
     # If no row is found, return an error message
-    if row.empty:
-        return bad_request_error("No image named {image_name} found")
+    if sha256 is None:
+        return bad_request_error(f"No image named {image_name} found")
+    # Find the row that matches the image name
+    row = imgview_data.loc[sha256]
     logger.debug(row)
     # Otherwise, get the current favorite value and flip it
     current_favorite = row["Favorites"]
     new_favorite = not current_favorite
     # Update the dataframe with the new value
-    imgview_data.loc[hashlib.sha256(image_name.encode()).hexdigest(), "Favorites"] = new_favorite
+    imgview_data.loc[sha256, "Favorites"] = new_favorite
+    record_edit(sha256, Favorites=new_favorite)
+    filter_engine.set(sha256, Favorites=new_favorite)
     # Return a success message with the new value
     return jsonify(new_favorite)
 
 @app.route("/set-rating", methods=["PUT"])
+@writes_library
 def set_rating():
-    data = request.json
-    rating = data.get("rating")
+    data = edit_payload()
+    if data is None:
+        return bad_request_error("The edit is not a JSON object")
+    try:
+        rating = int(data.get("rating"))
+    except (TypeError, ValueError):
+        return bad_request_error(f"Invalid rating {data.get('rating')!r}")
+    if not 0 <= rating <= 5:
+        return bad_request_error(f"Rating {rating} is not between 0 and 5")
     image_name = data.get("image_name")
+    sha256 = metadata_key(image_name)
+    if sha256 is None:
+        return bad_request_error(f"No image named {image_name} found")
     logger.debug(rating)
-    imgview_data.loc[hashlib.sha256(image_name.encode()).hexdigest(), "Rating"] = rating
-    logger.debug(imgview_data.loc[hashlib.sha256(image_name.encode()).hexdigest(), "Rating"])
+    imgview_data.loc[sha256, "Rating"] = rating
+    record_edit(sha256, Rating=rating)
+    filter_engine.set(sha256, Rating=rating)
+    logger.debug(imgview_data.loc[sha256, "Rating"])
     # Return a success message with the new tags
     return jsonify(rating=rating)
 
 @app.route("/add-tags", methods=["PUT"])
+@writes_library
 def add_tags():
-    data = request.json
+    data = edit_payload()
+    if data is None:
+        return bad_request_error("The edit is not a JSON object")
     tags = data.get("tags")
     logger.debug(tags)
     image_name = data.get("image_name")
-    row = imgview_data.loc[hashlib.sha256(image_name.encode()).hexdigest()]
+    sha256 = metadata_key(image_name)
     # If no row is found, return an error message
-    if row.empty:
+    if sha256 is None:
         return bad_request_error(f"No image named {image_name} found")
+    incoming_tags = edit_values(tags)
+    if incoming_tags is None:
+        return bad_request_error(f"Invalid tags {tags!r}")
+    row = imgview_data.loc[sha256]
     logger.debug(row)
     logger.debug(row.dtypes)
     # Otherwise, get the current tags list and append the new tags
     current_tags_list = row["Tags"]
     logger.debug(current_tags_list)
-    incoming_tags = tags
-    if not isinstance(incoming_tags, list):
-        incoming_tags = [incoming_tags]
     logger.debug(imgview_data.dtypes)
     # Check the type of the column
-    logger.debug(type(imgview_data.loc[hashlib.sha256(image_name.encode()).hexdigest(), "Tags"]))
-    imgview_data.loc[hashlib.sha256(image_name.encode()).hexdigest(), "Tags"].extend(incoming_tags)
+    logger.debug(type(imgview_data.loc[sha256, "Tags"]))
+    imgview_data.loc[sha256, "Tags"].extend(incoming_tags)
+    tag_vocabulary.add_many(incoming_tags)
+    record_edit(sha256, Tags=imgview_data.loc[sha256, "Tags"])
+    filter_engine.set(sha256, Tags=imgview_data.loc[sha256, "Tags"])
     # Return a success message with the new tags
-    return jsonify(tags=imgview_data.loc[hashlib.sha256(image_name.encode()).hexdigest(), "Tags"])
+    return jsonify(tags=imgview_data.loc[sha256, "Tags"])
 
 @app.route("/remove-tags", methods=["PUT"])
+@writes_library
 def remove_tags():
-    data = request.json
+    data = edit_payload()
+    if data is None:
+        return bad_request_error("The edit is not a JSON object")
     image_name = data.get("image_name")
+    sha256 = metadata_key(image_name)
     logger.debug("removing tags")
     tag_to_remove = data.get("tag")
     logger.debug(tag_to_remove)
-    row = imgview_data.loc[hashlib.sha256(image_name.encode()).hexdigest()]
     # If no row is found, return an error message
-    if row.empty:
+    if sha256 is None:
         return bad_request_error(f"No image named {image_name} found")
-    logger.debug(row)
+    if tag_to_remove not in imgview_data.loc[sha256, "Tags"]:
+        return bad_request_error(f"{image_name} has no tag {tag_to_remove!r}")
     logger.debug(type(tag_to_remove))
-    imgview_data.loc[hashlib.sha256(image_name.encode()).hexdigest(), "Tags"].remove(tag_to_remove)
+    imgview_data.loc[sha256, "Tags"].remove(tag_to_remove)
+    tag_vocabulary.remove(tag_to_remove)
+    record_edit(sha256, Tags=imgview_data.loc[sha256, "Tags"])
+    filter_engine.set(sha256, Tags=imgview_data.loc[sha256, "Tags"])
     # Return a success message with the updated tags
-    return jsonify(tags=imgview_data.loc[hashlib.sha256(image_name.encode()).hexdigest(), "Tags"])
+    return jsonify(tags=imgview_data.loc[sha256, "Tags"])
 
 @app.route("/assign-category", methods=["PUT"])
+@writes_library
 def assign_category():
-    data = request.json
+    data = edit_payload()
+    if data is None:
+        return bad_request_error("The edit is not a JSON object")
     image_name = data.get("image_name")
+    sha256 = metadata_key(image_name)
     category = data.get("categories")
     logger.debug(category)
-    row = imgview_data.loc[hashlib.sha256(image_name.encode()).hexdigest()]
     # If no row is found, return an error message
-    if row.empty:
+    if sha256 is None:
         return bad_request_error(f"No image named {image_name} found")
-    incomming_category = category
-    if not isinstance(incomming_category, list):
-        incomming_category = [incomming_category]
+    incomming_category = edit_values(category)
+    if incomming_category is None:
+        return bad_request_error(f"Invalid categories {category!r}")
     # Update the dataframe with the new value
-    imgview_data.loc[hashlib.sha256(image_name.encode()).hexdigest(), "Categorization"].extend(incomming_category)
-    logger.debug(imgview_data.loc[hashlib.sha256(image_name.encode()).hexdigest(), "Categorization"])
+    imgview_data.loc[sha256, "Categorization"].extend(incomming_category)
+    category_vocabulary.add_many(incomming_category)
+    record_edit(sha256, Categorization=imgview_data.loc[sha256, "Categorization"])
+    filter_engine.set(sha256, Categorization=imgview_data.loc[sha256, "Categorization"])
+    logger.debug(imgview_data.loc[sha256, "Categorization"])
     # Return a success message with the new value
-    return jsonify(category=imgview_data.loc[hashlib.sha256(image_name.encode()).hexdigest(), "Categorization"])
+    return jsonify(category=imgview_data.loc[sha256, "Categorization"])
 
 @app.route("/remove-category", methods=["PUT"])
+@writes_library
 def remove_categories():
-    data = request.json
+    data = edit_payload()
+    if data is None:
+        return bad_request_error("The edit is not a JSON object")
     image_name = data.get("image_name")
+    sha256 = metadata_key(image_name)
     logger.debug("removing tags")
     category_to_remove = data.get("category")
     logger.debug(category_to_remove)
-    row = imgview_data.loc[hashlib.sha256(image_name.encode()).hexdigest()]
     # If no row is found, return an error message
-    if row.empty:
+    if sha256 is None:
         return bad_request_error(f"No image named {image_name} found")
-    imgview_data.loc[hashlib.sha256(image_name.encode()).hexdigest(), "Categorization"].remove(category_to_remove)
+    if category_to_remove not in imgview_data.loc[sha256, "Categorization"]:
+        return bad_request_error(f"{image_name} has no category {category_to_remove!r}")
+    imgview_data.loc[sha256, "Categorization"].remove(category_to_remove)
+    category_vocabulary.remove(category_to_remove)
+    record_edit(sha256, Categorization=imgview_data.loc[sha256, "Categorization"])
+    filter_engine.set(sha256, Categorization=imgview_data.loc[sha256, "Categorization"])
     # Return a success message with the updated tags
-    return jsonify(tags=imgview_data.loc[hashlib.sha256(image_name.encode()).hexdigest(), "Categorization"])
+    return jsonify(tags=imgview_data.loc[sha256, "Categorization"])
 
 def get_selected_image_by_index(image_id):
     """
@@ -916,9 +1825,12 @@ def get_selected_image_by_index(image_id):
     return images[int(image_id)]
 
 @app.route('/get-metadata')
+@reads_library
 def get_metadata():
     image_name = request.args.get("image_name")
-    metadata_dict = imgview_data.loc[hashlib.sha256(image_name.encode()).hexdigest()].to_dict()
+    if image_sha256(image_name) not in imgview_data.index:
+        return jsonify("No metadata for this image yet"), 404
+    metadata_dict = imgview_data.loc[image_sha256(image_name)].to_dict()
     tags_str = str(metadata_dict['Tags'])
     metadata_dict['Tags'] = tags_str
     category_str = str(metadata_dict['Categorization'])
@@ -927,7 +1839,98 @@ def get_metadata():
     # Convert the metadata dictionary to a JSON object and return it
     return json.dumps(metadata_dict)
 
+@app.route('/autocomplete')
+@reads_library
+def autocomplete():
+    """Complete a prefix against the tags or categories in use.
+
+    A prefix starting with "+" or "-", as used to require or exclude a value in the
+    filter, is completed without it and the values are returned with it.
+
+    Args:
+        field (str): Either "tags" or "categories".
+        prefix (str): The prefix to complete. An empty prefix lists the first values.
+        limit (int): The maximum number of values to return.
+        counts (bool): Return [value, number of images] pairs instead of values.
+
+    Returns:
+        Response: Flask JSON response containing the matching values.
+    """
+    field = request.args.get("field", "tags")
+    prefix = request.args.get("prefix", "")
+    limit = request.args.get("limit", 20, type=int)
+    with_counts = request.args.get("counts", "false").lower() in ("1", "true")
+    vocabularies = {"tags": (tag_vocabulary, "Tags"), "categories": (category_vocabulary, "Categorization")}
+    if field not in vocabularies:
+        return bad_request_error(f"Unknown autocomplete field {field}")
+    vocabulary, column = vocabularies[field]
+    operator = prefix[:1] if prefix[:1] in ("+", "-") else ""
+    values = vocabulary.complete(prefix[len(operator):], limit)
+    if with_counts:
+        bitmaps = filter_engine.bitmaps[column]
+        return jsonify([[operator + value, bitmaps.count(value)] for value in values])
+    return jsonify([operator + value for value in values])
+
+@app.route('/facets')
+@reads_library
+def facets():
+    """Count the images per Model, Sampler, Steps, CFG scale, rating and favorite.
+
+    The counts over the folder are kept up to date by the filter engine as images are
+    indexed and edited. The counts among the images being viewed, i.e. the result of
+    the current filter, are counted from their positions in the filter engine.
+
+    Args:
+        limit (int): The maximum number of values per field, most used first.
+
+    Returns:
+        Response: Flask JSON response with per field the values, their number of images
+            in the folder ("count") and among the images being viewed ("filtered").
+    """
+    limit = request.args.get("limit", 20, type=int)
+    positions = listing_positions()
+    counts = filter_engine.facet_counts(positions, limit=limit)
+    return jsonify(images=len(filter_engine),
+                   filtered=len(positions),
+                   facets={field: [{"value": value, "count": count, "filtered": filtered} for value, count, filtered in values]
+                           for field, values in counts.items()})
+
+@app.route('/similar')
+def similar():
+    """Rank the images of the folder by the similarity of their CLIP embedding to an image.
+
+    Args:
+        image_name (str): Path of the image to find similar images for.
+        k (int): The maximum number of images to return.
+
+    Returns:
+        Response: Flask JSON response with the most similar images first, each with its
+        cosine similarity and the URLs of the image and its thumbnail.
+    """
+    image_name = request.args.get("image_name")
+    k = request.args.get("k", 20, type=int)
+    if not image_name:
+        return bad_request_error("image_name is missing")
+    if get_clip_engine() is None:
+        return jsonify(error="Similarity search needs torch and clip to be installed"), 503
+    index = get_similarity_index()
+    if index is None:
+        return similarity_index_pending()
+    if image_name in index:
+        query = index.vector(image_name)
+    else:
+        query = next(get_clip_engine().embed_many([image_name], num_workers=0))[1]
+        if query is None:
+            return bad_request_error(f"Could not read {image_name}")
+    results = [{"image_name": image,
+                "similarity": round(similarity, 4),
+                "image_src": url_for('image_viewer', image_name=image),
+                "thumb_src": url_for('thumbnail', sha256=image_sha256(image), v=thumbnail_version(image))}
+               for image, similarity in index.search(query, k, exclude=image_name)]
+    return jsonify(image_name=image_name, results=results)
+
 @app.route("/get_image_by_name")
+@reads_library
 def get_selected_image_index_by_name():
     """
     Return the index of the image with the given name.
@@ -940,16 +1943,10 @@ def get_selected_image_index_by_name():
     """
     image_name = request.args.get("image_name")
     logging.debug("Getting the index of image: %s" % image_name)
-    images = get_image_names_in_image_dir()
-    logging.debug("------------")
-    logging.debug(image_name)
-    #logging.debug(images)
-    logging.debug("------------")
-    try:
-        return int(images.index(image_name))
-    except ValueError as e:
-        logger.error(e)
-        return None
+    image_index = navigation.position(image_name)
+    if image_index is None:
+        logger.error(f"{image_name} is not in list")
+    return image_index
     
 def get_image_index_by_name(image_name):
     logger.debug(image_name)
@@ -961,12 +1958,10 @@ def get_image_index_by_name(image_name):
         else:
             image_name = "/" + image_name
     logging.debug("Getting the index of image: %s" % image_name)
-    logging.debug(images)
-    try:
-        return int(images.index(image_name))
-    except ValueError as e:
-        logger.error(e)
-        return None
+    image_index = navigation.position(image_name)
+    if image_index is None:
+        logger.error(f"{image_name} is not in list")
+    return image_index
 
 def is_valid_image_extension(filename):
     """
@@ -997,23 +1992,26 @@ def get_image_names_in_image_dir():
     logger.debug(len(filtered_images))
     return filtered_images
 
-def metadata_initialization():
+def metadata_initialization(images):
     """
-    Initializes metadata for all images in the image directory and saves it to a CSV file.
+    Initializes metadata for all images in the image directory and saves it to the metadata store.
 
     For each image in the image directory, the SHA256 hash of its path is computed as the key for its metadata in
     a dictionary. The metadata is initialized with default values for 'Favorites', 'Rating', 'Tags', and 'Categorization'.
 
     Debug messages are logged to show the metadata dataframe and its SHA256 index name.
 
+    Args:
+    images (list): Paths of all images in the image directory, not only the ones being viewed.
+
     Returns:
-    A Pandas DataFrame object containing the metadata for all images, saved to a CSV file.
+    A Pandas DataFrame object containing the metadata for all images, saved to the metadata store.
     """
     # create an empty dictionary to store the metadata for each image
     metadata = {}
-    for image in get_image_names_in_image_dir():
+    for image in images:
          # compute the SHA256 hash of the image path
-        key = hashlib.sha256(image.encode()).hexdigest()
+        key = image_sha256(image)
         
         # initialize the metadata for the image
         metadata[key] = {'Favorites': False,
@@ -1024,30 +2022,30 @@ def metadata_initialization():
                                             'Todelete': False,
                                             'Path': image}
 
-        if args.aesthetic:
-            metadata[key]['Aesthetic_score'] = aesthetic_engine.score(image)
-    
     # create the dataframe from the metadata dictionary
     df = pd.DataFrame.from_dict(metadata, orient='index')
     logger.debug(df)
     df.index.name = "sha256"
-    df.to_csv(metadata_subdir.joinpath("imgview_metadata.csv"), index=True, header=True)
+    metadata_store.save_metadata(df)
     return df
 
-def update_metadata():
+def update_metadata(images):
     """
     Updates the existing metadata with initialized metadata for images not already in the dataframe.
 
-    Reads in the metadata CSV file, creating a dataframe from it. Then, computes the set of SHA256 hashes for all images
-    already in the dataframe, and loops through all images in the image directory. For each image, if its SHA256 hash is not
-    already in the set of existing hashes, then its metadata is initialized and added to the metadata dictionary.
-    Finally, a dataframe is created from the updated metadata dictionary and saved to the CSV file.
+    Reads in the metadata from the metadata store, creating a dataframe from it. Then, computes the set of SHA256 hashes
+    for all images already in the dataframe, and loops through all images in the image directory. For each image, if its
+    SHA256 hash is not already in the set of existing hashes, then its metadata is initialized and added to the metadata
+    dictionary. Only the new rows are written to the metadata store.
+
+    Args:
+    images (list): Paths of all images in the image directory, not only the ones being viewed.
 
     Returns:
-    A Pandas DataFrame object containing the updated metadata for all images, saved to a CSV file.
+    A Pandas DataFrame object containing the updated metadata for all images.
     """
-    # read in the existing metadata CSV file
-    metadata_df = pd.read_csv(metadata_subdir.joinpath("imgview_metadata.csv"), index_col='sha256', converters={'Tags': convert_string_to_list, 'Categorization': convert_string_to_list}, dtype=dtypes)
+    # read in the existing metadata
+    metadata_df = metadata_store.load_metadata()
 
     # create a set of SHA256 hashes for all images already in the dataframe
     existing_hashes = set(metadata_df.index)
@@ -1055,9 +2053,9 @@ def update_metadata():
     # create an empty dictionary to store the updated metadata for all images
     updated_metadata = {}
 
-    for image in get_image_names_in_image_dir():
+    for image in images:
         # compute the SHA256 hash of the image path
-        key = hashlib.sha256(image.encode()).hexdigest()
+        key = image_sha256(image)
 
         # if the SHA256 hash is not already in the set of existing hashes, initialize the metadata for the image
         if key not in existing_hashes:
@@ -1068,8 +2066,10 @@ def update_metadata():
                                      'Reviewed': False,
                                      'Todelete': False,
                                      'Path': image}
-            if args.aesthetic:
-                updated_metadata[key]['Aesthetic_score'] = aesthetic_engine.score(image)
+    # write only the initialized metadata for new images to the store
+    new_df = pd.DataFrame.from_dict(updated_metadata, orient='index')
+    new_df.index.name = "sha256"
+    metadata_store.save_metadata(new_df)
 
     # update the existing metadata dictionary with the initialized metadata for new images
     updated_metadata.update(metadata_df.to_dict('index'))
@@ -1077,7 +2077,6 @@ def update_metadata():
     # create the dataframe from the updated metadata dictionary
     updated_df = pd.DataFrame.from_dict(updated_metadata, orient='index')
     updated_df.index.name = "sha256"
-    updated_df.to_csv(metadata_subdir.joinpath("imgview_metadata.csv"), index=True, header=True)
 
     return updated_df
 
@@ -1089,127 +2088,77 @@ def read_exif_data(image):
         image (str): Name of the image file.
 
     Returns:
-        pandas.DataFrame: A DataFrame row containing the extracted EXIF data.
+        dict: The generation parameters of the image as parsed by
+        gallery_exif.parse_parameters, empty if it has none.
     """
     logger.debug(image)
-    #image = os.path.join(image_folder, image)
-    img = Image.open(image)
-    parsed_data = {
-        'Positive prompt': 'No data found',
-        'Negative prompt': 'No data found',
-        'Steps': 'No data found', 
-        'Sampler': 'No data found', 
-        'CFG scale': 'No data found', 
-        'Seed': 'No data found', 
-        'Size': 'No data found', 
-        'Model hash': 'No data found', 
-        'Model': 'No data found', 
-        'Eta': 'No data found',
-        'Hashes': 'No data found',
-        'Postprocessing': 'No data found',
-        'Extras': 'No data found'
-    }
+    # Read the texts from the file header, without decoding the image
+    parsed_data = gallery_exif.read_parameters(image)
+    if parsed_data is not None:
+        logger.debug(parsed_data)
+        return parsed_data
+
     try:
+        img = Image.open(image)
         exif_data = img.info
         parameters = None
         if 'parameters' in exif_data:
             parameters = exif_data.get('parameters', '')
         elif 'exif' in exif_data:
-            try:
-                exif_info = piexif.load(exif_data['exif'])
-                user_comment_info = exif_info.get('Exif', {}).get(piexif.ExifIFD.UserComment, b'')
-                parameters = piexif.helper.UserComment.load(user_comment_info)
-            except FileNotFoundError as e:
-                logger.error(e)
-                return pd.DataFrame(parsed_data, index=["exifdataindex"])
+            exif_info = piexif.load(exif_data['exif'])
+            user_comment_info = exif_info.get('Exif', {}).get(piexif.ExifIFD.UserComment, b'')
+            parameters = piexif.helper.UserComment.load(user_comment_info)
         logger.debug(f"-------\nexif_data:{exif_data}\nexif_data_type:{type(exif_data)}----------\n")
-    except AttributeError as e:
-        logger.warning(f"{img}\n{e}")
-        return pd.DataFrame(parsed_data, index=["exifdataindex"])
+    except (OSError, AttributeError, ValueError) as e:
+        logger.warning(f"{image}\n{e}")
+        return {}
 
-    logger.debug(parameters)
-    logger.debug(type(parameters))
     if not parameters:
         logger.warning("No exif parameters found")
-        return pd.DataFrame(parsed_data, index=["exifdataindex"])
-    try:
-        regex = r'(\w+(?:\s+\w+)*)\s*:\s*([\w.+@-]+(?:\s+[\w.+@-]+)*(?:\s*\([\w\s.+@-]*\))?)'
-        param_lines = parameters.splitlines()
-        first_line = None
-        logger.debug(f"Length of  param_lines: {len(param_lines)}")
-        if len(param_lines) > 2 and any("Negative prompt:" in s for s in param_lines):
-            first_line = param_lines.pop(0)
-        elif len(param_lines) == 2 and not any("Negative prompt:" in s for s in param_lines):
-            first_line = param_lines.pop(0)
-        if first_line:
-            parsed_data['Positive prompt'] = first_line
-        for key_value in param_lines:
-            logger.debug(f"key_value:{key_value}")
-            if 'Negative prompt:' in key_value:
-                negative_prompt_values = key_value.split('Negative prompt: ')[1:]
-                negative_prompt_value = negative_prompt_values[-1]
-                parsed_data['Negative prompt'] = negative_prompt_value.strip()
-            elif all(x in key_value for x in ['Steps:', 'Sampler:', 'CFG scale:', 'Seed:', 'Size:', 'Model:']):
-                logger.debug(f"diff prompt: {key_value}")
-                matches = re.findall(regex, key_value)
-                for match in matches:
-                    parsed_data[match[0]] = match[1]
-
-        # Parse the "postprocessing" key
-        postprocessing = exif_data.get('postprocessing', '')
-        if postprocessing:
-            parsed_data['Postprocessing'] = postprocessing
-
-        # Parse the "extras" key
-        extras = exif_data.get('extras', '')
-        if extras:
-            parsed_data['Extras'] = extras
-    except KeyError as e:
-        logger.warning(e)
-        logger.debug(parsed_data)
-        return pd.DataFrame(parsed_data, index=["exifdataindex"])
-
+    parsed_data = gallery_exif.parse_parameters(parameters)
+    for key in ('postprocessing', 'extras'):
+        if exif_data.get(key):
+            parsed_data[key.capitalize()] = exif_data[key]
     logger.debug(parsed_data)
-    return pd.DataFrame(parsed_data, index=["exifdataindex"]) 
-    
-def mp_bulk_exif_read(filtered_images):
+    return parsed_data
+
+def read_exif_row(image):
+    """Reads the EXIF data of an image as a (sha256, fields) row, to be sent back from a worker process."""
+    return image_sha256(image), read_exif_data(image)
+
+def mp_bulk_exif_read(filtered_images, progress=None):
     """
     Reads the EXIF data from all image files in parallel using multiprocessing.
 
-    Returns:
-        bulk_exif_data (dict): A dictionary containing the EXIF data for all image files.
-    """
-    pool = multiprocessing.Pool(multiprocessing.cpu_count())
-    results = []
-    for image in filtered_images:
-        logger.debug(image)
-        result = pool.apply_async(read_exif_data, args=(image,))
-        results.append(result)
+    The worker processes stream (sha256, fields) rows back in chunks with imap_unordered,
+    and the DataFrame is built from them in one go by gallery_exif.exif_frame.
 
-    pool.close()
-    pool.join()
+    Args:
+        filtered_images (list): Paths of the images to read.
+        progress (callable, optional): Called as progress(done, total) while the results come in.
 
-    logger.debug("pool joined")
+    Returns:
+        pandas.DataFrame: The EXIF data of the images indexed by sha256.
+    """
+    total = len(filtered_images)
 
-    df = pd.DataFrame(columns=['Positive prompt', 'Negative prompt', 'Sampler settings',
-                               'Steps', 'Sampler', 'CFG scale', 'Seed', 'Size', 'Model hash',
-                               'Model', 'Eta', 'Hashes', 'Postprocessing', 'Extras',  'Denoising strength', 'ENSD', '0 Enabled',
-                                '0 Module', '0 Model', '0 Weight', '0 Guidance Start', '0 Guidance End',
-                                'Hires upscale', 'Hires steps', 'Hires upscaler'])
-    df.index.name = "sha256"
+    def report(rows):
+        for done, row in enumerate(rows, 1):
+            yield row
+            if progress is not None and (done % 100 == 0 or done == total):
+                progress(done, total)
 
-    for result, image in zip(results, filtered_images):
-        logger.debug(f"result: {result}, image: {image}")
-        row = result.get()
-        logger.debug(row.to_string())
-        df.loc[hashlib.sha256(image.encode()).hexdigest()] = row.loc['exifdataindex']
+    if total < MIN_POOL_EXIF_READ:
+        df = gallery_exif.exif_frame(report(map(read_exif_row, filtered_images)))
+    else:
+        processes = multiprocessing.cpu_count()
+        chunksize = max(1, min(EXIF_CHUNK_SIZE, total // (4 * processes)))
+        # Leaving the block terminates the workers, also when the progress callback raises
+        with multiprocessing.Pool(processes) as pool:
+            df = gallery_exif.exif_frame(report(pool.imap_unordered(read_exif_row, filtered_images, chunksize)))
 
-    # create the output dataframe from the list of dictionaries
-    #output_df = pd.DataFrame(dict_to_rows(bulk_exif_data), columns=['sha256', 'Positive prompt', 'Negative prompt', 'Sampler settings']).to_csv(metadata_subdir.joinpath("exif_df.csv"), index=False, header=True)
-    df.to_csv(metadata_subdir.joinpath("exif_df.csv"), index=True, header=True)
+    metadata_store.save_exif(df)
     logger.debug(df)
-    #bulk_exif_data = df.to_dict(orient='index')
-    # convert the output dictionary to a pandas DataFrame
     return df
 
 def dict_to_rows(inputdict):
@@ -1250,9 +2199,15 @@ if __name__ == '__main__':
         multiprocessing.freeze_support()
     start_time = time.time()
     logger.debug(args)
-    if args.aesthetic:
-        import gallery_engine as ge
-        aesthetic_engine = ge.aesthetic_engine()
+
+    if args.command == "index":
+        sys.exit(run_index())
+
+    if args.serve == "debug" and os.environ.get("WERKZEUG_RUN_MAIN") != "true":
+        # This is the reloader process of the debug server. It only restarts the server
+        # process on code changes, so there is nothing to load here.
+        app.run(host="0.0.0.0", port=args.port, debug=True)
+        sys.exit(0)
 
     if args.imagedir:
         image_folder = Path(args.imagedir)
@@ -1263,52 +2218,17 @@ if __name__ == '__main__':
     
     metadata_folder = Path("metadata")
     metadata_folder.mkdir(parents=True, exist_ok=True)
-    metadata_subdir = metadata_folder / (image_folder.parent.name + '_' + image_folder.name)
-    metadata_subdir.mkdir(parents=True, exist_ok=True)
-    thumbnail_folder = metadata_subdir / 'thumbnails'
-    thumbnail_folder.mkdir(parents=True, exist_ok=True)
-    #filtered_images = [f.name for f in image_folder.iterdir() if f.is_file() and is_valid_image_extension(f.name)]
-    #filtered_images = filter_images_in_image_folder_path()
-    filtered_images = sorted(filter_images_in_image_folder_path(), key=sort_by_filename_and_parent_folder)
-
-    # Check if EXIF data already exists
-    exif_df_path = metadata_subdir.joinpath("exif_df.csv")
-    if exif_df_path.exists():
-        bulk_exif_data = pd.read_csv(exif_df_path)
-        bulk_exif_data.set_index('sha256', inplace=True)
-        #bulk_exif_data['Sampler settings'] = pd.array(bulk_exif_data['Sampler settings'].tolist())
-        logger.warning(len(bulk_exif_data))
-        if check_images_in_dataframe(filtered_images, bulk_exif_data):
-            pass
-        else:
-            bulk_exif_data = mp_bulk_exif_read(filtered_images)
-    else:
-        logger.debug("Creating bulk exif data")
-        # Read EXIF data for images
-        bulk_exif_data = mp_bulk_exif_read(filtered_images)
-    
-    # Check if metadata already exists
-    metadata_path = metadata_subdir.joinpath("imgview_metadata.csv")
-    if metadata_path.exists():
-        imgview_data = pd.read_csv(metadata_path, converters={'Tags': convert_string_to_list, 'Categorization': convert_string_to_list}, dtype=dtypes)
-        imgview_data.set_index('sha256', inplace=True)
-        logger.warning(len(imgview_data))
-        if check_images_in_dataframe(filtered_images, imgview_data):
-            pass
-        else:
-            imgview_data = update_metadata()
-    else:
-        logger.debug("Initializing imgview data")
-        # Initialize metadata for images
-        imgview_data = metadata_initialization()
-
-    if args.cleanup:
-        imgview_data = remove_missing_sha256(imgview_data, filtered_images)
-        bulk_exif_data = remove_missing_sha256(bulk_exif_data, filtered_images)
+    open_library(image_folder, metadata_folder / (image_folder.parent.name + '_' + image_folder.name))
+    # Compact the edit journals on Ctrl+C and on termination as well
+    atexit.register(close_libraries)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
     end_time = time.time()
     execution_time = end_time - start_time
     print("Preamble time: {:.2f} seconds".format(execution_time))
 
     # Start the application
-    app.run(host="0.0.0.0", port=args.port, debug=True)
\ No newline at end of file
+    if args.serve == "production":
+        serve_production()
+    else:
+        app.run(host="0.0.0.0", port=args.port, debug=True)
\ No newline at end of file
@@ -0,0 +1,196 @@
+"""
+A persistent cache of CLIP image embeddings, keyed by a content hash of the image file.
+
+The embeddings are stored as a float16 matrix in `embeddings.npy`, with the content
+hash of each row in `hashes.npy`. Both files are memory-mapped, so opening
+the cache is cheap and only the rows that are used are read from disk. Rows are only
+appended: the hash of a row is written after its embedding, and the rows in use are
+those before the first empty hash, so an interrupted run loses at most its last batch.
+
+Because the key is the file content, the embeddings survive moving or renaming a folder
+and rebuilding its metadata, and every feature working on embeddings can share them.
+The content hash is the sha256 of the whole file. To keep a large library from being
+read again on every start, the hash of each path is remembered in `digests.json`
+together with the size and mtime of the file, and only computed again when they change.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+
+EMBEDDINGS_NAME = "embeddings.npy"
+HASHES_NAME = "hashes.npy"
+DIGESTS_NAME = "digests.json"
+MIN_CAPACITY = 1024
+HASH_BLOCK_SIZE = 1 << 20
+
+logger = logging.getLogger(__name__)
+
+def content_hash(path):
+    """Compute the sha256 of the content of a file.
+
+    Args:
+        path (str): Path of the file.
+
+    Returns:
+        str: The hex digest.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while block := f.read(HASH_BLOCK_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+class EmbeddingCache():
+    """Embeddings by content hash, persisted as memory-mapped float16 matrices.
+
+    Args:
+        folder (Path): The folder of the cache files, created if needed.
+        dim (int, optional): The size of an embedding. Defaults to 768 (CLIP ViT-L/14).
+    """
+    def __init__(self, folder, dim=768) -> None:
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.dim = dim
+        self.lock = threading.RLock()
+        self.embeddings = None
+        self.hashes = None
+        self.rows = {}
+        self.count = 0
+        self.path_digests = {}
+        self.digests_changed = False
+        self._open()
+        if self.count and not (self.folder / DIGESTS_NAME).exists():
+            # Written by earlier versions, whose key only covered part of each file
+            logger.info(f"The embedding cache in {self.folder} uses an old key, starting a new one")
+            self.count = 0
+            self.rows = {}
+            self._allocate(MIN_CAPACITY)
+        self._load_digests()
+
+    def _open(self):
+        embeddings_path = self.folder / EMBEDDINGS_NAME
+        hashes_path = self.folder / HASHES_NAME
+        if not embeddings_path.exists() or not hashes_path.exists():
+            self._allocate(MIN_CAPACITY)
+            return
+        self.embeddings = np.load(embeddings_path, mmap_mode='r+')
+        self.hashes = np.load(hashes_path, mmap_mode='r+')
+        if self.embeddings.shape[1] != self.dim or len(self.embeddings) != len(self.hashes):
+            logger.warning(f"Embedding cache in {self.folder} does not match, starting a new one")
+            self._allocate(MIN_CAPACITY)
+            return
+        empty = np.flatnonzero(~self.hashes.any(axis=1))
+        self.count = int(empty[0]) if len(empty) else len(self.hashes)
+        self.rows = {digest.tobytes().hex(): row for row, digest in enumerate(self.hashes[:self.count])}
+        logger.debug(f"Loaded {self.count} embeddings from {self.folder}")
+
+    def _load_digests(self):
+        try:
+            with open(self.folder / DIGESTS_NAME, 'r', encoding='utf-8') as f:
+                self.path_digests = {path: ((size, mtime_ns), digest) for path, (size, mtime_ns, digest) in json.load(f).items()}
+        except FileNotFoundError:
+            pass
+        except (ValueError, TypeError) as e:
+            logger.warning(f"Ignoring the damaged {self.folder / DIGESTS_NAME}: {e}")
+
+    def save_digests(self):
+        """Write the content hashes computed since the last save to `digests.json`."""
+        with self.lock:
+            if not self.digests_changed:
+                return
+            entries = {path: [*key, digest] for path, (key, digest) in list(self.path_digests.items())}
+            tmp_path = self.folder / (DIGESTS_NAME + ".tmp")
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.folder / DIGESTS_NAME)
+            self.digests_changed = False
+
+    def _allocate(self, capacity):
+        """Create the cache files with room for capacity rows, keeping the rows in use."""
+        embeddings = np.lib.format.open_memmap(self.folder / (EMBEDDINGS_NAME + ".tmp"), mode='w+', dtype=np.float16, shape=(capacity, self.dim))
+        hashes = np.lib.format.open_memmap(self.folder / (HASHES_NAME + ".tmp"), mode='w+', dtype=np.uint8, shape=(capacity, 32))
+        if self.count:
+            embeddings[:self.count] = self.embeddings[:self.count]
+            hashes[:self.count] = self.hashes[:self.count]
+        embeddings.flush()
+        hashes.flush()
+        # Release the old maps before replacing their files, which Windows requires
+        self.embeddings = self.hashes = None
+        del embeddings, hashes
+        os.replace(self.folder / (EMBEDDINGS_NAME + ".tmp"), self.folder / EMBEDDINGS_NAME)
+        os.replace(self.folder / (HASHES_NAME + ".tmp"), self.folder / HASHES_NAME)
+        self.embeddings = np.load(self.folder / EMBEDDINGS_NAME, mmap_mode='r+')
+        self.hashes = np.load(self.folder / HASHES_NAME, mmap_mode='r+')
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, digest):
+        return digest in self.rows
+
+    def digest(self, path):
+        """Get the content hash of an image, only hashing it again when its size or mtime changed."""
+        st = os.stat(path)
+        key = (st.st_size, st.st_mtime_ns)
+        known = self.path_digests.get(path)
+        if known is not None and known[0] == key:
+            return known[1]
+        digest = content_hash(path)
+        self.path_digests[path] = (key, digest)
+        self.digests_changed = True
+        return digest
+
+    def row(self, digest):
+        """Get the row of an embedding by content hash, or None if it is not cached."""
+        return self.rows.get(digest)
+
+    def get(self, digest):
+        """Get an embedding by content hash as a float32 vector, or None if it is not cached."""
+        # add may be swapping the maps for larger ones
+        with self.lock:
+            row = self.rows.get(digest)
+            if row is None:
+                return None
+            return np.asarray(self.embeddings[row], dtype=np.float32)
+
+    def matrix(self):
+        """Get all cached embeddings as a read-only float16 matrix, one row per embedding."""
+        with self.lock:
+            return self.embeddings[:self.count]
+
+    def add(self, digests, embeddings):
+        """Append embeddings to the cache, skipping the ones that are already cached.
+
+        Args:
+            digests (list): The content hashes of the embeddings.
+            embeddings (numpy.ndarray): The embeddings, one row per content hash.
+        """
+        with self.lock:
+            new = [(digest, i) for i, digest in enumerate(digests) if digest not in self.rows]
+            if not new:
+                return
+            if self.count + len(new) > len(self.hashes):
+                self._allocate(max(2 * len(self.hashes), self.count + len(new)))
+            start = self.count
+            end = start + len(new)
+            self.embeddings[start:end] = np.asarray(embeddings)[[i for _, i in new]]
+            self.embeddings.flush()
+            self.hashes[start:end] = np.frombuffer(b"".join(bytes.fromhex(digest) for digest, _ in new), dtype=np.uint8).reshape(-1, 32)
+            self.hashes.flush()
+            for row, (digest, _) in enumerate(new, start):
+                self.rows[digest] = row
+            self.count = end
+
+    def close(self):
+        self.save_digests()
+        with self.lock:
+            if self.embeddings is not None:
+                self.embeddings.flush()
+                self.hashes.flush()
+            self.embeddings = self.hashes = None
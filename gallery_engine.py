@@ -1,8 +1,16 @@
 import torch
 import clip
+import functools
+import numpy as np
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from PIL import Image
 import atexit
+import gallery_embeddings
 
 # Define a function to deallocate PyTorch memory
 def cleanup():
@@ -13,6 +21,7 @@ atexit.register(cleanup)
 
 STATE_NAME = "static/models/sac+logos+ava1-l14-linearMSE.pth"
 MODEL_DIM = 768
+TEXT_CACHE_SIZE = 256
 
 class AestheticPredictor(torch.nn.Module):
     def __init__(self, input_size):
@@ -54,13 +63,216 @@ def get_score(image, predictor, device, model, preprocess):
     score = predictor(torch.from_numpy(image_features).to(device).float())
     return round(score.item(), 2)
 
+class ImageDataset(torch.utils.data.Dataset):
+    """Decodes and preprocesses images for CLIP, run inside the DataLoader workers.
+
+    Images that cannot be read are returned as a blank tensor with ok set to False, so
+    one broken file does not stop a whole run.
+    """
+    def __init__(self, paths, preprocess) -> None:
+        self.paths = list(paths)
+        self.preprocess = preprocess
+        self.blank = None
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        try:
+            with Image.open(self.paths[index]) as img:
+                return self.preprocess(img.convert("RGB")), True
+        except Exception:
+            if self.blank is None:
+                self.blank = torch.zeros_like(self.preprocess(Image.new("RGB", (224, 224))))
+            return self.blank, False
+
 class aesthetic_engine():
-    def __init__(self) -> None:
+    """CLIP ViT-L/14 embeddings and the aesthetic predictor on top of them.
+
+    Args:
+        embedding_cache (gallery_embeddings.EmbeddingCache, optional): Where image embeddings
+            are looked up before running CLIP, and stored after. Without it every image is
+            embedded again each time it is scored.
+    """
+    def __init__(self, embedding_cache=None) -> None:
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         print(f"Device detected in aesthetic engine: {self.device}")
         self.predictor = load_predictor(STATE_NAME, self.device)
         self.clip_model, self.clip_preprocess = clip.load("ViT-L/14", device=self.device)
+        self.embedding_cache = embedding_cache
+        # Repeated and refined searches reuse the vectors of recent queries
+        self.embed_text = functools.lru_cache(maxsize=TEXT_CACHE_SIZE)(self._embed_text)
 
     def score(self, image_path):
-        img = Image.open(image_path)
-        return get_score(img, self.predictor, self.device, self.clip_model, self.clip_preprocess)
\ No newline at end of file
+        return next(self.score_many([image_path], num_workers=0))[1]
+
+    def embed_batch(self, images):
+        """Embed a batch of preprocessed images.
+
+        Args:
+            images (torch.Tensor): A batch of images as returned by the CLIP preprocessing.
+
+        Returns:
+            numpy.ndarray: The l2 normalized embedding of each image, one row per image.
+        """
+        with torch.no_grad():
+            image_features = self.clip_model.encode_image(images.to(self.device, non_blocking=True))
+            # l2 normalize
+            image_features /= image_features.norm(dim=-1, keepdim=True)
+        return image_features.float().cpu().numpy()
+
+    def _embed_text(self, text):
+        """Embed a text with the CLIP text encoder.
+
+        Args:
+            text (str): The text, truncated to the context length of CLIP.
+
+        Returns:
+            numpy.ndarray: The l2 normalized embedding as a read-only float32 vector.
+        """
+        tokens = clip.tokenize([text], truncate=True).to(self.device)
+        with torch.no_grad():
+            text_features = self.clip_model.encode_text(tokens)
+            text_features /= text_features.norm(dim=-1, keepdim=True)
+        embedding = text_features[0].float().cpu().numpy()
+        embedding.setflags(write=False)
+        return embedding
+
+    def predict(self, embeddings):
+        """Run the aesthetic predictor on image embeddings.
+
+        Args:
+            embeddings (numpy.ndarray): Image embeddings, one row per image.
+
+        Returns:
+            list: The aesthetic score of each image, rounded to 2 decimals.
+        """
+        with torch.no_grad():
+            scores = self.predictor(torch.from_numpy(np.asarray(embeddings, dtype=np.float32)).to(self.device))
+        return [round(score, 2) for score in scores.squeeze(1).tolist()]
+
+    def embed_many(self, paths, batch_size=32, num_workers=None, prefetch_factor=2):
+        """Embed many images, using the embedding cache where possible.
+
+        Cached embeddings are yielded first. The other images are decoded and preprocessed
+        in worker processes, which keep prefetch_factor batches per worker ready ahead of
+        inference, so CLIP runs on full batches while the next ones are being decoded.
+        New embeddings are added to the cache batch by batch.
+
+        Args:
+            paths (list): Paths of the images to embed.
+            batch_size (int, optional): Images per model run. Defaults to 32.
+            num_workers (int, optional): Decoding processes. Defaults to the number of CPUs, at most 8.
+            prefetch_factor (int, optional): Batches loaded in advance by each worker. Defaults to 2.
+
+        Yields:
+            tuple: (path, embedding) with the embedding as a float32 vector, or None for
+            images that could not be read.
+        """
+        paths = list(paths)
+        digests = [None] * len(paths)
+        missing = paths
+        if self.embedding_cache is not None:
+            with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as executor:
+                digests = list(executor.map(self._digest_or_none, paths))
+            self.embedding_cache.save_digests()
+            missing = []
+            missing_digests = []
+            for path, digest in zip(paths, digests):
+                embedding = self.embedding_cache.get(digest) if digest is not None else None
+                if embedding is None:
+                    missing.append(path)
+                    missing_digests.append(digest)
+                else:
+                    yield path, embedding
+            digests = missing_digests
+        if not missing:
+            return
+
+        if num_workers is None:
+            num_workers = min(8, os.cpu_count() or 1)
+        num_workers = min(num_workers, (len(missing) + batch_size - 1) // batch_size)
+        loader = torch.utils.data.DataLoader(
+            ImageDataset(missing, self.clip_preprocess),
+            batch_size=batch_size,
+            num_workers=num_workers,
+            prefetch_factor=prefetch_factor if num_workers > 0 else None,
+            pin_memory=self.device == "cuda",
+        )
+        position = 0
+        for images, ok in loader:
+            embeddings = self.embed_batch(images)
+            ok = ok.tolist()
+            batch_paths = missing[position:position + len(ok)]
+            batch_digests = digests[position:position + len(ok)]
+            position += len(ok)
+            if self.embedding_cache is not None:
+                cached = [i for i, image_ok in enumerate(ok) if image_ok and batch_digests[i] is not None]
+                self.embedding_cache.add([batch_digests[i] for i in cached], embeddings[cached])
+            for path, embedding, image_ok in zip(batch_paths, embeddings, ok):
+                yield path, embedding if image_ok else None
+
+    def _digest_or_none(self, path):
+        try:
+            return self.embedding_cache.digest(path)
+        except OSError:
+            return None
+
+    def score_many(self, paths, batch_size=32, num_workers=None, prefetch_factor=2):
+        """Score many images, see embed_many for how the images are embedded.
+
+        Since images with a cached embedding only run through the predictor, rescoring
+        after a predictor change is cheap.
+
+        Args:
+            paths (list): Paths of the images to score.
+            batch_size (int, optional): Images per model run. Defaults to 32.
+            num_workers (int, optional): Decoding processes. Defaults to the number of CPUs, at most 8.
+            prefetch_factor (int, optional): Batches loaded in advance by each worker. Defaults to 2.
+
+        Yields:
+            tuple: (path, score), images with a cached embedding first. The score is None
+            for images that could not be read.
+        """
+        batch = []
+        for path, embedding in self.embed_many(paths, batch_size, num_workers, prefetch_factor):
+            if embedding is None:
+                yield path, None
+                continue
+            batch.append((path, embedding))
+            if len(batch) == batch_size:
+                yield from zip([p for p, _ in batch], self.predict(np.stack([e for _, e in batch])))
+                batch = []
+        if batch:
+            yield from zip([p for p, _ in batch], self.predict(np.stack([e for _, e in batch])))
+
+if __name__ == "__main__":
+    # Throughput benchmark: python gallery_engine.py <image folder> [max images] [batch sizes...]
+    folder = Path(sys.argv[1])
+    limit = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    batch_sizes = [int(b) for b in sys.argv[3:]] or [1, 8, 32, 64]
+    paths = sorted(str(p) for p in folder.rglob("*") if p.suffix.lower() in (".png", ".jpg", ".jpeg", ".webp"))[:limit]
+    print(f"Scoring {len(paths)} images from {folder}")
+    engine = aesthetic_engine()
+
+    start_time = time.perf_counter()
+    serial = [get_score(Image.open(p), engine.predictor, engine.device, engine.clip_model, engine.clip_preprocess) for p in paths]
+    elapsed = time.perf_counter() - start_time
+    print(f"score():                 {len(paths) / elapsed:8.1f} images/sec")
+
+    for batch_size in batch_sizes:
+        start_time = time.perf_counter()
+        batched = [score for _, score in engine.score_many(paths, batch_size=batch_size)]
+        elapsed = time.perf_counter() - start_time
+        max_diff = max(abs(a - b) for a, b in zip(serial, batched) if b is not None)
+        print(f"score_many(batch={batch_size:3d}): {len(paths) / elapsed:8.1f} images/sec, max difference to score() {max_diff:.2f}")
+
+    # With a warm embedding cache, scoring only runs the predictor
+    with tempfile.TemporaryDirectory() as cache_folder:
+        engine.embedding_cache = gallery_embeddings.EmbeddingCache(cache_folder)
+        for run in ("cold", "warm"):
+            start_time = time.perf_counter()
+            cached = dict(engine.score_many(paths, batch_size=max(batch_sizes)))
+            elapsed = time.perf_counter() - start_time
+            print(f"score_many({run} cache):   {len(paths) / elapsed:8.1f} images/sec")
+        engine.embedding_cache.close()
\ No newline at end of file
@@ -0,0 +1,635 @@
+"""
+Reading the generation parameters of an image straight from its file header.
+
+PNG files from Stable Diffusion web UIs keep the parameters in `tEXt`, `iTXt` or `zTXt`
+chunks in front of the image data, JPEG and WebP files in the UserComment of their EXIF
+block. `read_image_text` walks the chunks or segments of the file with small reads and
+seeks past everything else, so the pixel data is never read or decoded.
+
+`parse_parameters` turns the parameters text of the AUTOMATIC1111 web UI into typed
+fields in a single pass: the prompt lines, the "Negative prompt:" lines and the
+settings line at the end, whose "Key: value" pairs may be quoted and include keys added
+by extensions. Numbers are stored as ints and floats, and fields that are missing are
+left out instead of being filled with a placeholder.
+
+In the EXIF DataFrame the number fields are nullable integer and float columns, with
+the integers narrowed to the smallest type holding their values. The text fields are
+dictionary encoded as categorical columns: every distinct value, e.g. a negative
+prompt shared by thousands of images or one of a handful of samplers, is stored once
+and the rows hold integer codes into it.
+
+Usage:
+    python gallery_exif.py [image files or folders]
+    python gallery_exif.py --parse
+    python gallery_exif.py --frame
+    python gallery_exif.py --memory [number of images]
+"""
+
+import json
+import logging
+import os
+import re
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import piexif.helper
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_TEXT_CHUNKS = (b'tEXt', b'iTXt', b'zTXt')
+EXIF_HEADER = b'Exif\x00\x00'
+EXIF_IFD_POINTER = 0x8769
+USER_COMMENT = 0x9286
+# Text chunks larger than this are not generation parameters, skip instead of reading them
+MAX_TEXT_CHUNK = 16 * 1024 * 1024
+
+NEGATIVE_PROMPT_PREFIX = "Negative prompt:"
+# One "Key: value" pair of the settings line, the value is either JSON quoted or runs to the next comma
+SETTING_REGEX = re.compile(r'\s*(\w[\w \-/]+):\s*("(?:\\.|[^\\"])+"|[^,]*)(?:,|$)')
+SIZE_REGEX = re.compile(r'(\d+)\s*x\s*(\d+)$')
+# A line is only the settings line if it has at least this many pairs, like the web UI checks
+MIN_SETTINGS = 3
+
+EXIF_COLUMNS = ['Positive prompt', 'Negative prompt', 'Steps', 'Sampler', 'CFG scale', 'Seed', 'Size', 'Width',
+                'Height', 'Model hash', 'Model', 'Eta', 'Hashes', 'Postprocessing', 'Extras']
+INT_FIELDS = ('Steps', 'Seed', 'Width', 'Height', 'Clip skip', 'ENSD', 'Hires steps', 'Variation seed')
+FLOAT_FIELDS = ('CFG scale', 'Denoising strength', 'Eta', 'Hires upscale', 'Variation seed strength')
+COLUMN_TYPES = {**{c: 'Int64' for c in INT_FIELDS}, **{c: 'Float64' for c in FLOAT_FIELDS}}
+# Integer types to narrow Int64 columns to, smallest first
+NARROW_INT_TYPES = ('Int8', 'Int16', 'Int32')
+# Written by earlier versions for every field that was not found
+MISSING_VALUE = 'No data found'
+
+logger = logging.getLogger(__name__)
+
+def _read_exact(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise EOFError("Unexpected end of file")
+    return data
+
+def _png_text(chunk_type, data):
+    keyword, _, rest = data.partition(b'\x00')
+    keyword = keyword.decode('latin-1')
+    if chunk_type == b'tEXt':
+        return keyword, rest.decode('latin-1')
+    if chunk_type == b'zTXt':
+        return keyword, zlib.decompress(rest[1:]).decode('latin-1')
+    # iTXt: compression flag, compression method, language tag, translated keyword, text
+    compressed = rest[0]
+    _, _, rest = rest[2:].partition(b'\x00')
+    _, _, text = rest.partition(b'\x00')
+    if compressed:
+        text = zlib.decompress(text)
+    return keyword, text.decode('utf-8')
+
+def read_png_text(f):
+    """Read the text chunks in front of the image data of a PNG file.
+
+    Args:
+        f (file): The file, positioned after the PNG signature.
+
+    Returns:
+        dict: The texts by keyword.
+    """
+    texts = {}
+    while True:
+        length, chunk_type = struct.unpack('>I4s', _read_exact(f, 8))
+        if chunk_type in (b'IDAT', b'IEND'):
+            return texts
+        if chunk_type in PNG_TEXT_CHUNKS and length <= MAX_TEXT_CHUNK:
+            keyword, text = _png_text(chunk_type, _read_exact(f, length))
+            texts.setdefault(keyword, text)
+            f.seek(4, os.SEEK_CUR)
+        else:
+            # Skip the chunk data and its CRC
+            f.seek(length + 4, os.SEEK_CUR)
+
+def user_comment_from_tiff(tiff):
+    """Get the UserComment from a TIFF structured EXIF block.
+
+    Args:
+        tiff (bytes): The EXIF block, starting at its byte order mark.
+
+    Returns:
+        str: The decoded UserComment, or None if there is none.
+    """
+    if tiff.startswith(EXIF_HEADER):
+        tiff = tiff[len(EXIF_HEADER):]
+    order = {b'II': '<', b'MM': '>'}.get(tiff[:2])
+    if order is None:
+        return None
+
+    def find_tag(ifd_offset, wanted):
+        count, = struct.unpack_from(order + 'H', tiff, ifd_offset)
+        for i in range(count):
+            tag, value_type, value_count, value = struct.unpack_from(order + 'HHII', tiff, ifd_offset + 2 + 12 * i)
+            if tag == wanted:
+                return value_type, value_count, value, ifd_offset + 2 + 12 * i + 8
+        return None
+
+    ifd0, = struct.unpack_from(order + 'I', tiff, 4)
+    pointer = find_tag(ifd0, EXIF_IFD_POINTER)
+    if pointer is None:
+        return None
+    entry = find_tag(pointer[2], USER_COMMENT)
+    if entry is None:
+        return None
+    _, value_count, value, value_position = entry
+    # Values of up to 4 bytes are stored in the entry itself
+    start = value_position if value_count <= 4 else value
+    return piexif.helper.UserComment.load(tiff[start:start + value_count])
+
+def read_jpeg_user_comment(f):
+    """Read the UserComment from the APP1 EXIF segment of a JPEG file.
+
+    Args:
+        f (file): The file, positioned after the start of image marker.
+
+    Returns:
+        str: The UserComment, or None if there is none.
+    """
+    while True:
+        marker, = struct.unpack('>H', _read_exact(f, 2))
+        while marker == 0xFFFF:
+            # Fill bytes in front of a marker
+            marker = 0xFF00 | _read_exact(f, 1)[0]
+        if marker in (0xFFDA, 0xFFD9):
+            # Start of scan or end of image, the metadata segments come before
+            return None
+        if 0xFFD0 <= marker <= 0xFFD7 or marker == 0xFF01:
+            continue
+        length, = struct.unpack('>H', _read_exact(f, 2))
+        if marker == 0xFFE1:
+            data = _read_exact(f, length - 2)
+            if data.startswith(EXIF_HEADER):
+                return user_comment_from_tiff(data)
+        else:
+            f.seek(length - 2, os.SEEK_CUR)
+
+def read_webp_user_comment(f):
+    """Read the UserComment from the EXIF chunk of a WebP file.
+
+    Args:
+        f (file): The file, positioned after the RIFF header.
+
+    Returns:
+        str: The UserComment, or None if there is none.
+    """
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return None
+        chunk_type, length = struct.unpack('<4sI', header)
+        if chunk_type == b'EXIF':
+            return user_comment_from_tiff(_read_exact(f, length))
+        # Chunks are padded to an even size
+        f.seek(length + (length & 1), os.SEEK_CUR)
+
+def read_image_text(path):
+    """Read the generation parameters and other texts of an image without decoding it.
+
+    Args:
+        path (str): Path of a PNG, JPEG or WebP image.
+
+    Returns:
+        dict: The texts by key, with the generation parameters under 'parameters' and
+        for PNG files also 'postprocessing' and 'extras' when present. None if the file
+        is not one of these formats or could not be parsed, so the caller can fall back
+        to PIL.
+    """
+    try:
+        with open(path, 'rb', buffering=8192) as f:
+            head = f.read(12)
+            if head.startswith(PNG_SIGNATURE):
+                f.seek(len(PNG_SIGNATURE))
+                return read_png_text(f)
+            if head.startswith(b'\xff\xd8'):
+                f.seek(2)
+                comment = read_jpeg_user_comment(f)
+            elif head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+                comment = read_webp_user_comment(f)
+            else:
+                return None
+            return {'parameters': comment} if comment else {}
+    except (OSError, EOFError, ValueError, struct.error, zlib.error, IndexError) as e:
+        logger.warning(f"Could not read the metadata of {path} from its header: {e}")
+        return None
+
+def _unquote(value):
+    if len(value) > 1 and value[0] == '"' and value[-1] == '"':
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value[1:-1]
+    return value
+
+def _number(convert, value):
+    try:
+        return convert(value)
+    except ValueError:
+        return None
+
+def parse_parameters(text):
+    """Parse the generation parameters written by the AUTOMATIC1111 web UI.
+
+    The text is made of the positive prompt, optionally followed by lines starting
+    with "Negative prompt:", and a last line with the settings as "Key: value" pairs.
+    Prompts can span several lines. Values containing commas are JSON quoted, like
+    `Lora hashes: "a: 123, b: 456"`.
+
+    Args:
+        text (str): The parameters text.
+
+    Returns:
+        dict: 'Positive prompt', 'Negative prompt' and one entry per setting. Steps,
+        Seed, CFG scale, Denoising strength and the other fields in INT_FIELDS and
+        FLOAT_FIELDS are numbers, and Size is also split into Width and Height. Fields
+        that are missing or cannot be read are left out.
+    """
+    parsed = {}
+    if not text:
+        return parsed
+    prompt, _, last_line = text.strip().rpartition("\n")
+    settings = SETTING_REGEX.findall(last_line)
+    if len(settings) < MIN_SETTINGS:
+        # No settings line, everything is prompt
+        prompt, settings = text.strip(), []
+    # The negative prompt starts at the first line beginning with its prefix
+    if prompt.startswith(NEGATIVE_PROMPT_PREFIX):
+        split = 0
+    else:
+        split = prompt.find("\n" + NEGATIVE_PROMPT_PREFIX)
+        split = split + 1 if split >= 0 else -1
+    if split >= 0:
+        positive, negative = prompt[:split], prompt[split + len(NEGATIVE_PROMPT_PREFIX):]
+    else:
+        positive, negative = prompt, None
+    positive = positive.strip()
+    if positive:
+        parsed['Positive prompt'] = positive
+    if negative is not None:
+        parsed['Negative prompt'] = negative.strip()
+
+    for key, value in settings:
+        key = key.strip()
+        value = _unquote(value.strip())
+        if key in INT_FIELDS:
+            value = _number(int, value)
+        elif key in FLOAT_FIELDS:
+            value = _number(float, value)
+        elif key == 'Size':
+            size = SIZE_REGEX.match(value)
+            if size:
+                parsed['Width'], parsed['Height'] = int(size.group(1)), int(size.group(2))
+        if value is not None and value != "":
+            parsed[key] = value
+    return parsed
+
+def read_parameters(path):
+    """Read and parse the generation parameters of an image.
+
+    Args:
+        path (str): Path of the image.
+
+    Returns:
+        dict: The fields of parse_parameters plus 'Postprocessing' and 'Extras' when
+        the image has them, or None if the header could not be read.
+    """
+    texts = read_image_text(path)
+    if texts is None:
+        return None
+    parsed = parse_parameters(texts.get('parameters'))
+    for key in ('postprocessing', 'extras'):
+        if texts.get(key):
+            parsed[key.capitalize()] = texts[key]
+    return parsed
+
+def apply_column_types(df):
+    """Give the columns of an EXIF DataFrame their types, in place.
+
+    The number fields become nullable Int64 and Float64 columns and the "No data
+    found" placeholders of earlier versions become missing values, so rows stored
+    before the fields were typed load the same as new ones. The columns are then
+    encoded with encode_columns.
+
+    Args:
+        df (pandas.DataFrame): EXIF rows, one column per field.
+
+    Returns:
+        pandas.DataFrame: The same DataFrame, with at least the EXIF_COLUMNS.
+    """
+    for column in EXIF_COLUMNS:
+        if column not in df.columns:
+            df[column] = None
+    if len(df) and df['Width'].isna().any():
+        # Rows from earlier versions only have the Size
+        size = df['Size'].astype('string').str.extract(SIZE_REGEX.pattern)
+        df['Width'] = df['Width'].where(df['Width'].notna(), size[0])
+        df['Height'] = df['Height'].where(df['Height'].notna(), size[1])
+    for column in df.columns:
+        if column in COLUMN_TYPES:
+            df[column] = pd.to_numeric(df[column].replace(MISSING_VALUE, None), errors='coerce').astype(COLUMN_TYPES[column])
+        elif df[column].dtype == object:
+            df[column] = df[column].replace(MISSING_VALUE, None)
+    return encode_columns(df)
+
+def _narrow_int(column):
+    values = column.dropna()
+    if len(values) == 0:
+        return column.astype(NARROW_INT_TYPES[0])
+    low, high = values.min(), values.max()
+    for dtype in NARROW_INT_TYPES:
+        info = np.iinfo(dtype.lower())
+        if info.min <= low and high <= info.max:
+            return column.astype(dtype)
+    return column
+
+def encode_columns(df):
+    """Store the columns of an EXIF DataFrame compactly, in place.
+
+    Int64 columns are narrowed to the smallest integer type holding their values and
+    all text columns become categorical, so each distinct value is stored once.
+
+    Args:
+        df (pandas.DataFrame): EXIF rows with typed number columns.
+
+    Returns:
+        pandas.DataFrame: The same DataFrame.
+    """
+    for column in df.columns:
+        dtype = df[column].dtype
+        if dtype == 'Int64':
+            df[column] = _narrow_int(df[column])
+        elif column not in COLUMN_TYPES and not isinstance(dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype('category')
+    return df
+
+def concat_frames(df, *frames):
+    """Append EXIF rows to an EXIF DataFrame, keeping the columns encoded.
+
+    pandas.concat turns categorical columns into plain object columns unless all sides
+    have the same categories, so those are extended to the union first. That only
+    remaps the integer codes. Only the columns whose type changed in the concatenation,
+    like a column missing on one side, are encoded again, so appending rows does not go
+    over every value of the existing ones.
+
+    Args:
+        df (pandas.DataFrame): The EXIF DataFrame, may be empty.
+        *frames (pandas.DataFrame): The rows to append, see exif_frame.
+
+    Returns:
+        pandas.DataFrame: A new DataFrame with the rows of all of them.
+    """
+    frames = [rows for rows in (df, *frames) if rows is not None and len(rows.columns) > 0 and not rows.empty]
+    if not frames:
+        return df
+    if len(frames) == 1:
+        return frames[0]
+    first = frames[0]
+    categories = {}
+    for rows in frames:
+        for column in rows.columns:
+            if isinstance(rows[column].dtype, pd.CategoricalDtype):
+                categories.setdefault(column, []).append(rows[column].cat.categories)
+    # One dtype object per column, so pandas compares the categories of the frames once
+    dtypes = {column: pd.CategoricalDtype(indexes[0].append(indexes[1:]).unique()) for column, indexes in categories.items()}
+    for i, rows in enumerate(frames):
+        remapped = {column: rows[column].astype(dtype) for column, dtype in dtypes.items()
+                    if column in rows.columns and isinstance(rows[column].dtype, pd.CategoricalDtype)}
+        if remapped:
+            frames[i] = rows.assign(**remapped)
+    result = pd.concat(frames)
+    changed = [column for column in result.columns
+               if column not in first.columns or result[column].dtype != first[column].dtype]
+    if changed:
+        result[changed] = encode_columns(result[changed])
+    return result
+
+def exif_frame(rows):
+    """Build a typed EXIF DataFrame from rows in a single construction.
+
+    The rows are consumed one at a time into a list per column, so they can be streamed
+    from worker processes without keeping a dict per row around.
+
+    Args:
+        rows (iterable): (sha256, fields) tuples, with fields as returned by read_parameters.
+
+    Returns:
+        pandas.DataFrame: The EXIF data indexed by sha256, see apply_column_types.
+    """
+    index = []
+    columns = {}
+    for sha256, fields in rows:
+        n = len(index)
+        for key, value in fields.items():
+            column = columns.get(key)
+            if column is None:
+                column = columns[key] = []
+            if len(column) < n:
+                # The rows before did not have this field
+                column.extend([None] * (n - len(column)))
+            column.append(value)
+        index.append(sha256)
+    for column in columns.values():
+        column.extend([None] * (len(index) - len(column)))
+    return apply_column_types(pd.DataFrame(columns, index=pd.Index(index, name="sha256")))
+
+def _read_with_pil(path):
+    from PIL import Image
+    import piexif
+    with Image.open(path) as img:
+        info = img.info
+        if 'parameters' in info:
+            return info['parameters']
+        if 'exif' in info:
+            user_comment = piexif.load(info['exif']).get('Exif', {}).get(piexif.ExifIFD.UserComment, b'')
+            return piexif.helper.UserComment.load(user_comment) if user_comment else None
+    return None
+
+def _make_sample_images(folder):
+    """Write multi-megabyte PNG, JPEG and WebP images with generation parameters."""
+    import piexif
+    from PIL import Image, PngImagePlugin
+    parameters = ("a castle on a hill, highly detailed, (masterpiece:1.2)\n"
+                  "Negative prompt: blurry, lowres\n"
+                  "Steps: 30, Sampler: DPM++ 2M Karras, CFG scale: 7, Seed: 1234, Size: 2048x2048, Model hash: abc123, Model: sd15")
+    pixels = np.random.default_rng(0).integers(0, 256, (2048, 2048, 3), dtype=np.uint8)
+    img = Image.fromarray(pixels)
+    info = PngImagePlugin.PngInfo()
+    info.add_text('parameters', parameters)
+    img.save(folder / 'sample.png', pnginfo=info)
+    exif = piexif.dump({"Exif": {piexif.ExifIFD.UserComment: piexif.helper.UserComment.dump(parameters, encoding="unicode")}})
+    img.save(folder / 'sample.jpg', quality=95, exif=exif)
+    img.save(folder / 'sample.webp', quality=90, exif=exif)
+    return [folder / 'sample.png', folder / 'sample.jpg', folder / 'sample.webp']
+
+# (parameters text, expected fields) pairs covering the variants written by the web UI and its extensions
+PARSE_CORPUS = [
+    ("a castle on a hill\nNegative prompt: blurry, lowres\nSteps: 30, Sampler: DPM++ 2M Karras, CFG scale: 7, Seed: 1234, Size: 512x768, Model hash: abc123, Model: sd15",
+     {'Positive prompt': 'a castle on a hill', 'Negative prompt': 'blurry, lowres', 'Steps': 30, 'Sampler': 'DPM++ 2M Karras',
+      'CFG scale': 7.0, 'Seed': 1234, 'Size': '512x768', 'Width': 512, 'Height': 768, 'Model hash': 'abc123', 'Model': 'sd15'}),
+    ("portrait, (masterpiece:1.2),\nsoft light, <lora:film:0.8>\nNegative prompt: bad hands,\nextra fingers\n"
+     "Steps: 20, Sampler: Euler a, CFG scale: 6.5, Seed: 4294967295, Size: 1024x1024, Denoising strength: 0.45, Clip skip: 2, "
+     "Hires upscale: 1.5, Hires steps: 10, Hires upscaler: R-ESRGAN 4x+, Lora hashes: \"film: 0a1b2c3d, other: 4e5f\", Version: v1.6.0",
+     {'Positive prompt': 'portrait, (masterpiece:1.2),\nsoft light, <lora:film:0.8>', 'Negative prompt': 'bad hands,\nextra fingers',
+      'Steps': 20, 'Sampler': 'Euler a', 'CFG scale': 6.5, 'Seed': 4294967295, 'Size': '1024x1024', 'Width': 1024, 'Height': 1024,
+      'Denoising strength': 0.45, 'Clip skip': 2, 'Hires upscale': 1.5, 'Hires steps': 10, 'Hires upscaler': 'R-ESRGAN 4x+',
+      'Lora hashes': 'film: 0a1b2c3d, other: 4e5f', 'Version': 'v1.6.0'}),
+    ("a cat\nSteps: 25, Sampler: DDIM, CFG scale: 8, Seed: 42, Size: 640x480, Eta: 0.67, ENSD: 31337, "
+     "ControlNet 0: \"preprocessor: canny, model: control_canny [e3fe7712], weight: 1\", Hashes: \"{\\\"model\\\": \\\"abc123\\\"}\"",
+     {'Positive prompt': 'a cat', 'Steps': 25, 'Sampler': 'DDIM', 'CFG scale': 8.0, 'Seed': 42, 'Size': '640x480', 'Width': 640,
+      'Height': 480, 'Eta': 0.67, 'ENSD': 31337, 'ControlNet 0': 'preprocessor: canny, model: control_canny [e3fe7712], weight: 1',
+      'Hashes': '{"model": "abc123"}'}),
+    ("Negative prompt: text, watermark\nSteps: 10, Sampler: Euler, CFG scale: 5, Seed: -1, Size: 512x512",
+     {'Negative prompt': 'text, watermark', 'Steps': 10, 'Sampler': 'Euler', 'CFG scale': 5.0, 'Seed': -1, 'Size': '512x512',
+      'Width': 512, 'Height': 512}),
+    ("just a prompt, with: a colon, and commas",
+     {'Positive prompt': 'just a prompt, with: a colon, and commas'}),
+    ("a dog\nNegative prompt:\nSteps: abc, Sampler: Euler, CFG scale: 7, Seed: 1, Size: large",
+     {'Positive prompt': 'a dog', 'Negative prompt': '', 'Sampler': 'Euler', 'CFG scale': 7.0, 'Seed': 1, 'Size': 'large'}),
+    ("", {}),
+]
+
+def _legacy_parse(parameters):
+    """The parser used before parse_parameters, kept to compare the throughput."""
+    parsed_data = {}
+    regex = r'(\w+(?:\s+\w+)*)\s*:\s*([\w.+@-]+(?:\s+[\w.+@-]+)*(?:\s*\([\w\s.+@-]*\))?)'
+    param_lines = parameters.splitlines()
+    first_line = None
+    if len(param_lines) > 2 and any("Negative prompt:" in s for s in param_lines):
+        first_line = param_lines.pop(0)
+    elif len(param_lines) == 2 and not any("Negative prompt:" in s for s in param_lines):
+        first_line = param_lines.pop(0)
+    if first_line:
+        parsed_data['Positive prompt'] = first_line
+    for key_value in param_lines:
+        if 'Negative prompt:' in key_value:
+            parsed_data['Negative prompt'] = key_value.split('Negative prompt: ')[1:][-1].strip()
+        elif all(x in key_value for x in ['Steps:', 'Sampler:', 'CFG scale:', 'Seed:', 'Size:', 'Model:']):
+            for match in re.findall(regex, key_value):
+                parsed_data[match[0]] = match[1]
+    return parsed_data
+
+def _benchmark_frame():
+    # Build frames of growing size from parsed rows, by appending rows like earlier versions and in one construction
+    fields = [parse_parameters(text) for text, _ in PARSE_CORPUS]
+    for n in (2500, 5000, 10000, 20000, 100000, 200000):
+        rows = [(f"{i:064x}", fields[i % len(fields)]) for i in range(n)]
+        if n <= 10000:
+            start_time = time.perf_counter()
+            df = pd.DataFrame(columns=EXIF_COLUMNS)
+            for sha256, row in rows:
+                df.loc[sha256] = pd.Series(row)
+            print(f"{n:7d} rows, row by row: {1e6 * (time.perf_counter() - start_time) / n:7.1f} us/row")
+        start_time = time.perf_counter()
+        exif_frame(iter(rows))
+        print(f"{n:7d} rows, one frame:  {1e6 * (time.perf_counter() - start_time) / n:7.1f} us/row")
+
+def _sample_rows(count):
+    # Generation parameters the way a folder of generations has them: a prompt per image
+    # and a few negative prompts, samplers, models and sizes shared by all of them
+    rng = np.random.default_rng(0)
+    negatives = [", ".join(f"bad anatomy {i}, lowres, blurry, watermark, text, jpeg artifacts, worst quality, extra fingers"
+                           for i in range(k)) for k in (1, 3, 5)]
+    samplers = ["Euler a", "DPM++ 2M Karras", "DPM++ SDE Karras", "DDIM", "UniPC"]
+    models = [("sd15", "cc6cb27103"), ("sdxl", "31e35c80fc"), ("dreamshaper_8", "879db523c3")]
+    sizes = [(512, 512), (512, 768), (768, 512), (1024, 1024)]
+    for i in range(count):
+        width, height = sizes[rng.integers(len(sizes))]
+        model, model_hash = models[rng.integers(len(models))]
+        text = (f"a portrait of a knight number {i}, castle in the background, dramatic light, highly detailed, (masterpiece:1.2)\n"
+                f"Negative prompt: {negatives[rng.integers(len(negatives))]}\n"
+                f"Steps: {rng.integers(20, 50)}, Sampler: {samplers[rng.integers(len(samplers))]}, CFG scale: {rng.integers(5, 12)}, "
+                f"Seed: {rng.integers(2**32)}, Size: {width}x{height}, Model hash: {model_hash}, Model: {model}")
+        if i % 4 == 0:
+            text += ", Denoising strength: 0.45, Hires upscale: 2, Hires steps: 15, Hires upscaler: R-ESRGAN 4x+"
+        yield f"{i:064x}", text
+
+def _benchmark_memory(count):
+    # Resident size of the EXIF table of a folder in the layout of earlier versions and now
+    texts = list(_sample_rows(count))
+
+    # Earlier versions: every field a string, "No data found" for missing ones
+    legacy = []
+    for _, text in texts:
+        fields = {k: str(v) for k, v in parse_parameters(text).items()}
+        legacy.append({c: fields.get(c, MISSING_VALUE) for c in EXIF_COLUMNS})
+    frames = {"strings with placeholders": pd.DataFrame(legacy, index=[sha256 for sha256, _ in texts], dtype=object)}
+    del legacy
+
+    start_time = time.perf_counter()
+    encoded = exif_frame((sha256, parse_parameters(text)) for sha256, text in texts)
+    build_time = time.perf_counter() - start_time
+    typed = encoded.copy()
+    for column in typed.columns:
+        if isinstance(typed[column].dtype, pd.CategoricalDtype):
+            typed[column] = typed[column].astype(object)
+    frames["typed, text as objects"] = typed
+    frames["typed, dictionary encoded"] = encoded
+
+    print(f"EXIF table of {count} images, built in {build_time:.2f} seconds")
+    sizes = {}
+    for name, df in frames.items():
+        usage = df.memory_usage(index=True, deep=True)
+        sizes[name] = usage
+        print(f"{name:>26}: {usage.sum() / 2**20:8.1f} MB, {usage.sum() / count:6.0f} bytes/image")
+    print("Largest columns, MB:")
+    for column in sizes["strings with placeholders"].drop("Index").sort_values(ascending=False).index[:8]:
+        print(f"{column:>26}: " + "  ".join(f"{usage.get(column, 0) / 2**20:8.1f}" for usage in sizes.values()))
+
+def _check_parser():
+    failures = 0
+    for text, expected in PARSE_CORPUS:
+        parsed = parse_parameters(text)
+        if parsed != expected:
+            failures += 1
+            print(f"Mismatch for {text!r}:\n  expected {expected}\n  parsed   {parsed}")
+    print(f"Parser corpus: {len(PARSE_CORPUS) - failures}/{len(PARSE_CORPUS)} texts parsed as expected")
+
+    # The legacy parser fails on an empty negative prompt, leave that text out of the comparison
+    texts = [text for text, _ in PARSE_CORPUS if text and "Negative prompt:\n" not in text] * 5000
+    for name, parse in (("legacy", _legacy_parse), ("single pass", parse_parameters)):
+        fields = 0
+        start_time = time.perf_counter()
+        for text in texts:
+            fields += len(parse(text))
+        elapsed = time.perf_counter() - start_time
+        print(f"{name:>11}: {len(texts) / elapsed:10.0f} texts/s, {fields / len(texts):5.1f} fields/text")
+    return failures
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--parse"]:
+        sys.exit(1 if _check_parser() else 0)
+    if sys.argv[1:] == ["--frame"]:
+        _benchmark_frame()
+        sys.exit(0)
+    if sys.argv[1:2] == ["--memory"]:
+        _benchmark_memory(int(sys.argv[2]) if len(sys.argv) > 2 else 200000)
+        sys.exit(0)
+    # Compare the header reader with the PIL path, on the given images or on generated samples
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = []
+        for arg in sys.argv[1:]:
+            arg = Path(arg)
+            paths.extend(sorted(p for p in arg.rglob('*') if p.suffix.lower() in ('.png', '.jpg', '.jpeg', '.webp')) if arg.is_dir() else [arg])
+        if not paths:
+            paths = _make_sample_images(Path(tmp))
+        total_size = sum(os.path.getsize(p) for p in paths)
+        print(f"{len(paths)} images, {total_size / len(paths) / 1e6:.1f} MB on average")
+
+        repeats = max(1, 2000 // len(paths))
+        mismatches = sum(1 for p in paths if (read_image_text(p) or {}).get('parameters') != _read_with_pil(p))
+        for name, read in (("PIL", _read_with_pil), ("header", read_image_text)):
+            start_time = time.perf_counter()
+            for _ in range(repeats):
+                for p in paths:
+                    read(p)
+            elapsed = (time.perf_counter() - start_time) / (repeats * len(paths))
+            print(f"{name:>6}: {1e6 * elapsed:8.1f} us/image")
+        print(f"Parameters differing between the readers: {mismatches}")
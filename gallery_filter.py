@@ -0,0 +1,635 @@
+"""
+Filtering the images of a library on their metadata.
+
+The `FilterEngine` keeps the metadata columns that can be filtered on as typed NumPy
+arrays, one entry per image, in the order the images were added: bool Favorites,
+Reviewed and Todelete, int8 Rating and float32 Aesthetic_score, which is NaN for
+images that are not scored yet.
+
+Tags, categories, favorites and ratings are also kept as a `BitmapIndex`: a bitmap
+over the image positions per value, packed eight images to a byte. Any-of, all-of and
+none-of queries on them are bitwise OR, AND and NOT of the bitmaps, a minimum rating
+is the OR of the rating buckets above it, and the number of images with a value,
+overall or among the results of a filter, is a popcount. A filter combines the
+bitmaps of its predicates with `&`, and the result is an int32 array of the matching
+positions. Nothing is copied or converted per query.
+
+The EXIF fields shown as facets in the filter bar (Model, Sampler, Steps, CFG scale)
+are kept as a `FacetCounter` each: an int32 code per image into the distinct values of
+the field, and the number of images per value. The counts are updated as EXIF rows
+come in, and the counts among the results of a filter are a bincount of the codes at
+their positions.
+
+The engine is built from the metadata and EXIF tables when they are loaded or
+replaced, and kept up to date by the edit routes and the indexing tasks, the same way
+as the tag and category vocabularies.
+
+Usage:
+    python gallery_filter.py [number of images]
+"""
+
+import logging
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+INITIAL_CAPACITY = 1024
+
+# Array dtypes of the filterable columns, and the value of an image without one
+COLUMNS = {"Favorites": (np.bool_, False),
+           "Reviewed": (np.bool_, False),
+           "Todelete": (np.bool_, False),
+           "Rating": (np.int8, 0),
+           "Aesthetic_score": (np.float32, np.nan)}
+LIST_COLUMNS = ("Tags", "Categorization")
+# Columns with a bitmap per value
+BITMAP_COLUMNS = ("Favorites", "Rating", *LIST_COLUMNS)
+# EXIF fields counted per value for the filter bar
+FACET_COLUMNS = ("Model", "Sampler", "Steps", "CFG scale")
+
+# Number of set bits of every byte value, for NumPy versions without bitwise_count
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+BITWISE_COUNT = hasattr(np, "bitwise_count")
+
+logger = logging.getLogger(__name__)
+
+def _as_list(value):
+    if isinstance(value, (list, tuple, set)):
+        return list(value)
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return []
+    return [value]
+
+def _typed_column(df, column, dtype, default):
+    if column not in df.columns:
+        return np.full(len(df), default, dtype=dtype)
+    values = df[column]
+    if dtype is np.bool_:
+        return values.fillna(False).to_numpy(dtype=np.bool_)
+    values = pd.to_numeric(values, errors='coerce')
+    if dtype is np.int8:
+        values = values.fillna(default).clip(-128, 127)
+    return values.to_numpy(dtype=dtype, na_value=default)
+
+def _width(capacity):
+    # Whole 64 bit words, so bitmaps can be counted as uint64
+    return 8 * ((capacity + 63) // 64)
+
+def pack(mask, capacity):
+    """Pack a boolean mask over positions into a bitmap with room for capacity positions."""
+    bits = np.zeros(_width(capacity), dtype=np.uint8)
+    packed = np.packbits(mask)
+    bits[:len(packed)] = packed
+    return bits
+
+def unpack(bits, size):
+    """Get the positions set in a bitmap, below size, as int32."""
+    return np.flatnonzero(np.unpackbits(bits, count=size)).astype(np.int32)
+
+def popcount(bits):
+    """Count the positions set in a bitmap."""
+    if BITWISE_COUNT:
+        return int(np.bitwise_count(bits.view(np.uint64)).sum())
+    return int(POPCOUNT[bits].sum(dtype=np.int64))
+
+def parse_terms(terms):
+    """Split filter terms into the values of which one, all and none must be present.
+
+    A term prefixed with "+" is required and one prefixed with "-" is excluded. The
+    other terms are alternatives, of which an image needs at least one.
+
+    Args:
+        terms (list): The terms, e.g. ["cat", "dog", "+outdoor", "-blurry"].
+
+    Returns:
+        tuple: The lists of any-of, all-of and none-of values.
+    """
+    any_of, all_of, none_of = [], [], []
+    for term in terms:
+        term = term.strip()
+        if term.startswith("+") and len(term) > 1:
+            all_of.append(term[1:])
+        elif term.startswith("-") and len(term) > 1:
+            none_of.append(term[1:])
+        elif term:
+            any_of.append(term)
+    return any_of, all_of, none_of
+
+class BitmapIndex():
+    """A bitmap of the image positions per value of a column.
+
+    Args:
+        capacity (int): The number of positions the bitmaps have room for.
+    """
+    def __init__(self, capacity=INITIAL_CAPACITY) -> None:
+        self.capacity = capacity
+        self.bitmaps = {}
+        self.counts = {}
+
+    @classmethod
+    def from_values(cls, values, capacity, lists=False):
+        """Build the index of a column.
+
+        Args:
+            values (list): The value of every position, or the list of values with lists.
+            capacity (int): The number of positions the bitmaps have room for.
+            lists (bool, optional): Whether a position has a list of values.
+
+        Returns:
+            BitmapIndex: The index.
+        """
+        index = cls(capacity)
+        positions = {}
+        for position, value in enumerate(values):
+            for v in (value if lists else (value,)):
+                positions.setdefault(v, []).append(position)
+        for value, value_positions in positions.items():
+            mask = np.zeros(capacity, dtype=np.bool_)
+            mask[value_positions] = True
+            index.bitmaps[value] = pack(mask, capacity)
+            index.counts[value] = int(mask.sum())
+        return index
+
+    def __contains__(self, value):
+        return value in self.bitmaps
+
+    def values(self):
+        return self.bitmaps.keys()
+
+    def resize(self, capacity):
+        """Make room for capacity positions."""
+        width = _width(capacity)
+        for value, bits in self.bitmaps.items():
+            grown = np.zeros(width, dtype=np.uint8)
+            grown[:len(bits)] = bits
+            self.bitmaps[value] = grown
+        self.capacity = capacity
+
+    def add(self, value, position):
+        """Set the bit of a position in the bitmap of a value."""
+        bits = self.bitmaps.get(value)
+        if bits is None:
+            bits = self.bitmaps[value] = np.zeros(_width(self.capacity), dtype=np.uint8)
+        byte, bit = divmod(position, 8)
+        flag = 0x80 >> bit
+        if not bits[byte] & flag:
+            bits[byte] |= flag
+            self.counts[value] = self.counts.get(value, 0) + 1
+
+    def discard(self, value, position):
+        """Clear the bit of a position in the bitmap of a value, if set."""
+        bits = self.bitmaps.get(value)
+        if bits is None:
+            return
+        byte, bit = divmod(position, 8)
+        flag = 0x80 >> bit
+        if bits[byte] & flag:
+            bits[byte] &= ~flag & 0xFF
+            self.counts[value] -= 1
+            if self.counts[value] == 0:
+                del self.bitmaps[value]
+                del self.counts[value]
+
+    def bitmap(self, value):
+        """Get the bitmap of a value, empty if no position has it."""
+        bits = self.bitmaps.get(value)
+        return bits if bits is not None else np.zeros(_width(self.capacity), dtype=np.uint8)
+
+    def any_of(self, values):
+        """Get the bitmap of the positions having at least one of the values."""
+        bits = np.zeros(_width(self.capacity), dtype=np.uint8)
+        for value in values:
+            if value in self.bitmaps:
+                bits |= self.bitmaps[value]
+        return bits
+
+    def all_of(self, values):
+        """Get the bitmap of the positions having all of the values."""
+        bits = np.full(_width(self.capacity), 0xFF, dtype=np.uint8)
+        for value in values:
+            bits &= self.bitmap(value)
+        return bits
+
+    def count(self, value):
+        """Get the number of positions having a value."""
+        return self.counts.get(value, 0)
+
+    def counts_in(self, bits):
+        """Get the number of positions having each value among the positions set in a bitmap.
+
+        Returns:
+            dict: The counts by value, leaving out values no position in the bitmap has.
+        """
+        counts = {}
+        for value, value_bits in self.bitmaps.items():
+            count = popcount(value_bits & bits)
+            if count:
+                counts[value] = count
+        return counts
+
+    def memory_usage(self):
+        return sum(bits.nbytes for bits in self.bitmaps.values())
+
+def _facet_value(value):
+    if value is None or value is pd.NA or (isinstance(value, float) and np.isnan(value)):
+        return None
+    if hasattr(value, 'item'):
+        # numpy scalars
+        return value.item()
+    return value
+
+class FacetCounter():
+    """The value of a field per image position as a code, and the number of images per value.
+
+    Code 0 stands for images without a value, so the codes can be counted with
+    numpy.bincount as they are. The value of code i is values[i - 1].
+
+    Args:
+        capacity (int): The number of positions there is room for.
+    """
+    def __init__(self, capacity=INITIAL_CAPACITY) -> None:
+        self.codes = np.zeros(capacity, dtype=np.int32)
+        self.values = []
+        self.lookup = {}
+        self.counts = np.zeros(1, dtype=np.int64)
+
+    def resize(self, capacity):
+        """Make room for capacity positions."""
+        grown = np.zeros(capacity, dtype=np.int32)
+        grown[:len(self.codes)] = self.codes
+        self.codes = grown
+
+    def _code(self, value):
+        value = _facet_value(value)
+        if value is None:
+            return 0
+        code = self.lookup.get(value)
+        if code is None:
+            self.values.append(value)
+            code = self.lookup[value] = len(self.values)
+        return code
+
+    def set(self, positions, values):
+        """Set the values of images.
+
+        Args:
+            positions (numpy.ndarray): The distinct positions of the images.
+            values (iterable): The value of each image, None or NA if it has none.
+        """
+        codes = np.fromiter((self._code(v) for v in values), dtype=np.int32, count=len(positions))
+        size = len(self.values) + 1
+        if len(self.counts) < size:
+            self.counts = np.concatenate([self.counts, np.zeros(size - len(self.counts), dtype=np.int64)])
+        self.counts -= np.bincount(self.codes[positions], minlength=size)
+        self.counts += np.bincount(codes, minlength=size)
+        self.codes[positions] = codes
+
+    def counts_in(self, positions):
+        """Get the number of images per value among the images at positions, by code."""
+        return np.bincount(self.codes[positions], minlength=len(self.values) + 1)
+
+    def memory_usage(self):
+        return self.codes.nbytes + self.counts.nbytes + sum(sys.getsizeof(v) + 2 * 100 for v in self.values)
+
+class FilterEngine():
+    """Typed filter columns over the images of a library.
+
+    `version` changes whenever images are added or the engine is rebuilt, i.e. whenever
+    positions looked up with positions_of may be out of date.
+
+    Args:
+        df (pandas.DataFrame, optional): The metadata table, indexed by sha256 with a
+            Path column.
+        exif (pandas.DataFrame, optional): The EXIF table, indexed by sha256.
+    """
+    def __init__(self, df=None, exif=None) -> None:
+        self.version = 0
+        self.rebuild(df, exif)
+
+    def rebuild(self, df, exif=None):
+        """Replace the images the engine is built over.
+
+        Args:
+            df (pandas.DataFrame): The metadata table, indexed by sha256 with a Path column.
+            exif (pandas.DataFrame, optional): The EXIF table, indexed by sha256. Images
+                that only have EXIF data are added.
+        """
+        if df is None or not isinstance(df, pd.DataFrame):
+            df = pd.DataFrame(columns=["Path", *COLUMNS, *LIST_COLUMNS])
+        self.version += 1
+        self.size = len(df)
+        capacity = max(INITIAL_CAPACITY, self.size)
+        self.keys = list(df.index)
+        self.paths = list(df["Path"]) if "Path" in df.columns else [None] * self.size
+        self.positions = {key: position for position, key in enumerate(self.keys)}
+        self.columns = {}
+        for column, (dtype, default) in COLUMNS.items():
+            array = np.full(capacity, default, dtype=dtype)
+            array[:self.size] = _typed_column(df, column, dtype, default)
+            self.columns[column] = array
+        self.lists = {column: [_as_list(v) for v in df[column]] if column in df.columns else [[] for _ in range(self.size)]
+                      for column in LIST_COLUMNS}
+        self.bitmaps = {column: BitmapIndex.from_values(self.lists[column] if column in LIST_COLUMNS else self.column(column).tolist(),
+                                                        capacity, lists=column in LIST_COLUMNS)
+                        for column in BITMAP_COLUMNS}
+        self.facets = {column: FacetCounter(capacity) for column in FACET_COLUMNS}
+        if isinstance(exif, pd.DataFrame) and not exif.empty:
+            self.set_exif(exif)
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, sha256):
+        return sha256 in self.positions
+
+    def _append(self, sha256):
+        position = self.size
+        if position == len(self.columns["Rating"]):
+            for column, (dtype, default) in COLUMNS.items():
+                grown = np.full(2 * position, default, dtype=dtype)
+                grown[:position] = self.columns[column]
+                self.columns[column] = grown
+            for bitmaps in self.bitmaps.values():
+                bitmaps.resize(2 * position)
+            for facet in self.facets.values():
+                facet.resize(2 * position)
+        self.keys.append(sha256)
+        self.paths.append(None)
+        for column in LIST_COLUMNS:
+            self.lists[column].append([])
+        for column in ("Favorites", "Rating"):
+            self.bitmaps[column].add(COLUMNS[column][1], position)
+        self.positions[sha256] = position
+        self.size += 1
+        self.version += 1
+        return position
+
+    def set(self, sha256, **fields):
+        """Set the metadata of an image, adding the image when it is not known yet.
+
+        Takes the same fields as gallery_store.MetadataStore.update_metadata, fields the
+        engine does not filter on are ignored.
+
+        Args:
+            sha256 (str): The sha256 key of the image path.
+            **fields: Column values to set.
+        """
+        position = self.positions.get(sha256)
+        if position is None:
+            position = self._append(sha256)
+        for column, value in fields.items():
+            if column in COLUMNS:
+                dtype, default = COLUMNS[column]
+                if value is None or value is pd.NA:
+                    value = default
+                if column in self.bitmaps:
+                    self.bitmaps[column].discard(self.columns[column][position].item(), position)
+                self.columns[column][position] = value
+                if column in self.bitmaps:
+                    self.bitmaps[column].add(self.columns[column][position].item(), position)
+            elif column in LIST_COLUMNS:
+                old, new = self.lists[column][position], _as_list(value)
+                for v in set(old) - set(new):
+                    self.bitmaps[column].discard(v, position)
+                for v in new:
+                    self.bitmaps[column].add(v, position)
+                self.lists[column][position] = new
+            elif column == "Path":
+                self.paths[position] = value
+
+    def set_exif(self, exif):
+        """Count the facet fields of EXIF rows, adding the images that are not known yet.
+
+        Args:
+            exif (pandas.DataFrame): EXIF rows indexed by sha256, see gallery_exif.exif_frame.
+        """
+        positions = self.positions
+        for sha256 in exif.index:
+            if sha256 not in positions:
+                self._append(sha256)
+        at = np.fromiter((positions[k] for k in exif.index), dtype=np.int64, count=len(exif))
+        if exif.index.has_duplicates:
+            keep = ~exif.index.duplicated(keep='last')
+            exif, at = exif[keep], at[keep]
+        for column, facet in self.facets.items():
+            if column in exif.columns:
+                facet.set(at, exif[column].tolist())
+
+    def facet_counts(self, positions=None, limit=None):
+        """Get the number of images per value of the facet fields, Rating and Favorites.
+
+        Args:
+            positions (numpy.ndarray, optional): The positions of the images of a filter
+                result, to count among them as well.
+            limit (int, optional): The maximum number of values per field, most used first.
+
+        Returns:
+            dict: Per field, a list of (value, number of images, number among positions)
+                tuples. The last is the same as the second without positions.
+        """
+        facets = {}
+        for column, facet in self.facets.items():
+            counts = facet.counts[1:]
+            counts_in = counts if positions is None else facet.counts_in(positions)[1:]
+            order = np.argsort(-counts, kind='stable')
+            order = order[counts[order] > 0][:limit]
+            facets[column] = [(facet.values[i], int(counts[i]), int(counts_in[i])) for i in order]
+        for column in ("Rating", "Favorites"):
+            index = self.bitmaps[column]
+            counts_in = dict(index.counts)
+            if positions is not None and len(positions):
+                # Favorites count as 0 and 1, which look up the same as False and True
+                values = self.column(column)[positions].astype(np.int64)
+                low = int(values.min())
+                counts_in = {low + i: int(c) for i, c in enumerate(np.bincount(values - low)) if c}
+            elif positions is not None:
+                counts_in = {}
+            facets[column] = [(value, index.count(value), counts_in.get(value, 0)) for value in sorted(index.values())]
+        return facets
+
+    def column(self, column):
+        """Get the values of a filter column of all images, as a view."""
+        return self.columns[column][:self.size]
+
+    def query(self, favorites=None, min_rating=None, min_ascore=None, tags=None, categories=None, among=None):
+        """Get the images matching all of the given predicates.
+
+        Args:
+            favorites (bool, optional): Only keep favorites, or only non-favorites.
+            min_rating (int, optional): The minimum rating.
+            min_ascore (float, optional): The minimum aesthetic score. Unscored images never match.
+            tags (list, optional): Tag terms as taken by parse_terms: an image needs one of
+                the plain tags, all of the ones prefixed with "+" and none of the ones
+                prefixed with "-".
+            categories (list, optional): Category terms, as for tags.
+            among (numpy.ndarray, optional): Positions to restrict the result to, e.g. the
+                images a prompt search found.
+
+        Returns:
+            numpy.ndarray: The int32 positions of the matching images, in ascending order.
+        """
+        return unpack(self.query_bits(favorites, min_rating, min_ascore, tags, categories, among), self.size)
+
+    def query_bits(self, favorites=None, min_rating=None, min_ascore=None, tags=None, categories=None, among=None):
+        """Get the images matching all of the given predicates as a bitmap, see query."""
+        capacity = len(self.columns["Rating"])
+        if among is not None:
+            mask = np.zeros(capacity, dtype=np.bool_)
+            mask[among] = True
+            bits = pack(mask, capacity)
+        else:
+            bits = pack(np.ones(self.size, dtype=np.bool_), capacity)
+        if favorites is not None:
+            bits &= self.bitmaps["Favorites"].bitmap(bool(favorites))
+        if min_rating is not None:
+            ratings = self.bitmaps["Rating"]
+            bits &= ratings.any_of([r for r in ratings.values() if r >= min_rating])
+        if min_ascore is not None:
+            # NaN compares as False
+            bits &= pack(self.column("Aesthetic_score") >= min_ascore, capacity)
+        for column, terms in (("Tags", tags), ("Categorization", categories)):
+            if not terms:
+                continue
+            any_of, all_of, none_of = parse_terms(terms)
+            index = self.bitmaps[column]
+            if any_of:
+                bits &= index.any_of(any_of)
+            if all_of:
+                bits &= index.all_of(all_of)
+            if none_of:
+                bits &= ~index.any_of(none_of)
+        return bits
+
+    def counts(self, column, bits=None):
+        """Get the number of images with each value of a bitmap column.
+
+        Args:
+            column (str): One of Favorites, Rating, Tags and Categorization.
+            bits (numpy.ndarray, optional): Only count the images in this bitmap, e.g. the
+                result of query_bits.
+
+        Returns:
+            dict: The counts by value.
+        """
+        index = self.bitmaps[column]
+        if bits is None:
+            return dict(index.counts)
+        return index.counts_in(bits)
+
+    def positions_of(self, keys):
+        """Get the positions of images by sha256 key, skipping unknown keys.
+
+        Returns:
+            numpy.ndarray: The int32 positions.
+        """
+        positions = self.positions
+        return np.fromiter((positions[k] for k in keys if k in positions), dtype=np.int32)
+
+    def keys_at(self, positions):
+        """Get the sha256 keys of the images at positions."""
+        return [self.keys[p] for p in positions]
+
+    def paths_at(self, positions):
+        """Get the paths of the images at positions."""
+        return [self.paths[p] for p in positions]
+
+    def memory_usage(self):
+        """Estimate the memory held by the engine in bytes."""
+        size = sum(array.nbytes for array in self.columns.values())
+        size += sum(index.memory_usage() for index in self.bitmaps.values())
+        size += sum(facet.memory_usage() for facet in self.facets.values())
+        size += sum(sys.getsizeof(values) for lists in self.lists.values() for values in lists)
+        return size
+
+def _legacy_filter(imgview_data, favorites, rating, ascore, tags):
+    # The filter of apply_filter before the engine, for comparison
+    filtered_df = imgview_data.copy()
+    filtered_df = filtered_df[filtered_df["Favorites"] == favorites]
+    filtered_df["Rating"] = filtered_df["Rating"].astype(int)
+    filtered_df = filtered_df[filtered_df["Rating"] >= rating]
+    filtered_df = filtered_df[filtered_df["Tags"].apply(lambda x: [x] if not isinstance(x, list) else x).apply(lambda x: any(tag in x for tag in tags))]
+    filtered_df["Aesthetic_score"] = filtered_df["Aesthetic_score"].astype(int)
+    filtered_df = filtered_df[filtered_df["Aesthetic_score"] >= ascore]
+    return set(filtered_df.index)
+
+def _benchmark(count):
+    rng = np.random.default_rng(0)
+    vocabulary = [f"tag{i}" for i in range(200)]
+    tag_lists = [list(rng.choice(vocabulary, size=n, replace=False)) for n in rng.integers(0, 4, count)]
+    df = pd.DataFrame({"Favorites": rng.random(count) < 0.1,
+                       "Rating": rng.integers(0, 6, count),
+                       "Tags": tag_lists,
+                       "Categorization": [[] for _ in range(count)],
+                       "Reviewed": rng.random(count) < 0.5,
+                       "Todelete": False,
+                       "Path": [f"/images/{i:07d}.png" for i in range(count)],
+                       "Aesthetic_score": rng.uniform(3, 8, count)},
+                      index=pd.Index([f"{i:064x}" for i in range(count)], name="sha256"))
+
+    exif = pd.DataFrame({"Model": pd.Categorical.from_codes(rng.integers(0, 12, count), [f"model{i}" for i in range(12)]),
+                         "Sampler": pd.Categorical.from_codes(rng.integers(0, 8, count), [f"sampler{i}" for i in range(8)]),
+                         "Steps": pd.array(rng.integers(10, 60, count), dtype="Int16"),
+                         "CFG scale": pd.array(rng.integers(8, 24, count) / 2, dtype="Float64")},
+                        index=df.index)
+
+    start_time = time.perf_counter()
+    engine = FilterEngine(df, exif)
+    print(f"{count} images: built in {time.perf_counter() - start_time:.2f} seconds, {engine.memory_usage() / 2**20:.0f} MB")
+
+    queries = {"favorites": dict(favorites=True),
+               "rating >= 4": dict(min_rating=4),
+               "favorites, rating >= 3, ascore >= 6": dict(favorites=True, min_rating=3, min_ascore=6),
+               "tag7 or tag8": dict(tags=["tag7", "tag8"]),
+               "tag7 and tag8": dict(tags=["+tag7", "+tag8"]),
+               "tag7 but not tag8, unfavorited": dict(favorites=False, tags=["tag7", "-tag8"]),
+               "favorites, rating >= 3, ascore >= 6": dict(favorites=True, min_rating=3, min_ascore=6),
+               "all of the above and a tag": dict(favorites=True, min_rating=3, min_ascore=6, tags=["tag7", "tag8"])}
+    for name, query in queries.items():
+        start_time = time.perf_counter()
+        positions = engine.query(**query)
+        elapsed = time.perf_counter() - start_time
+        print(f"{name:>36}: {len(positions):7d} images in {1000 * elapsed:7.1f} ms")
+
+    start_time = time.perf_counter()
+    legacy = _legacy_filter(df, True, 3, 6, ["tag7", "tag8"])
+    elapsed = time.perf_counter() - start_time
+    assert legacy == set(engine.keys_at(positions)), "The engine and the legacy filter disagree"
+    print(f"{'legacy pandas filter':>36}: {len(legacy):7d} images in {1000 * elapsed:7.1f} ms")
+
+    start_time = time.perf_counter()
+    counts = engine.counts("Tags")
+    elapsed = time.perf_counter() - start_time
+    print(f"{'count of every tag':>36}: {len(counts):7d} tags in {1000 * elapsed:7.1f} ms")
+    bits = engine.query_bits(min_rating=4)
+    start_time = time.perf_counter()
+    counts = engine.counts("Tags", bits)
+    elapsed = time.perf_counter() - start_time
+    print(f"{'count of every tag, rating >= 4':>36}: {len(counts):7d} tags in {1000 * elapsed:7.1f} ms")
+
+    start_time = time.perf_counter()
+    facets = engine.facet_counts()
+    elapsed = time.perf_counter() - start_time
+    print(f"{'facet counts':>36}: {sum(len(v) for v in facets.values()):7d} values in {1000 * elapsed:7.1f} ms")
+    for name, query in (("rating >= 4", dict(min_rating=4)), ("tag7 or tag8", dict(tags=["tag7", "tag8"]))):
+        positions = engine.query(**query)
+        start_time = time.perf_counter()
+        facets = engine.facet_counts(positions)
+        elapsed = time.perf_counter() - start_time
+        assert facets["Rating"] == [(r, c, int((engine.column("Rating")[positions] == r).sum())) for r, c, _ in facets["Rating"]]
+        print(f"{'facet counts, ' + name:>36}: {len(positions):7d} images in {1000 * elapsed:7.1f} ms")
+    start_time = time.perf_counter()
+    engine.set_exif(exif.iloc[:5000])
+    elapsed = time.perf_counter() - start_time
+    print(f"{'counting 5000 new EXIF rows':>36}: {1000 * elapsed:7.1f} ms")
+
+    start_time = time.perf_counter()
+    for i in range(1000):
+        engine.set(f"{i:064x}", Tags=["tag1", f"new{i}"], Rating=5, Favorites=True)
+    elapsed = time.perf_counter() - start_time
+    assert set(engine.keys_at(engine.query(tags=["+tag1", "+new7"]))) == {f"{7:064x}"}
+    print(f"{'edits':>36}: {1e6 * elapsed / 1000:7.1f} us/edit")
+
+if __name__ == "__main__":
+    _benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
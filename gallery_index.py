@@ -0,0 +1,139 @@
+"""
+In-memory lookup structures for the images of the viewing directory.
+"""
+
+import bisect
+import hashlib
+
+def path_sha256(path):
+    """Compute the sha256 key of an image path, as used to index the metadata tables.
+
+    Args:
+        path (str): Path of the image.
+
+    Returns:
+        str: The hex digest of the sha256 of the path.
+    """
+    return hashlib.sha256(path.encode()).hexdigest()
+
+class NavigationIndex():
+    """Position and sha256 lookups for the current image listing.
+
+    The index is rebuilt every time the listing is filtered or reset, so next/prev and
+    jumping to an image by name are dictionary lookups instead of scans of the listing.
+    The sha256 keys of paths are remembered across rebuilds, so each path is only hashed
+    once.
+
+    Args:
+        images (list, optional): The initial image listing.
+    """
+    def __init__(self, images=()) -> None:
+        self.images = []
+        self.positions = {}
+        self.hashes = {}
+        self.paths = {}
+        self.rebuild(images)
+
+    def rebuild(self, images):
+        """Replace the listing the index is built over.
+
+        Args:
+            images (list): Paths of the images in viewing order.
+        """
+        self.images = list(images)
+        self.positions = {path: position for position, path in enumerate(self.images)}
+        for path in self.images:
+            if path not in self.hashes:
+                sha256 = path_sha256(path)
+                self.hashes[path] = sha256
+                self.paths[sha256] = path
+
+    def __len__(self):
+        return len(self.images)
+
+    def __contains__(self, path):
+        return path in self.positions
+
+    def position(self, path):
+        """Get the position of an image in the listing, or None if it is not listed."""
+        return self.positions.get(path)
+
+    def path(self, position):
+        """Get the path of the image at a position in the listing."""
+        return self.images[position]
+
+    def sha256(self, path):
+        """Get the sha256 key of an image path."""
+        sha256 = self.hashes.get(path)
+        if sha256 is None:
+            sha256 = path_sha256(path)
+        return sha256
+
+    def path_for_sha256(self, sha256):
+        """Get the path of an image by its sha256 key, or None if the image is unknown."""
+        return self.paths.get(sha256)
+
+class Vocabulary():
+    """The distinct values of a list column (tags or categories) with their use counts.
+
+    The values are kept sorted case-insensitively, so prefix completion is a binary
+    search. Adding and removing a value is done incrementally by the edit routes.
+
+    Args:
+        value_lists (iterable, optional): Lists of values to count, one per image.
+    """
+    def __init__(self, value_lists=()) -> None:
+        self.counts = {}
+        self.sorted_keys = []
+        for values in value_lists:
+            self.add_many(values)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __iter__(self):
+        return (value for _, value in self.sorted_keys)
+
+    def add(self, value):
+        """Count one more use of a value."""
+        count = self.counts.get(value, 0)
+        if count == 0:
+            bisect.insort(self.sorted_keys, (value.casefold(), value))
+        self.counts[value] = count + 1
+
+    def add_many(self, values):
+        for value in values:
+            self.add(value)
+
+    def remove(self, value):
+        """Count one less use of a value, dropping it when it is no longer used."""
+        count = self.counts.get(value, 0)
+        if count <= 1:
+            self.counts.pop(value, None)
+            key = (value.casefold(), value)
+            i = bisect.bisect_left(self.sorted_keys, key)
+            if i < len(self.sorted_keys) and self.sorted_keys[i] == key:
+                del self.sorted_keys[i]
+        else:
+            self.counts[value] = count - 1
+
+    def complete(self, prefix, limit=20):
+        """Get the values starting with a prefix, ignoring case.
+
+        Args:
+            prefix (str): The prefix to complete.
+            limit (int, optional): The maximum number of values to return. Defaults to 20.
+
+        Returns:
+            list: The matching values in sorted order.
+        """
+        prefix = prefix.casefold()
+        i = bisect.bisect_left(self.sorted_keys, (prefix, ""))
+        matches = []
+        while i < len(self.sorted_keys) and len(matches) < limit:
+            key, value = self.sorted_keys[i]
+            if not key.startswith(prefix):
+                break
+            matches.append(value)
+            i += 1
+        return matches
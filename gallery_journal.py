@@ -0,0 +1,226 @@
+"""
+An append-only journal of metadata edits in front of the metadata store.
+
+Edits made in the viewer (favorites, ratings, tags, ...) are appended to the journal as
+one JSON line each, which only costs a buffered write on the request path. A background
+thread fsyncs the journal in batches every `SYNC_INTERVAL` seconds, so a burst of edits
+shares one fsync, and compacts it into the store once no edit came in for
+`COMPACT_DELAY` seconds, or at the latest `MAX_COMPACT_DELAY` seconds after the oldest
+edit that is not compacted yet. Compacting merges the edits per image, writes them in a
+single transaction and then empties the journal.
+
+A journal left behind by a crash is replayed when the store is opened. A line torn by
+the crash is skipped.
+
+Usage:
+    python gallery_journal.py [number of edits]
+"""
+
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+JOURNAL_NAME = "edits.journal"
+SYNC_INTERVAL = 0.05
+COMPACT_DELAY = 2.0
+MAX_COMPACT_DELAY = 30.0
+
+logger = logging.getLogger(__name__)
+
+def _json_default(value):
+    if hasattr(value, 'item'):
+        # numpy scalars
+        return value.item()
+    if isinstance(value, (set, tuple)):
+        return list(value)
+    raise TypeError(f"Cannot journal a {type(value).__name__}")
+
+def merge_edits(entries):
+    """Merge journal entries into one set of fields per image, later edits winning.
+
+    Args:
+        entries (list): (sha256, fields) tuples in the order they were made.
+
+    Returns:
+        dict: The merged fields by sha256 key.
+    """
+    rows = {}
+    for sha256, fields in entries:
+        rows.setdefault(sha256, {}).update(fields)
+    return rows
+
+class EditJournal():
+    """The journal file of an image folder and its background writer.
+
+    Args:
+        path (Path): The journal file.
+        apply (callable): Called with the merged edits by sha256 key to write them to the
+            store. The edits are only removed from the journal once it returns.
+        sync_interval (float, optional): Seconds between batched fsyncs.
+        compact_delay (float, optional): Seconds without edits before compacting.
+        max_compact_delay (float, optional): Seconds after which edits are compacted even
+            while more keep coming in.
+    """
+    def __init__(self, path, apply, sync_interval=SYNC_INTERVAL, compact_delay=COMPACT_DELAY, max_compact_delay=MAX_COMPACT_DELAY) -> None:
+        self.path = Path(path)
+        self.apply = apply
+        self.sync_interval = sync_interval
+        self.compact_delay = compact_delay
+        self.max_compact_delay = max_compact_delay
+        self.lock = threading.Lock()
+        self.compact_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pending = []
+        self.unsynced = False
+        self.first_edit = None
+        self.last_edit = None
+        self.closed = False
+        self.pending.extend(self._read())
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.thread = threading.Thread(target=self._run, name=f"journal-{self.path.parent.name}", daemon=True)
+        self.thread.start()
+
+    def _read(self):
+        entries = []
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        entries.append((entry["sha256"], entry["fields"]))
+                    except (ValueError, KeyError, TypeError):
+                        logger.warning(f"Skipping a damaged line of {self.path}")
+        except FileNotFoundError:
+            pass
+        if entries:
+            logger.info(f"Replaying {len(entries)} edits from {self.path}")
+        return entries
+
+    def __len__(self):
+        return len(self.pending)
+
+    def append(self, sha256, fields):
+        """Record an edit.
+
+        Args:
+            sha256 (str): The sha256 key of the image path.
+            fields (dict): The metadata columns that were set.
+        """
+        line = json.dumps({"sha256": sha256, "fields": fields}, default=_json_default) + "\n"
+        now = time.monotonic()
+        with self.lock:
+            if self.closed:
+                raise ValueError(f"The journal {self.path} is closed")
+            self.file.write(line)
+            self.file.flush()
+            self.pending.append((sha256, fields))
+            self.unsynced = True
+            self.last_edit = now
+            if self.first_edit is None:
+                self.first_edit = now
+        self.wakeup.set()
+
+    def sync(self):
+        """Flush the journal to disk."""
+        with self.lock:
+            if self.unsynced and not self.closed:
+                os.fsync(self.file.fileno())
+                self.unsynced = False
+
+    def compact(self):
+        """Write the edits in the journal to the store and empty the journal."""
+        with self.compact_lock:
+            with self.lock:
+                entries = list(self.pending)
+            if not entries:
+                return
+            start_time = time.perf_counter()
+            self.apply(merge_edits(entries))
+            with self.lock:
+                # Keep what was appended while the store was written
+                self.pending = self.pending[len(entries):]
+                self._rewrite()
+                self.first_edit = self.last_edit if self.pending else None
+            logger.debug(f"Compacted {len(entries)} edits into the store in {time.perf_counter() - start_time:.3f} seconds")
+
+    def _rewrite(self):
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for sha256, fields in self.pending:
+                f.write(json.dumps({"sha256": sha256, "fields": fields}, default=_json_default) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.file.close()
+        os.replace(tmp_path, self.path)
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.unsynced = False
+
+    def _due(self):
+        with self.lock:
+            if self.first_edit is None:
+                return False
+            now = time.monotonic()
+            return now - self.last_edit >= self.compact_delay or now - self.first_edit >= self.max_compact_delay
+
+    def _run(self):
+        while not self.closed:
+            self.wakeup.wait(self.compact_delay)
+            self.wakeup.clear()
+            # Let the edits of a burst pile up, then sync them together
+            time.sleep(self.sync_interval)
+            try:
+                self.sync()
+                if self._due():
+                    self.compact()
+            except Exception as e:
+                if not self.closed:
+                    logger.error(f"Writing the journal {self.path} failed: {e}")
+
+    def close(self):
+        """Compact the journal and stop its background writer."""
+        self.compact()
+        with self.lock:
+            self.closed = True
+            self.file.close()
+        self.wakeup.set()
+
+if __name__ == "__main__":
+    # Cost of recording an edit in the journal against updating the store row directly
+    import gallery_store
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in (1000, 100000):
+            store = gallery_store.MetadataStore(Path(tmp) / f"{size}.db", journal=False)
+            keys = [f"{i:064x}" for i in range(size)]
+            store.connection.execute("BEGIN")
+            store.connection.executemany("INSERT INTO imgview_metadata (sha256, Path) VALUES (?, ?)", [(k, k) for k in keys])
+            store.connection.execute("COMMIT")
+
+            start_time = time.perf_counter()
+            for i in range(count):
+                store.update_metadata(keys[i % size], Rating=i % 6)
+            direct = (time.perf_counter() - start_time) / count
+            # The same with every edit synced to disk, which the journal does in batches
+            store.connection.execute("PRAGMA synchronous=FULL")
+            start_time = time.perf_counter()
+            for i in range(count // 100):
+                store.update_metadata(keys[i % size], Rating=i % 6)
+            durable = (time.perf_counter() - start_time) / (count // 100)
+            store.connection.execute("PRAGMA synchronous=NORMAL")
+
+            journal = EditJournal(Path(tmp) / f"{size}.journal", lambda rows: store.update_metadata_many(rows))
+            start_time = time.perf_counter()
+            for i in range(count):
+                journal.append(keys[i % size], {"Rating": i % 6})
+            journaled = (time.perf_counter() - start_time) / count
+            start_time = time.perf_counter()
+            journal.close()
+            compacted = time.perf_counter() - start_time
+            store.close()
+            print(f"{size:7d} images: store update {1e6 * direct:6.1f} us/edit ({1e6 * durable:.0f} us synced), "
+                  f"journal append {1e6 * journaled:5.1f} us/edit, compacting {count} edits {1000 * compacted:.0f} ms")
@@ -0,0 +1,212 @@
+"""
+Keeping the libraries opened with /browse loaded, so switching back to one is instant.
+
+A `LibraryState` holds everything that is loaded for one image folder: the listing and
+its navigation index, the EXIF and metadata tables, the tag and category vocabularies,
+the filter engine, the similarity index and the open metadata store. When another
+folder is opened, the state of the current one is put into the `LibraryCache` instead
+of being dropped. Opening it again takes it back out, so only the folder scan runs
+again.
+
+The cache is bounded by a memory budget and evicts the least recently used states
+first. Edits are recorded in the store's edit journal as they are made, so evicting a
+state only has to compact the journal, fold the store's write-ahead log back into the
+database and close it.
+
+The open library is shared by the request threads of the production server and the
+background tasks. `RWLock` lets any number of them read it at a time, while edits and
+the tasks replacing its tables get it to themselves.
+"""
+
+import logging
+import os
+import sys
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Rough size of a dict entry, with the key and value stored elsewhere
+DICT_ENTRY_SIZE = 100
+
+logger = logging.getLogger(__name__)
+
+class RWLock():
+    """A lock that is held by any number of readers or by one writer.
+
+    Readers that arrive while a writer is waiting wait as well, so a steady stream of
+    readers cannot starve the writers. The writer may take the lock again, for reading
+    or writing, while it holds it. Readers must not, as a waiting writer would keep
+    them out.
+    """
+    def __init__(self) -> None:
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writer = None
+        self.write_depth = 0
+        self.waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        if self.writer == threading.get_ident():
+            yield
+            return
+        with self.condition:
+            while self.writer is not None or self.waiting_writers:
+                self.condition.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                if self.readers == 0:
+                    self.condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        me = threading.get_ident()
+        with self.condition:
+            if self.writer != me:
+                self.waiting_writers += 1
+                while self.writer is not None or self.readers:
+                    self.condition.wait()
+                self.waiting_writers -= 1
+                self.writer = me
+            self.write_depth += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.write_depth -= 1
+                if self.write_depth == 0:
+                    self.writer = None
+                    self.condition.notify_all()
+
+def _frame_size(df):
+    if df is None or not hasattr(df, 'memory_usage'):
+        return 0
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+class LibraryState():
+    """The loaded state of one image folder.
+
+    Args:
+        image_folder (Path): The image folder.
+        metadata_subdir (Path): The metadata folder of the image folder.
+        thumbnail_folder (Path): The thumbnail folder of the image folder.
+        metadata_store (gallery_store.MetadataStore): The open metadata store.
+        bulk_exif_data (pandas.DataFrame): The EXIF table.
+        imgview_data (pandas.DataFrame): The metadata table.
+        filtered_images (list): The images being viewed, in viewing order.
+        active_filters (list): The filters the images being viewed were selected with.
+        navigation (gallery_index.NavigationIndex): The navigation index over filtered_images.
+        tag_vocabulary (gallery_index.Vocabulary): The tags in use.
+        category_vocabulary (gallery_index.Vocabulary): The categories in use.
+        filter_engine (gallery_filter.FilterEngine): The filter columns of the metadata table.
+        similarity_index (gallery_similar.SimilarityIndex): The similarity index, or None
+            if it has not been built.
+    """
+    def __init__(self, image_folder, metadata_subdir, thumbnail_folder, metadata_store, bulk_exif_data, imgview_data,
+                 filtered_images, active_filters, navigation, tag_vocabulary, category_vocabulary, filter_engine,
+                 similarity_index) -> None:
+        self.image_folder = image_folder
+        self.metadata_subdir = metadata_subdir
+        self.thumbnail_folder = thumbnail_folder
+        self.metadata_store = metadata_store
+        self.bulk_exif_data = bulk_exif_data
+        self.imgview_data = imgview_data
+        self.filtered_images = filtered_images
+        self.active_filters = active_filters
+        self.navigation = navigation
+        self.tag_vocabulary = tag_vocabulary
+        self.category_vocabulary = category_vocabulary
+        self.filter_engine = filter_engine
+        self.similarity_index = similarity_index
+
+    def memory_usage(self):
+        """Estimate the memory held by the state in bytes."""
+        size = _frame_size(self.bulk_exif_data) + _frame_size(self.imgview_data)
+        size += sum(sys.getsizeof(path) for path in self.filtered_images)
+        # The navigation index keeps a sha256 string and three dict entries per path
+        size += len(self.navigation.hashes) * (sys.getsizeof("0" * 64) + 3 * DICT_ENTRY_SIZE)
+        # The keys and paths of the filter engine are shared with the tables and the listing
+        size += self.filter_engine.memory_usage() + len(self.filter_engine) * 3 * DICT_ENTRY_SIZE
+        if self.similarity_index is not None:
+            size += self.similarity_index.embeddings.nbytes
+        return size
+
+    def close(self):
+        """Write the pending edits and the metadata store back to its database file and close it."""
+        if self.metadata_store is not None:
+            self.metadata_store.checkpoint()
+            self.metadata_store.close()
+            self.metadata_store = None
+
+class LibraryCache():
+    """Library states by image folder, least recently used first out.
+
+    Args:
+        budget (int): The memory budget in bytes. States are evicted until the cached
+            ones fit in it, so with a budget of 0 nothing is kept.
+    """
+    def __init__(self, budget) -> None:
+        self.budget = budget
+        self.states = OrderedDict()
+        self.sizes = {}
+
+    @staticmethod
+    def key(folder):
+        return os.path.abspath(folder)
+
+    def __len__(self):
+        return len(self.states)
+
+    def __contains__(self, folder):
+        return self.key(folder) in self.states
+
+    @property
+    def size(self):
+        return sum(self.sizes.values())
+
+    def put(self, state):
+        """Add the state of a library that is being switched away from.
+
+        Args:
+            state (LibraryState): The state, which the cache now owns.
+        """
+        key = self.key(state.image_folder)
+        old = self.states.pop(key, None)
+        if old is not None and old is not state:
+            old.close()
+        self.states[key] = state
+        self.sizes[key] = state.memory_usage()
+        logger.debug(f"Cached library {key} ({self.sizes[key] / 2**20:.1f} MB)")
+        self._evict()
+
+    def pop(self, folder):
+        """Take the state of a library out of the cache.
+
+        Args:
+            folder (Path): The image folder.
+
+        Returns:
+            LibraryState: The state, or None if the folder is not cached.
+        """
+        key = self.key(folder)
+        self.sizes.pop(key, None)
+        return self.states.pop(key, None)
+
+    def clear(self):
+        """Evict all states."""
+        while self.states:
+            self._evict_oldest()
+
+    def _evict(self):
+        while self.states and self.size > self.budget:
+            self._evict_oldest()
+
+    def _evict_oldest(self):
+        key, state = self.states.popitem(last=False)
+        size = self.sizes.pop(key)
+        logger.info(f"Evicting library {key} ({size / 2**20:.1f} MB) from the library cache")
+        state.close()
@@ -0,0 +1,147 @@
+"""
+Incremental scanning of an image folder.
+
+A manifest with the mtime of every directory and the (size, mtime) of every image in it
+is persisted next to the metadata of the folder. A rescan walks the tree with
+`os.scandir` and only lists directories whose mtime has changed since the manifest was
+written; unchanged directories reuse their entries from the manifest. The result holds
+the full listing together with the images that were added, removed or changed, so the
+rest of the pipeline can limit itself to the difference.
+
+Note that overwriting a file in place does not change the mtime of its directory, so
+such a change is only picked up once something else in the directory changes.
+"""
+
+import json
+import logging
+import os
+from pathlib import Path
+
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+logger = logging.getLogger(__name__)
+
+class ScanResult():
+    """The outcome of a folder scan.
+
+    Args:
+        images (list): Paths of all images found.
+        added (set): Paths of images that are new since the last scan.
+        removed (set): Paths of images that are gone since the last scan.
+        changed (set): Paths of images whose size or mtime changed since the last scan.
+    """
+    def __init__(self, images, added, removed, changed) -> None:
+        self.images = images
+        self.added = added
+        self.removed = removed
+        self.changed = changed
+
+    def __repr__(self):
+        return f"ScanResult(images={len(self.images)}, added={len(self.added)}, removed={len(self.removed)}, changed={len(self.changed)})"
+
+def load_manifest(manifest_path, root):
+    """Load the directory entries of a manifest, or an empty dict if it is missing or stale."""
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if manifest.get("version") != MANIFEST_VERSION or manifest.get("root") != root:
+        return {}
+    return manifest.get("dirs", {})
+
+def save_manifest(manifest_path, root, dirs):
+    manifest_path = Path(manifest_path)
+    tmp_path = manifest_path.with_name(manifest_path.name + ".tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"version": MANIFEST_VERSION, "root": root, "dirs": dirs}, f)
+    os.replace(tmp_path, manifest_path)
+
+def _list_directory(path, is_valid_image):
+    files = {}
+    subdirs = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    subdirs.append(entry.name)
+                elif entry.is_file() and is_valid_image(entry.name):
+                    st = entry.stat()
+                    files[entry.name] = [st.st_size, st.st_mtime_ns]
+            except OSError as e:
+                logger.warning(f"Could not read {entry.path}: {e}")
+    return files, subdirs
+
+def scan_directories(root, old_dirs, is_valid_image):
+    """Scan a folder recursively against the directory entries of a previous scan.
+
+    Args:
+        root (str): The folder to scan.
+        old_dirs (dict): The directory entries of the previous scan, empty for a first scan.
+        is_valid_image (callable): Called with a file name, returns whether it is an image.
+
+    Returns:
+        tuple: The ScanResult and the directory entries of this scan.
+    """
+    new_dirs = {}
+    images = []
+    added = set()
+    removed = set()
+    changed = set()
+    listed = 0
+
+    stack = [root]
+    while stack:
+        path = stack.pop()
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError as e:
+            logger.warning(f"Could not read {path}: {e}")
+            continue
+        old = old_dirs.get(path)
+        if old is not None and old["mtime_ns"] == mtime_ns:
+            files, subdirs = old["files"], old["subdirs"]
+        else:
+            listed += 1
+            try:
+                files, subdirs = _list_directory(path, is_valid_image)
+            except OSError as e:
+                logger.warning(f"Could not list {path}: {e}")
+                continue
+            old_files = old["files"] if old is not None else {}
+            for name, entry in files.items():
+                old_entry = old_files.get(name)
+                if old_entry is None:
+                    added.add(os.path.join(path, name))
+                elif list(old_entry) != entry:
+                    changed.add(os.path.join(path, name))
+            removed.update(os.path.join(path, name) for name in old_files.keys() - files.keys())
+        new_dirs[path] = {"mtime_ns": mtime_ns, "files": files, "subdirs": subdirs}
+        images.extend(os.path.join(path, name) for name in files)
+        stack.extend(os.path.join(path, name) for name in subdirs)
+
+    # Directories that disappeared take their images with them
+    for path in old_dirs.keys() - new_dirs.keys():
+        removed.update(os.path.join(path, name) for name in old_dirs[path]["files"])
+
+    logger.debug(f"Listed {listed} of {len(new_dirs)} directories in {root}")
+    return ScanResult(images, added, removed, changed), new_dirs
+
+def scan_folder(folder, manifest_path, is_valid_image):
+    """Scan an image folder recursively, using and updating its manifest.
+
+    Args:
+        folder (Path): The image folder.
+        manifest_path (Path): Where the manifest of the folder is stored.
+        is_valid_image (callable): Called with a file name, returns whether it is an image.
+
+    Returns:
+        ScanResult: The images found and the difference to the previous scan.
+    """
+    root = str(Path(folder))
+    old_dirs = load_manifest(manifest_path, root)
+    scan, new_dirs = scan_directories(root, old_dirs, is_valid_image)
+    if scan.added or scan.removed or scan.changed or new_dirs.keys() != old_dirs.keys():
+        save_manifest(manifest_path, root, new_dirs)
+    return scan
@@ -0,0 +1,421 @@
+"""
+SQLite storage for the image metadata and EXIF data of an image folder.
+
+Each image folder gets one database file in its metadata folder. It holds the
+imgview_metadata table (favorites, ratings, tags, ...) and the exif table. The
+database runs in WAL mode, so single edits are written row by row instead of
+rewriting the whole table. The DataFrames that the viewer works with are loaded from
+it on startup.
+
+Edits made in the viewer go through the edit journal of gallery_journal, which appends
+them to a file next to the database and compacts them into the imgview_metadata table
+in the background. Reading or bulk writing the table compacts the journal first.
+
+The positive and negative prompts are also kept in an FTS5 full-text index, which
+`search_prompts` queries instead of scanning every prompt for a substring.
+
+The CSV files written by earlier versions (imgview_metadata.csv and exif_df.csv) are
+migrated into the database the first time it is opened.
+"""
+
+import ast
+import json
+import logging
+import math
+import re
+import sqlite3
+import threading
+from pathlib import Path
+import pandas as pd
+
+import gallery_exif
+import gallery_journal
+
+DATABASE_NAME = "promptvision.db"
+
+METADATA_COLUMNS = ['Favorites', 'Rating', 'Tags', 'Categorization', 'Reviewed', 'Todelete', 'Path', 'Aesthetic_score']
+BOOL_COLUMNS = ['Favorites', 'Reviewed', 'Todelete']
+LIST_COLUMNS = ['Tags', 'Categorization']
+PROMPT_FIELDS = {'both': '{positive negative}', 'positive': 'positive', 'negative': 'negative'}
+
+QUERY_TOKEN_REGEX = re.compile(r'"([^"]*)"|(\S+)')
+QUERY_WORD_REGEX = re.compile(r'\w+')
+
+logger = logging.getLogger(__name__)
+
+def _literal_list(x):
+    return ast.literal_eval(x) if isinstance(x, str) else []
+
+def _to_sql_value(column, value):
+    if column in LIST_COLUMNS:
+        return json.dumps(list(value) if isinstance(value, (list, tuple, set)) else [])
+    if column in BOOL_COLUMNS:
+        return int(bool(value))
+    if column == 'Rating':
+        return int(value) if value is not None and value == value else 0
+    if column == 'Aesthetic_score':
+        return float(value) if value is not None and not (isinstance(value, float) and math.isnan(value)) else None
+    return value
+
+def _fts_rowid(sha256):
+    # A stable integer key for the full-text index, so rows can be replaced by rowid
+    return int(sha256[:15], 16)
+
+def _prompt_text(value):
+    return value if isinstance(value, str) and value != 'No data found' else ''
+
+def build_match_query(query):
+    """Turn a search box query into an FTS5 match expression.
+
+    Words are matched as terms, "quoted text" as a phrase and a word ending in * as a
+    prefix. All parts have to match. Punctuation that FTS5 would read as query syntax
+    is dropped.
+
+    Args:
+        query (str): The search query.
+
+    Returns:
+        str: The FTS5 expression, or an empty string if the query has no words.
+    """
+    parts = []
+    for phrase, word in QUERY_TOKEN_REGEX.findall(query):
+        if phrase:
+            words = QUERY_WORD_REGEX.findall(phrase)
+            if words:
+                parts.append('"' + " ".join(words) + '"')
+        else:
+            words = QUERY_WORD_REGEX.findall(word)
+            for i, w in enumerate(words):
+                prefix = word.endswith("*") and i == len(words) - 1
+                parts.append(f'"{w}"' + ("*" if prefix else ""))
+    return " ".join(parts)
+
+def _to_json_value(value):
+    if value is pd.NA or (isinstance(value, float) and math.isnan(value)):
+        return None
+    if hasattr(value, 'item'):
+        # numpy scalars
+        return value.item()
+    return value
+
+class MetadataStore():
+    """SQLite database holding the metadata and EXIF data of one image folder.
+
+    The connection is shared between the request threads, so every statement runs
+    under a lock.
+
+    Args:
+        db_path (Path): Path of the database file.
+    """
+    def __init__(self, db_path, journal=True) -> None:
+        self.db_path = Path(db_path)
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS imgview_metadata (
+            sha256 TEXT PRIMARY KEY,
+            Favorites INTEGER NOT NULL DEFAULT 0,
+            Rating INTEGER NOT NULL DEFAULT 0,
+            Tags TEXT NOT NULL DEFAULT '[]',
+            Categorization TEXT NOT NULL DEFAULT '[]',
+            Reviewed INTEGER NOT NULL DEFAULT 0,
+            Todelete INTEGER NOT NULL DEFAULT 0,
+            Path TEXT,
+            Aesthetic_score REAL)""")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS exif (sha256 TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS store_info (key TEXT PRIMARY KEY, value TEXT)")
+        try:
+            self.connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS prompt_fts USING fts5(sha256 UNINDEXED, positive, negative)")
+            self.fts_available = True
+        except sqlite3.OperationalError as e:
+            logger.warning(f"SQLite has no FTS5 support, prompt search falls back to scanning: {e}")
+            self.fts_available = False
+        self.journal = None
+        if journal:
+            self.journal = gallery_journal.EditJournal(self.db_path.with_name(gallery_journal.JOURNAL_NAME), self.update_metadata_many)
+            # Edits left behind by a crash
+            self.journal.compact()
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+        with self.lock:
+            self.connection.close()
+
+    def record_edit(self, sha256, **fields):
+        """Record an edit of a metadata row in the edit journal.
+
+        The row is updated, or inserted when it is missing, once the journal is compacted.
+
+        Args:
+            sha256 (str): The sha256 key of the image path.
+            **fields: Column values to set.
+        """
+        if self.journal is None:
+            self.update_metadata(sha256, **fields)
+            return
+        self.journal.append(sha256, {c: v for c, v in fields.items() if c in METADATA_COLUMNS})
+
+    def compact_journal(self):
+        """Write the edits in the edit journal to the imgview_metadata table."""
+        if self.journal is not None:
+            self.journal.compact()
+
+    def checkpoint(self):
+        """Compact the edit journal and fold the write-ahead log back into the database file."""
+        self.compact_journal()
+        with self.lock:
+            self.connection.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def get_info(self, key, default=None):
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM store_info WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_info(self, key, value):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO store_info (key, value) VALUES (?, ?)", (key, value))
+
+    def load_metadata(self):
+        """Load the imgview_metadata table.
+
+        Returns:
+            pandas.DataFrame: The metadata indexed by sha256, with Tags and Categorization as lists.
+        """
+        self.compact_journal()
+        with self.lock:
+            df = pd.read_sql_query("SELECT * FROM imgview_metadata", self.connection, index_col='sha256')
+        for column in LIST_COLUMNS:
+            df[column] = [json.loads(x) for x in df[column]]
+        for column in BOOL_COLUMNS:
+            df[column] = df[column].astype(bool)
+        if df['Aesthetic_score'].isna().all():
+            # Only keep the column when the images have been scored
+            df = df.drop(columns='Aesthetic_score')
+        return df
+
+    def save_metadata(self, df):
+        """Insert or replace metadata rows.
+
+        Args:
+            df (pandas.DataFrame): Metadata rows indexed by sha256.
+        """
+        self.compact_journal()
+        if df is None or len(df) == 0:
+            return
+        columns = [c for c in METADATA_COLUMNS if c in df.columns]
+        rows = [(sha256, *[_to_sql_value(c, v) for c, v in zip(columns, values)])
+                for sha256, values in zip(df.index, df[columns].itertuples(index=False, name=None))]
+        quoted = ", ".join(columns)
+        placeholders = ", ".join("?" * (len(columns) + 1))
+        with self.lock:
+            self.connection.execute("BEGIN")
+            self.connection.executemany(f"INSERT OR REPLACE INTO imgview_metadata (sha256, {quoted}) VALUES ({placeholders})", rows)
+            self.connection.execute("COMMIT")
+
+    def update_metadata(self, sha256, **fields):
+        """Update columns of a single metadata row, inserting the row when it is missing.
+
+        Args:
+            sha256 (str): The sha256 key of the image path.
+            **fields: Column values to set.
+        """
+        with self.lock:
+            self._upsert(sha256, fields)
+
+    def update_metadata_many(self, rows):
+        """Update columns of many metadata rows in one transaction, inserting missing rows.
+
+        The transaction is synced to disk, as the edit journal is emptied after it.
+
+        Args:
+            rows (dict): Column values to set by sha256 key.
+        """
+        with self.lock:
+            self.connection.execute("PRAGMA synchronous=FULL")
+            try:
+                self.connection.execute("BEGIN")
+                for sha256, fields in rows.items():
+                    self._upsert(sha256, fields)
+                self.connection.execute("COMMIT")
+            finally:
+                self.connection.execute("PRAGMA synchronous=NORMAL")
+
+    def _upsert(self, sha256, fields):
+        columns = [c for c in fields if c in METADATA_COLUMNS]
+        if not columns:
+            return
+        values = [_to_sql_value(c, fields[c]) for c in columns]
+        updates = ", ".join(f"{c} = excluded.{c}" for c in columns)
+        self.connection.execute(
+            f"INSERT INTO imgview_metadata (sha256, {', '.join(columns)}) VALUES ({', '.join('?' * (len(columns) + 1))}) "
+            f"ON CONFLICT(sha256) DO UPDATE SET {updates}", (sha256, *values))
+
+    def update_column(self, column, values):
+        """Set one column of many existing metadata rows.
+
+        Args:
+            column (str): The column to set.
+            values (dict): The column values by sha256 key.
+        """
+        if column not in METADATA_COLUMNS:
+            raise ValueError(f"Unknown metadata column {column}")
+        self.compact_journal()
+        rows = [(_to_sql_value(column, value), sha256) for sha256, value in values.items()]
+        with self.lock:
+            self.connection.execute("BEGIN")
+            self.connection.executemany(f"UPDATE imgview_metadata SET {column} = ? WHERE sha256 = ?", rows)
+            self.connection.execute("COMMIT")
+
+    def delete_metadata(self, sha256_keys):
+        self.compact_journal()
+        with self.lock:
+            self.connection.execute("BEGIN")
+            self.connection.executemany("DELETE FROM imgview_metadata WHERE sha256 = ?", [(k,) for k in sha256_keys])
+            self.connection.execute("COMMIT")
+
+    def load_exif(self):
+        """Load the exif table.
+
+        Returns:
+            pandas.DataFrame: The EXIF data indexed by sha256.
+        """
+        with self.lock:
+            rows = self.connection.execute("SELECT sha256, data FROM exif").fetchall()
+        df = pd.DataFrame.from_records([json.loads(data) for _, data in rows], index=[sha256 for sha256, _ in rows])
+        df.index.name = "sha256"
+        return gallery_exif.apply_column_types(df)
+
+    def save_exif(self, df):
+        """Insert or replace EXIF rows.
+
+        Args:
+            df (pandas.DataFrame): EXIF rows indexed by sha256.
+        """
+        if df is None or len(df) == 0:
+            return
+        columns = list(df.columns)
+        rows = []
+        prompt_rows = []
+        for sha256, values in zip(df.index, df.itertuples(index=False, name=None)):
+            data = {c: _to_json_value(v) for c, v in zip(columns, values)}
+            rows.append((sha256, json.dumps({c: v for c, v in data.items() if v is not None})))
+            prompt_rows.append((_fts_rowid(sha256), sha256, _prompt_text(data.get('Positive prompt')), _prompt_text(data.get('Negative prompt'))))
+        with self.lock:
+            self.connection.execute("BEGIN")
+            self.connection.executemany("INSERT OR REPLACE INTO exif (sha256, data) VALUES (?, ?)", rows)
+            if self.fts_available:
+                self.connection.executemany("DELETE FROM prompt_fts WHERE rowid = ?", [(r[0],) for r in prompt_rows])
+                self.connection.executemany("INSERT INTO prompt_fts (rowid, sha256, positive, negative) VALUES (?, ?, ?, ?)", prompt_rows)
+            self.connection.execute("COMMIT")
+
+    def delete_exif(self, sha256_keys):
+        with self.lock:
+            self.connection.execute("BEGIN")
+            self.connection.executemany("DELETE FROM exif WHERE sha256 = ?", [(k,) for k in sha256_keys])
+            if self.fts_available:
+                self.connection.executemany("DELETE FROM prompt_fts WHERE rowid = ?", [(_fts_rowid(k),) for k in sha256_keys])
+            self.connection.execute("COMMIT")
+
+    def build_prompt_index(self):
+        """Fill the full-text index from the exif table, once per database."""
+        if not self.fts_available or self.get_info("prompt_index_built"):
+            return
+        with self.lock:
+            rows = self.connection.execute("SELECT sha256, data FROM exif").fetchall()
+            prompt_rows = []
+            for sha256, data in rows:
+                data = json.loads(data)
+                prompt_rows.append((_fts_rowid(sha256), sha256, _prompt_text(data.get('Positive prompt')), _prompt_text(data.get('Negative prompt'))))
+            self.connection.execute("BEGIN")
+            self.connection.execute("DELETE FROM prompt_fts")
+            self.connection.executemany("INSERT INTO prompt_fts (rowid, sha256, positive, negative) VALUES (?, ?, ?, ?)", prompt_rows)
+            self.connection.execute("COMMIT")
+        self.set_info("prompt_index_built", "1")
+        logger.info(f"Built the prompt index for {len(prompt_rows)} images")
+
+    def search_prompts(self, query, field='both'):
+        """Search the positive and/or negative prompts with the full-text index.
+
+        Args:
+            query (str): The search query, see `build_match_query`.
+            field (str, optional): "both", "positive" or "negative". Defaults to "both".
+
+        Returns:
+            list: The sha256 keys of the matching images, or None if the index is not available.
+        """
+        if not self.fts_available:
+            return None
+        expression = build_match_query(query)
+        if not expression:
+            return []
+        columns = PROMPT_FIELDS.get(field, PROMPT_FIELDS['both'])
+        with self.lock:
+            rows = self.connection.execute("SELECT sha256 FROM prompt_fts WHERE prompt_fts MATCH ?", (f"{columns} : ({expression})",)).fetchall()
+        return [row[0] for row in rows]
+
+    def migrate_from_csv(self, metadata_subdir):
+        """Import imgview_metadata.csv and exif_df.csv from earlier versions, once.
+
+        Args:
+            metadata_subdir (Path): The metadata folder of the image folder.
+        """
+        if self.get_info("csv_migrated"):
+            return
+        metadata_subdir = Path(metadata_subdir)
+        metadata_path = metadata_subdir.joinpath("imgview_metadata.csv")
+        if metadata_path.exists():
+            metadata_df = pd.read_csv(metadata_path, index_col='sha256', converters={'Tags': _literal_list, 'Categorization': _literal_list})
+            self.save_metadata(metadata_df)
+            logger.info(f"Migrated {len(metadata_df)} metadata rows from {metadata_path}")
+        exif_df_path = metadata_subdir.joinpath("exif_df.csv")
+        if exif_df_path.exists():
+            exif_df = pd.read_csv(exif_df_path, index_col='sha256')
+            self.save_exif(exif_df)
+            logger.info(f"Migrated {len(exif_df)} EXIF rows from {exif_df_path}")
+        self.set_info("csv_migrated", "1")
+
+def open_store(metadata_subdir):
+    """Open the metadata database of an image folder, migrating old CSV files into it.
+
+    Args:
+        metadata_subdir (Path): The metadata folder of the image folder.
+
+    Returns:
+        MetadataStore: The opened store.
+    """
+    store = MetadataStore(Path(metadata_subdir).joinpath(DATABASE_NAME))
+    store.migrate_from_csv(metadata_subdir)
+    store.build_prompt_index()
+    return store
+
+if __name__ == '__main__':
+    # Benchmark of the prompt search on a synthetic library:
+    #   python gallery_store.py [number of images]
+    import hashlib
+    import random
+    import sys
+    import tempfile
+    import time
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    words = [f"word{i}" for i in range(5000)] + ["masterpiece", "portrait", "landscape", "cat", "dog", "best", "quality"]
+    negative_prompts = ["blurry, lowres, bad anatomy", "worst quality, low quality", "watermark, text"]
+    with tempfile.TemporaryDirectory() as tmp:
+        store = MetadataStore(Path(tmp) / DATABASE_NAME)
+        start = time.perf_counter()
+        batch = 50000
+        for offset in range(0, count, batch):
+            keys = [hashlib.sha256(str(i).encode()).hexdigest() for i in range(offset, min(offset + batch, count))]
+            df = pd.DataFrame({
+                'Positive prompt': [", ".join(random.choices(words, k=12)) for _ in keys],
+                'Negative prompt': [random.choice(negative_prompts) for _ in keys],
+            }, index=keys)
+            store.save_exif(df)
+        print(f"Indexed {count} images in {time.perf_counter() - start:.1f} seconds")
+        for query, field in [("cat", "both"), ("masterpiece portrait", "positive"), ('"best quality"', "both"), ("word12*", "positive"), ("watermark", "negative")]:
+            start = time.perf_counter()
+            found = store.search_prompts(query, field)
+            print(f"{query!r:24} {field:9} {len(found):8} matches {1000 * (time.perf_counter() - start):8.1f} ms")
+        store.close()
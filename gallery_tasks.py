@@ -0,0 +1,169 @@
+"""
+Background tasks with progress reporting.
+
+The `TaskManager` runs submitted tasks one after another in a worker thread, so the web
+server can answer requests while a library is being indexed. Every task gets a `Task`
+object to report its progress on, and the manager hands out snapshots of all recent
+tasks for the /progress route.
+
+Tasks that belong to a library are cancelled when another library is opened. A
+cancelled task stops at the next progress report it makes.
+"""
+
+import logging
+import queue
+import threading
+import time
+import traceback
+
+MAX_FINISHED_TASKS = 20
+
+logger = logging.getLogger(__name__)
+
+class TaskCancelled(Exception):
+    """Raised inside a task when it has been cancelled."""
+
+class Task():
+    """A unit of background work and its progress.
+
+    Args:
+        name (str): Short name of the task, e.g. "exif" or "thumbnails".
+        description (str): What the task does, as shown in the progress bar.
+        fn (callable): Called with the task once it runs.
+    """
+    def __init__(self, name, description, fn) -> None:
+        self.name = name
+        self.description = description
+        self.fn = fn
+        self.status = "pending"
+        self.done = 0
+        self.total = 0
+        self.message = ""
+        self.error = None
+        self.started = None
+        self.finished = None
+        self.cancel_event = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def update(self, done=None, total=None, message=None):
+        """Report progress, raising TaskCancelled if the task has been cancelled.
+
+        Args:
+            done (int, optional): Units of work done so far.
+            total (int, optional): Units of work in total.
+            message (str, optional): What the task is doing right now.
+        """
+        if done is not None:
+            self.done = done
+        if total is not None:
+            self.total = total
+        if message is not None:
+            self.message = message
+        if self.cancelled:
+            raise TaskCancelled(self.name)
+
+    def progress(self, done, total):
+        """Progress callback in the form used by gallery_thumbnails.build_thumbnails."""
+        self.update(done=done, total=total)
+
+    def to_dict(self):
+        elapsed = None
+        if self.started is not None:
+            elapsed = round((self.finished or time.time()) - self.started, 2)
+        return {"name": self.name,
+                "description": self.description,
+                "status": self.status,
+                "done": self.done,
+                "total": self.total,
+                "message": self.message,
+                "error": self.error,
+                "elapsed": elapsed}
+
+class TaskManager():
+    """Runs tasks one at a time in a background thread."""
+    def __init__(self) -> None:
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.tasks = []
+        self.thread = threading.Thread(target=self._run, name="task-manager", daemon=True)
+        self.thread.start()
+
+    def submit(self, name, fn, description=""):
+        """Queue a task.
+
+        Args:
+            name (str): Short name of the task.
+            fn (callable): Called with the Task once it runs. It should report progress
+                through Task.update, which is also where it is stopped when cancelled.
+            description (str, optional): What the task does.
+
+        Returns:
+            Task: The queued task.
+        """
+        task = Task(name, description or name, fn)
+        with self.lock:
+            self.tasks.append(task)
+            finished = [t for t in self.tasks if t.finished is not None]
+            for old in finished[:max(0, len(finished) - MAX_FINISHED_TASKS)]:
+                self.tasks.remove(old)
+        self.queue.put(task)
+        return task
+
+    def cancel_all(self):
+        """Cancel all pending and running tasks."""
+        with self.lock:
+            for task in self.tasks:
+                if task.finished is None:
+                    task.cancel()
+
+    def latest(self, name):
+        """Get the most recently submitted task with a name, or None."""
+        with self.lock:
+            for task in reversed(self.tasks):
+                if task.name == name:
+                    return task
+        return None
+
+    def busy(self):
+        with self.lock:
+            return any(task.finished is None for task in self.tasks)
+
+    def snapshot(self):
+        """Get the state of all recent tasks, oldest first."""
+        with self.lock:
+            tasks = [task.to_dict() for task in self.tasks]
+        return {"busy": any(task["status"] in ("pending", "running") for task in tasks), "tasks": tasks}
+
+    def wait(self):
+        """Block until all queued tasks have finished."""
+        self.queue.join()
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task.cancelled:
+                    task.status = "cancelled"
+                    continue
+                task.status = "running"
+                task.started = time.time()
+                logger.info(f"Started {task.description}")
+                task.fn(task)
+                task.status = "done"
+                logger.info(f"Finished {task.description} in {time.time() - task.started:.2f} seconds")
+            except TaskCancelled:
+                task.status = "cancelled"
+                logger.info(f"Cancelled {task.description}")
+            except Exception:
+                task.status = "failed"
+                task.error = traceback.format_exc().splitlines()[-1]
+                logger.error(traceback.format_exc())
+            finally:
+                task.finished = time.time()
+                self.queue.task_done()
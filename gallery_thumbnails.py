@@ -0,0 +1,119 @@
+"""
+Thumbnail generation for the image viewer.
+
+Thumbnails are pre-generated by `build_thumbnails`, which spreads the decode, resize and
+JPEG encode of every image that does not have a thumbnail yet over all cores. The same
+`make_thumbnail` function is used by the viewer to create a single thumbnail on demand
+when it is asked for one that has not been built yet.
+"""
+
+import logging
+import multiprocessing
+import os
+from pathlib import Path
+from PIL import Image
+
+import gallery_index
+
+# Increase the maximum pixel count limit
+Image.MAX_IMAGE_PIXELS = None
+
+THUMBNAIL_HEIGHT = 256
+THUMBNAIL_QUALITY = 85
+# Fewer thumbnails than this are made in this process, starting worker processes would take longer
+MIN_POOL_THUMBNAILS = 8
+
+logger = logging.getLogger(__name__)
+
+def thumbnail_path_for_image(image, thumbnail_folder):
+    """Get the path of the thumbnail for an image.
+
+    Args:
+        image (str): Path of the image.
+        thumbnail_folder (Path): Folder the thumbnails are stored in.
+
+    The name holds the start of the sha256 key of the image path, so images with the
+    same file name in different subfolders get a thumbnail each.
+
+    Returns:
+        Path: The path of the thumbnail.
+    """
+    return Path(thumbnail_folder) / f"{Path(image).stem}_{gallery_index.path_sha256(str(image))[:16]}_thumbnail.jpg"
+
+def make_thumbnail(image, thumbnail_path):
+    """Create the JPEG thumbnail of an image.
+
+    The thumbnail is written to a temporary file and moved into place, so a thumbnail
+    that is built concurrently by the background stage and an on-demand request is
+    never seen half written.
+
+    Args:
+        image (str): Path of the image.
+        thumbnail_path (Path): Where to write the thumbnail.
+    """
+    img = Image.open(image)
+    ratio = img.width / img.height
+    size = (int(THUMBNAIL_HEIGHT * ratio), THUMBNAIL_HEIGHT)
+    if img.format == "JPEG":
+        # Let the JPEG decoder scale down while decoding instead of decoding full size
+        img.draft("RGB", size)
+    if img.format == "PNG":
+        img = img.convert("P")
+    img = img.convert("RGB")
+    img.thumbnail(size, Image.LANCZOS)
+    tmp_path = Path(thumbnail_path).with_name(f"{Path(thumbnail_path).name}.{os.getpid()}.tmp")
+    img.save(tmp_path, format='JPEG', quality=THUMBNAIL_QUALITY)
+    os.replace(tmp_path, thumbnail_path)
+
+def _build_thumbnail(task):
+    image, thumbnail_path = task
+    try:
+        make_thumbnail(image, thumbnail_path)
+        return image, None
+    except Exception as e:
+        return image, str(e)
+
+def build_thumbnails(images, thumbnail_folder, processes=None, progress=None):
+    """Build the thumbnails that are missing for a list of images in parallel.
+
+    Args:
+        images (list): Paths of the images.
+        thumbnail_folder (Path): Folder the thumbnails are stored in.
+        processes (int, optional): Number of worker processes. Defaults to the number of cores.
+        progress (callable, optional): Called as progress(done, total) after each thumbnail.
+
+    Returns:
+        int: The number of thumbnails that were built.
+    """
+    thumbnail_folder = Path(thumbnail_folder)
+    thumbnail_folder.mkdir(parents=True, exist_ok=True)
+    tasks = []
+    for image in images:
+        thumbnail_path = thumbnail_path_for_image(image, thumbnail_folder)
+        if not thumbnail_path.exists():
+            tasks.append((image, thumbnail_path))
+    total = len(tasks)
+    logger.debug(f"Building {total} thumbnails of {len(images)} images")
+    if progress:
+        progress(0, total)
+    if not tasks:
+        return 0
+    if total < MIN_POOL_THUMBNAILS:
+        for done, (image, error) in enumerate(map(_build_thumbnail, tasks), 1):
+            if error:
+                logger.warning(f"Could not build thumbnail for {image}: {error}")
+            if progress:
+                progress(done, total)
+        return total
+
+    processes = processes or multiprocessing.cpu_count()
+    chunksize = max(1, min(64, total // (processes * 8)))
+    done = 0
+    with multiprocessing.Pool(processes) as pool:
+        for image, error in pool.imap_unordered(_build_thumbnail, tasks, chunksize=chunksize):
+            done += 1
+            if error:
+                logger.warning(f"Could not build thumbnail for {image}: {error}")
+            if progress:
+                progress(done, total)
+    return done
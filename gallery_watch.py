@@ -0,0 +1,163 @@
+"""
+Watching an image folder for new and deleted images.
+
+`FolderWatcher` uses the optional watchdog package, which is backed by inotify on Linux
+(and the native APIs on Windows and macOS), when it is installed. Without it, or when
+the native watcher cannot be started, it falls back to polling a cheap incremental
+rescan of the folder (see gallery_scan), against a snapshot it keeps in memory.
+
+File events are collected into batches. A batch is handed to the `on_changes` callback
+once no new events have arrived for `debounce` seconds, or at the latest `max_delay`
+seconds after its first event, so a burst of thousands of new files results in a few
+large batches instead of thousands of small ones.
+
+Usage:
+    pip install watchdog
+"""
+
+import logging
+import os
+import threading
+import time
+import traceback
+import gallery_scan
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+logger = logging.getLogger(__name__)
+
+class _EventHandler(FileSystemEventHandler):
+    def __init__(self, watcher) -> None:
+        super().__init__()
+        self.watcher = watcher
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.watcher.record(added=[event.src_path])
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.watcher.record(added=[event.src_path])
+
+    def on_deleted(self, event):
+        if not event.is_directory:
+            self.watcher.record(removed=[event.src_path])
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self.watcher.record(added=[event.dest_path], removed=[event.src_path])
+
+class FolderWatcher():
+    """Watch a folder and report new and deleted images in batches.
+
+    Args:
+        folder (Path): The folder to watch, including its subfolders.
+        on_changes (callable): Called as on_changes(added, removed) with sets of image paths.
+        is_valid_image (callable): Called with a file name, returns whether it is an image.
+        debounce (float, optional): Seconds without events before a batch is delivered.
+        max_delay (float, optional): Maximum seconds a batch is held back during a burst.
+        poll_interval (float, optional): Seconds between rescans when polling.
+    """
+    def __init__(self, folder, on_changes, is_valid_image, debounce=1.0, max_delay=10.0, poll_interval=5.0) -> None:
+        self.folder = str(folder)
+        self.on_changes = on_changes
+        self.snapshot = None
+        self.is_valid_image = is_valid_image
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.added = set()
+        self.removed = set()
+        self.first_event = None
+        self.last_event = None
+        self.observer = None
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def start(self):
+        """Start watching in a background thread."""
+        if Observer is not None:
+            try:
+                self.observer = Observer()
+                self.observer.schedule(_EventHandler(self), self.folder, recursive=True)
+                self.observer.start()
+                logger.info(f"Watching {self.folder} for changes")
+            except Exception as e:
+                logger.warning(f"Could not start the file system watcher, polling {self.folder} instead: {e}")
+                self.observer = None
+        else:
+            logger.info(f"watchdog is not installed, polling {self.folder} every {self.poll_interval} seconds")
+        if self.observer is None:
+            _, self.snapshot = gallery_scan.scan_directories(self.folder, {}, self.is_valid_image)
+        self.thread = threading.Thread(target=self._run, name="folder-watcher", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop watching and wait for the background thread to finish."""
+        self.stop_event.set()
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+        if self.thread is not None:
+            self.thread.join()
+
+    def record(self, added=(), removed=()):
+        """Add file events to the pending batch.
+
+        Args:
+            added (iterable): Paths of files that were created, modified or moved here.
+            removed (iterable): Paths of files that were deleted or moved away.
+        """
+        added = [p for p in added if self.is_valid_image(os.path.basename(p))]
+        removed = [p for p in removed if self.is_valid_image(os.path.basename(p))]
+        if not added and not removed:
+            return
+        now = time.monotonic()
+        with self.lock:
+            for path in added:
+                self.removed.discard(path)
+                self.added.add(path)
+            for path in removed:
+                self.added.discard(path)
+                self.removed.add(path)
+            if self.first_event is None:
+                self.first_event = now
+            self.last_event = now
+
+    def _take_batch(self):
+        now = time.monotonic()
+        with self.lock:
+            if self.first_event is None:
+                return None
+            if now - self.last_event < self.debounce and now - self.first_event < self.max_delay:
+                return None
+            batch = (self.added, self.removed)
+            self.added, self.removed = set(), set()
+            self.first_event = self.last_event = None
+        return batch
+
+    def _run(self):
+        next_poll = time.monotonic() + self.poll_interval
+        while not self.stop_event.wait(min(self.debounce, self.poll_interval) / 2):
+            if self.observer is None and time.monotonic() >= next_poll:
+                try:
+                    scan, self.snapshot = gallery_scan.scan_directories(self.folder, self.snapshot, self.is_valid_image)
+                    self.record(added=scan.added | scan.changed, removed=scan.removed)
+                except Exception:
+                    logger.error(traceback.format_exc())
+                next_poll = time.monotonic() + self.poll_interval
+            batch = self._take_batch()
+            if batch is None:
+                continue
+            added, removed = batch
+            logger.debug(f"Delivering {len(added)} added and {len(removed)} removed images")
+            try:
+                self.on_changes(added, removed)
+            except Exception:
+                logger.error(traceback.format_exc())
@@ -522,8 +522,8 @@ $(document).ready(function () {
                 window.location.replace(response); // redirect to the image viewer with a filtered image
             },
             error: function (jqXHR, textStatus, errorThrown) { // handle http errors
-                console.log(response)
-                alert(textStatus + ": " + errorThrown);
+                // e.g. a semantic search while the images are being indexed for it
+                alert(jqXHR.responseJSON && jqXHR.responseJSON.error ? jqXHR.responseJSON.error : textStatus + ": " + errorThrown);
             }
         });
     });
@@ -593,9 +593,122 @@ document.getElementById('light-style').addEventListener('click', setThemeFromCoo
 // Load initial thumbnails
 lazyLoadThumbnails();
 
+// Fill the datalist of the tag and category filter inputs from /autocomplete while typing
+function autocompleteInput(input) {
+    const datalist = document.getElementById(input.getAttribute('list'));
+    const field = input.dataset.field;
+    // Complete the last of the comma separated terms, keeping the ones before it
+    const terms = input.value.split(',');
+    const last = terms.pop().trimStart();
+    const head = terms.length ? terms.join(',') + ',' : '';
+    fetch(`/autocomplete?field=${field}&counts=true&prefix=${encodeURIComponent(last)}`)
+        .then(response => response.json())
+        .then(values => {
+            datalist.innerHTML = '';
+            values.forEach(([value, count]) => {
+                const option = document.createElement('option');
+                option.value = head + value;
+                option.label = `${value} (${count})`;
+                datalist.appendChild(option);
+            });
+        });
+}
+
+document.querySelectorAll('.autocomplete').forEach(input => {
+    input.addEventListener('focus', () => autocompleteInput(input));
+    input.addEventListener('input', () => autocompleteInput(input));
+});
+
+// Show the progress of the background indexing until it is done
+function pollIndexingProgress() {
+    fetch('/progress')
+        .then(response => response.json())
+        .then(data => {
+            const box = document.getElementById('indexing-progress');
+            if (!data.busy) {
+                box.hidden = true;
+                return;
+            }
+            const task = data.tasks.find(task => task.status === 'running') || data.tasks.find(task => task.status === 'pending');
+            document.getElementById('indexing-label').textContent = `${task.description}: ${task.done} / ${task.total}`;
+            const bar = document.getElementById('indexing-bar');
+            bar.max = task.total || 1;
+            bar.value = task.done;
+            box.hidden = false;
+            setTimeout(pollIndexingProgress, 1000);
+        });
+}
+
+pollIndexingProgress();
+
+// Replace the thumbnails with the images most similar to the active image
+function showSimilarImages() {
+    const container = document.getElementById('thumbnails');
+    const image_name = document.getElementById('active-image').alt;
+    container.removeEventListener('scroll', loadMoreThumbnails);
+    fetch(`/similar?image_name=${encodeURIComponent(image_name)}&k=50`)
+        .then(response => response.json())
+        .then(data => {
+            if (data.error) {
+                alert(data.error);
+                return;
+            }
+            container.innerHTML = '';
+            data.results.forEach(result => {
+                container.insertAdjacentHTML('beforeend',
+                    `<div class="thumbnail"><a href="${result.image_src}" title="${result.similarity}"><img src="${result.thumb_src}" loading="lazy" /></a></div>`);
+            });
+        });
+}
+
+document.getElementById('similar').addEventListener('click', showSimilarImages);
+
 var filterbtn = document.querySelector('.filterbtn');
 var filterform = document.querySelector('.filterform');
 
 filterbtn.addEventListener('click', function() {
   filterform.classList.toggle('open');
+  if (filterform.classList.contains('open')) {
+    showFacets();
+  }
 });
+
+// Show how many of the images being viewed each filter value would keep
+function showFacets() {
+  fetch('/facets?limit=8')
+    .then(response => response.json())
+    .then(data => {
+      const facets = data.facets;
+      // A rating filter keeps the images with at least that rating
+      let atLeast = 0;
+      const ratings = {};
+      facets.Rating.slice().reverse().forEach(facet => {
+        atLeast += facet.filtered;
+        ratings[facet.value] = atLeast;
+      });
+      document.querySelectorAll('#rating option').forEach(option => {
+        option.textContent = option.textContent.replace(/ \(\d+\)$/, '');
+        if (option.value) {
+          option.textContent += ` (${ratings[option.value] || 0})`;
+        }
+      });
+      document.querySelectorAll('#favorites option').forEach(option => {
+        option.textContent = option.textContent.replace(/ \(\d+\)$/, '');
+        const facet = facets.Favorites.find(facet => String(facet.value) === option.value.toLowerCase());
+        if (facet) {
+          option.textContent += ` (${facet.filtered})`;
+        }
+      });
+      const container = document.getElementById('facets');
+      container.innerHTML = '';
+      ['Model', 'Sampler', 'Steps', 'CFG scale'].forEach(field => {
+        const values = facets[field].filter(facet => facet.filtered > 0);
+        if (!values.length) {
+          return;
+        }
+        const line = document.createElement('div');
+        line.textContent = `${field}: ` + values.map(facet => `${facet.value} (${facet.filtered})`).join(', ');
+        container.appendChild(line);
+      });
+    });
+}
@@ -0,0 +1,118 @@
+"""
+Stress test of the production server: parallel viewing and editing must lose no edits.
+
+Runs `gallery.py --serve production` on an image folder, from a temporary working
+directory so the metadata of the folder is a fresh copy, and sends /img, /thumbnails,
+/set-rating and /add-tags requests from many threads. Afterwards every rating and tag
+must be served by the server and stored in the metadata store.
+
+Usage:
+    python stress_library.py <image folder> [threads]
+"""
+
+import ast
+import json
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import gallery_scan
+import gallery_store
+
+def _request(base, path, params=None, body=None):
+    url = base + path + ("?" + urllib.parse.urlencode(params) if params else "")
+    data = json.dumps(body).encode() if body is not None else None
+    request = urllib.request.Request(url, data=data, method="PUT" if body is not None else "GET",
+                                     headers={"Content-Type": "application/json"} if body is not None else {})
+    with urllib.request.urlopen(request, timeout=60) as response:
+        return response.read()
+
+def _stress(base, images, threads, rounds):
+    """Send /img, /thumbnails, /set-rating and /add-tags requests from many threads.
+
+    Every thread rates its own images and adds its own tags to one shared image, so
+    afterwards the last rating of each image and every tag must be there. Threads left
+    without images of their own, when there are fewer images than threads, rate nothing.
+    """
+    shared = images[0]
+    expected_ratings = {}
+    timings = {"/img": [], "/thumbnails": [], "/set-rating": [], "/add-tags": []}
+    errors = []
+
+    def worker(n):
+        own = images[1 + n::threads]
+        for i in range(rounds):
+            image = own[i % len(own)] if own else shared
+            requests = [("/img", {"image_name": image}, None),
+                        ("/thumbnails", {"limit": 30, "imgsrc": image}, None),
+                        ("/add-tags", None, {"image_name": shared, "tags": [f"t{n}-{i}"]})]
+            if own:
+                requests.append(("/set-rating", None, {"image_name": image, "rating": str(1 + (n + i) % 5)}))
+            for path, params, body in requests:
+                start_time = time.perf_counter()
+                try:
+                    _request(base, path, params, body)
+                except Exception as e:
+                    errors.append(f"{path}: {e}")
+                timings[path].append(time.perf_counter() - start_time)
+            if own:
+                expected_ratings[image] = 1 + (n + i) % 5
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(worker, range(threads)))
+    elapsed = time.perf_counter() - start_time
+    total = sum(len(t) for t in timings.values())
+    print(f"{total} requests from {threads} threads in {elapsed:.2f} seconds, {total / elapsed:.0f} requests/s")
+    for path, times in timings.items():
+        times = sorted(times)
+        if not times:
+            continue
+        print(f"{path:>12}: median {1000 * times[len(times) // 2]:6.1f} ms, p95 {1000 * times[int(len(times) * 0.95)]:6.1f} ms")
+    expected_tags = {f"t{n}-{i}" for n in range(threads) for i in range(rounds)}
+    return expected_ratings, shared, expected_tags, errors
+
+if __name__ == "__main__":
+    # Run the production server on an image folder and check that no edit is lost under parallel traffic
+    folder = Path(sys.argv[1]).resolve()
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    # gallery parses the command line when it is imported, which holds none of its arguments here
+    sys.argv = sys.argv[:1]
+    import gallery
+    port = 8799
+    base = f"http://127.0.0.1:{port}"
+    with tempfile.TemporaryDirectory() as cwd:
+        server = subprocess.Popen([sys.executable, str(Path(__file__).with_name("gallery.py")), "--imagedir", str(folder),
+                                   "--port", str(port), "--serve", "production", "--threads", str(threads)],
+                                  cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            for _ in range(600):
+                try:
+                    if not json.loads(_request(base, "/progress"))["busy"]:
+                        break
+                except OSError:
+                    pass
+                time.sleep(0.1)
+            # The images the server lists, found the way it finds them
+            images = sorted(gallery_scan.scan_directories(str(folder), {}, gallery.is_valid_image_extension)[0].images)
+            expected_ratings, shared, expected_tags, errors = _stress(base, images, threads, rounds=25)
+            lost_ratings = [image for image, rating in expected_ratings.items()
+                            if json.loads(_request(base, "/get-metadata", {"image_name": image}))["Rating"] != rating]
+            served_tags = set(ast.literal_eval(json.loads(_request(base, "/get-metadata", {"image_name": shared}))["Tags"]))
+        finally:
+            server.terminate()
+            server.wait()
+
+        store = gallery_store.open_store(Path(cwd) / "metadata" / (folder.parent.name + "_" + folder.name))
+        stored = store.load_metadata().set_index("Path")
+        store.close()
+        lost_stored = [image for image, rating in expected_ratings.items() if stored.at[image, "Rating"] != rating]
+        print(f"Failed requests: {len(errors)}" + (f", e.g. {errors[0]}" if errors else ""))
+        print(f"Ratings lost: {len(lost_ratings)} served, {len(lost_stored)} stored, of {len(expected_ratings)}")
+        print(f"Tags lost: {len(expected_tags - served_tags)} served, {len(expected_tags - set(stored.at[shared, 'Tags']))} stored, of {len(expected_tags)}")
+        sys.exit(1 if errors or lost_ratings or lost_stored or expected_tags - served_tags else 0)